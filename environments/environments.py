@@ -23,6 +23,7 @@ CLASSIFIER = {
         "DROPOUT": 0.3,
         "VAMPIRE_DIRECTORY": os.environ.get("VAMPIRE_DIR", None),
         "VAMPIRE_DIM": os.environ.get("VAMPIRE_DIM", None),
+        "VOCABULARY_CACHE": os.environ.get("VOCABULARY_CACHE", os.environ["DATA_DIR"] + "/.vocabulary_cache"),
         "BATCH_SIZE": 32,
         "NUM_ENCODER_LAYERS": 1,
         "NUM_OUTPUT_LAYERS": 2, 
@@ -46,10 +47,11 @@ VAMPIRE = {
         "SIGMOID_WEIGHT_2": 15,
         "LINEAR_SCALING": 1000,
         "VAE_HIDDEN_DIM": 81,
-        "TRAIN_PATH": os.environ["DATA_DIR"] + "/train.npz",
-        "DEV_PATH": os.environ["DATA_DIR"] + "/dev.npz",
-        "REFERENCE_COUNTS": os.environ["DATA_DIR"] + "/reference/ref.npz",
-        "REFERENCE_VOCAB": os.environ["DATA_DIR"] + "/reference/ref.vocab.json",
+        "TRAIN_PATH": os.environ["DATA_DIR"] + "/train." + os.environ.get("DATA_FORMAT", "npz"),
+        "DEV_PATH": os.environ["DATA_DIR"] + "/dev." + os.environ.get("DATA_FORMAT", "npz"),
+        "REFERENCE_COUNTS": os.environ["DATA_DIR"] + "/reference/ref." + os.environ.get("DATA_FORMAT", "npz"),
+        "REFERENCE_VOCAB": os.environ.get("REFERENCE_VOCAB", os.environ["DATA_DIR"] + "/reference/ref.vocab.json"),
+        "REFERENCE_NPMI": os.environ.get("REFERENCE_NPMI", ""),
         "VOCABULARY_DIRECTORY": os.environ["DATA_DIR"] + "/vocabulary/",
         "BACKGROUND_DATA_PATH": os.environ["DATA_DIR"] + "/vampire.bgfreq",
         "NUM_ENCODER_LAYERS": 2,
@@ -62,6 +64,7 @@ VAMPIRE = {
         "Z_DROPOUT": 0.49,
         "LEARNING_RATE": 1e-3,
         "TRACK_NPMI": True,
+        "ASYNC_NPMI": os.environ.get("ASYNC_NPMI", 0),
         "CUDA_DEVICE": 0,
         "UPDATE_BACKGROUND_FREQUENCY": 0,
         "VOCAB_SIZE": os.environ.get("VOCAB_SIZE", 30000),
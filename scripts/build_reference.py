@@ -0,0 +1,160 @@
+import argparse
+import os
+import tempfile
+from typing import List
+
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import CountVectorizer
+from tqdm import tqdm
+
+from scripts.preprocess_data import count_terms, iter_chunks, iter_data
+from vampire.common.npmi import npmi_matrices_from_interactions, save_npmi_matrices
+from vampire.common.util import CSRWriter, read_json, read_text, write_to_json
+
+REFERENCE_NPMI_FILE = "ref.npmi.npz"
+TRIPLET_DTYPE = np.dtype([("row", "<i4"), ("col", "<i4"), ("count", "<i8")])
+
+
+class CooccurrenceAccumulator:
+    """
+    Sums sparse (vocabulary x vocabulary) co-occurrence blocks out of core. Blocks are
+    summed in memory until the sum holds more than 'max_buffer_entries' entries. Its
+    (row, col, count) triplets are then appended to on-disk buckets of rows, and
+    'finalize' sums each bucket on its own.
+    """
+    def __init__(self, vocab_size: int, directory: str, num_buckets: int = 16,
+                 max_buffer_entries: int = 1 << 25) -> None:
+        self.vocab_size = vocab_size
+        self._bucket_rows = max(1, -(-vocab_size // num_buckets))
+        self._paths = [os.path.join(directory, f"bucket{bucket}.triplets")
+                       for bucket in range(-(-vocab_size // self._bucket_rows))]
+        self._files = [open(path, "wb") for path in self._paths]
+        self._max_buffer_entries = max_buffer_entries
+        self._buffer = None
+
+    def add(self, block: sparse.spmatrix) -> None:
+        self._buffer = block.tocsr() if self._buffer is None else self._buffer + block
+        if self._buffer.nnz > self._max_buffer_entries:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._buffer is None:
+            return
+        buffer = self._buffer.tocoo()
+        self._buffer = None
+        triplets = np.empty(buffer.nnz, dtype=TRIPLET_DTYPE)
+        triplets["row"], triplets["col"], triplets["count"] = buffer.row, buffer.col, buffer.data
+        buckets = buffer.row // self._bucket_rows
+        order = np.argsort(buckets, kind="stable")
+        boundaries = np.searchsorted(buckets[order], np.arange(len(self._files) + 1))
+        for bucket, output_file in enumerate(self._files):
+            triplets[order[boundaries[bucket]:boundaries[bucket + 1]]].tofile(output_file)
+
+    def finalize(self) -> sparse.csr_matrix:
+        """
+        Sum all blocks added so far into one CSR matrix, and remove the buckets.
+        """
+        self.flush()
+        blocks = []
+        for bucket, (path, output_file) in enumerate(zip(self._paths, self._files)):
+            output_file.close()
+            triplets = np.fromfile(path, dtype=TRIPLET_DTYPE)
+            os.remove(path)
+            start = bucket * self._bucket_rows
+            num_rows = min(self._bucket_rows, self.vocab_size - start)
+            # Converting to CSR sums the duplicate entries.
+            blocks.append(sparse.coo_matrix((triplets["count"], (triplets["row"] - start, triplets["col"])),
+                                            shape=(num_rows, self.vocab_size)).tocsr())
+        return sparse.vstack(blocks, format="csr")
+
+
+def read_vocabulary(vocabulary_path: str) -> List[str]:
+    """
+    Read a JSON list of words (e.g. a 'ref.vocab.json'), or a text file with one word per
+    line (e.g. a VAMPIRE 'vocabulary/vampire.txt'). Special '@@...@@' tokens are skipped.
+    """
+    if vocabulary_path.endswith(".json"):
+        words = read_json(vocabulary_path)
+    else:
+        words = read_text(vocabulary_path)
+    return sorted({word for word in words if word and not (word.startswith("@@") and word.endswith("@@"))})
+
+
+def build_reference(args) -> None:
+    count_vectorizer_args = dict(stop_words='english', token_pattern=r'\b[^\d\W]{3,30}\b')
+    if args.vocabulary_path:
+        vocabulary = read_vocabulary(args.vocabulary_path)
+    else:
+        print("counting terms...")
+        analyzer = CountVectorizer(**count_vectorizer_args).build_analyzer()
+        texts = iter_data(args.reference_corpus_path, args.tokenize, args.tokenizer_type, args.workers)
+        _, doc_counts = count_terms(texts, analyzer, args.max_counter_size)
+        vocabulary = sorted(term for term, _ in doc_counts.most_common(args.vocab_size))
+    vectorizer = CountVectorizer(vocabulary=vocabulary, binary=True, **count_vectorizer_args)
+
+    if not os.path.isdir(args.serialization_dir):
+        os.makedirs(args.serialization_dir)
+    counts_writer = None
+    if args.save_counts:
+        counts_writer = CSRWriter(os.path.join(args.serialization_dir, "ref.csr"), len(vocabulary))
+
+    n_docs = 0
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir or args.serialization_dir) as tmp_dir:
+        accumulator = CooccurrenceAccumulator(len(vocabulary), tmp_dir, max_buffer_entries=args.max_buffer_entries)
+        texts = iter_data(args.reference_corpus_path, args.tokenize, args.tokenizer_type, args.workers)
+        for chunk in tqdm(iter_chunks(texts, args.chunk_size), desc="counting co-occurrences"):
+            doc_counts = vectorizer.transform(chunk).astype(np.int64)
+            n_docs += doc_counts.shape[0]
+            if counts_writer is not None:
+                counts_writer.append(doc_counts)
+            # The co-occurrence matrix is symmetric, so only its upper triangle is accumulated.
+            accumulator.add(sparse.triu(doc_counts.T.dot(doc_counts)))
+        upper = accumulator.finalize()
+    if counts_writer is not None:
+        counts_writer.close()
+
+    print("generating npmi matrices...")
+    interactions = upper + sparse.triu(upper, k=1).T
+    save_npmi_matrices(npmi_matrices_from_interactions(interactions, n_docs),
+                       os.path.join(args.serialization_dir, REFERENCE_NPMI_FILE))
+    write_to_json(vocabulary, os.path.join(args.serialization_dir, "ref.vocab.json"))
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--reference-corpus-path", type=str, required=True,
+                        help="Path to the reference corpus jsonl file.")
+    parser.add_argument("--serialization-dir", "-s", type=str, required=True,
+                        help=f"Path to store {REFERENCE_NPMI_FILE} and ref.vocab.json.")
+    vocabulary = parser.add_mutually_exclusive_group(required=True)
+    vocabulary.add_argument("--vocabulary-path", type=str,
+                            help="Restrict the reference to the words of this vocabulary, e.g. the "
+                                 "vocabulary/vampire.txt written by preprocess_data.py.")
+    vocabulary.add_argument("--vocab-size", type=int,
+                            help="Restrict the reference to this many words with the highest document "
+                                 "frequency, counted in a first pass over the corpus.")
+    parser.add_argument("--tokenize", action='store_true',
+                        help="Tokenize the reference corpus.")
+    parser.add_argument("--tokenizer-type", type=str, default="just_spaces",
+                        help="Tokenizer used with --tokenize.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes used to load and tokenize the corpus.")
+    parser.add_argument("--chunk-size", type=int, default=10000,
+                        help="Number of documents vectorized at a time.")
+    parser.add_argument("--max-counter-size", type=int, default=5000000,
+                        help="Maximum number of distinct terms counted at once with --vocab-size.")
+    parser.add_argument("--max-buffer-entries", type=int, default=1 << 25,
+                        help="Number of co-occurrence entries summed in memory before spilling to disk.")
+    parser.add_argument("--tmp-dir", type=str, required=False,
+                        help="Directory for the on-disk co-occurrence buckets. Defaults to the serialization dir.")
+    parser.add_argument("--save-counts", action='store_true',
+                        help="Also write the (documents x vocabulary) reference matrix to ref.csr, "
+                             "as needed by the bitset npmi reference.")
+    args = parser.parse_args()
+
+    build_reference(args)
+
+
+if __name__ == '__main__':
+    main()
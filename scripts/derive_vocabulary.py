@@ -0,0 +1,86 @@
+import argparse
+import os
+from typing import Iterator, List
+
+import numpy as np
+from scipy import sparse
+from tqdm import tqdm
+
+from vampire.common.util import (CSRWriter, load_sparse, read_json, save_matrix,
+                                 write_list_to_text, write_to_json)
+
+FULL_VOCABULARY_DIR = "full"
+TERM_COUNTS_FILE = "term_counts.json"
+
+
+def slice_columns(matrix, columns: np.ndarray, chunk_size: int = 100000) -> Iterator[sparse.csr_matrix]:
+    """
+    Yield row chunks of 'matrix' restricted to 'columns' (in that order), with a leading
+    all-zero @@UNKNOWN@@ column.
+    """
+    matrix = matrix.tocsr()
+    for start in range(0, matrix.shape[0], chunk_size):
+        chunk = matrix[start:start + chunk_size][:, columns]
+        unknown = sparse.csr_matrix((chunk.shape[0], 1), dtype=chunk.dtype)
+        yield sparse.hstack((unknown, chunk), format='csr')
+
+
+def derive_vocabulary(full_dir: str, vocab_size: int, serialization_dir: str, output_format: str = None) -> List[str]:
+    """
+    Derive the train and dev matrices, background frequencies and vocabulary for the
+    top 'vocab_size' words from the frequency-sorted full-vocabulary matrices in 'full_dir'.
+    Returns the derived vocabulary (excluding @@UNKNOWN@@).
+    """
+    term_counts = read_json(os.path.join(full_dir, TERM_COUNTS_FILE))
+    top_terms = [term for term, _ in term_counts[:vocab_size]]
+    # Order the vocabulary alphabetically, as CountVectorizer does.
+    columns = np.argsort(top_terms, kind='stable')
+    vocabulary = [top_terms[index] for index in columns]
+
+    vocabulary_dir = os.path.join(serialization_dir, "vocabulary")
+    if not os.path.isdir(vocabulary_dir):
+        os.makedirs(vocabulary_dir)
+
+    word_counts = np.zeros(len(vocabulary) + 1)
+    for split in ("train", "dev"):
+        input_format = "csr" if os.path.exists(os.path.join(full_dir, f"{split}.csr")) else "npz"
+        split_format = output_format or input_format
+        full_matrix = load_sparse(os.path.join(full_dir, f"{split}.{input_format}"))
+        output_prefix = os.path.join(serialization_dir, split)
+        if split_format == "csr":
+            with CSRWriter(output_prefix + ".csr", len(vocabulary) + 1) as writer:
+                for chunk in tqdm(slice_columns(full_matrix, columns), desc=f"slicing {split}"):
+                    writer.append(chunk)
+                    word_counts += np.asarray(chunk.sum(0)).squeeze(0)
+        else:
+            matrix = sparse.vstack(list(slice_columns(full_matrix, columns)))
+            save_matrix(matrix, output_prefix, split_format)
+            word_counts += np.asarray(matrix.sum(0)).squeeze(0)
+
+    bgfreq = dict(zip(vocabulary, word_counts / vocab_size))
+    write_to_json(bgfreq, os.path.join(serialization_dir, "vampire.bgfreq"))
+    write_list_to_text(['@@UNKNOWN@@'] + vocabulary, os.path.join(vocabulary_dir, "vampire.txt"),
+                       add_final_newline=True)
+    write_list_to_text(['*tags', '*labels', 'vampire'], os.path.join(vocabulary_dir, "non_padded_namespaces.txt"),
+                       add_final_newline=True)
+    return vocabulary
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--full-vocabulary-dir", type=str, required=True,
+                        help="Directory written by preprocess_data.py --save-full-vocabulary "
+                             f"(the '{FULL_VOCABULARY_DIR}' subdirectory of its serialization dir).")
+    parser.add_argument("--vocab-size", type=int, required=True,
+                        help="Number of most frequent words to keep.")
+    parser.add_argument("--serialization-dir", "-s", type=str, required=True,
+                        help="Path to store the derived train/dev matrices, vampire.bgfreq and vocabulary.")
+    parser.add_argument("--output-format", type=str, choices=["npz", "csr"], required=False,
+                        help="Format of the output matrices. Defaults to the format of the full matrices.")
+    args = parser.parse_args()
+
+    derive_vocabulary(args.full_vocabulary_dir, args.vocab_size, args.serialization_dir, args.output_format)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+import torch
+from allennlp.data.tokenizers import WordTokenizer
+from allennlp.data.tokenizers.word_splitter import JustSpacesWordSplitter, SpacyWordSplitter
+from tqdm import tqdm
+
+from vampire.common.allennlp_bridge import load_cached_archive
+from vampire.common.feature_store import FeatureStoreWriter
+from vampire.common.util import document_hash
+from vampire.data.dataset_readers import SemiSupervisedTextClassificationJsonReader
+from vampire.modules.pretrained_vae import ARCHIVE_OVERRIDES
+
+
+def default_scalar_mix(num_layers: int) -> List[float]:
+    # The initial scalar mix of PretrainedVAE.
+    return [1] + [-20] * (num_layers - 2) + [1]
+
+
+class DocumentEncoder:
+    """
+    Compute the per-document features of a pretrained VAMPIRE, either mixed with a
+    fixed scalar mix, or every layer's activations.
+    """
+    def __init__(self, model_archive: str, features: str, scalar_mix: List[float] = None,
+                 tokenizer_type: str = "just_spaces", max_sequence_length: int = 400) -> None:
+        self.model = load_cached_archive(model_archive, overrides=ARCHIVE_OVERRIDES).model
+        self.model.eval()
+        self.features = features
+        self.num_layers = len(self.model.vae.encoder._linear_layers) + 1  # pylint: disable=protected-access
+        self.scalar_mix = torch.softmax(torch.FloatTensor(scalar_mix or default_scalar_mix(self.num_layers)), dim=0)
+        word_splitter = SpacyWordSplitter() if tokenizer_type == "spacy" else JustSpacesWordSplitter()
+        # Tokenize exactly as the classifier's reader does, so that documents hash the same.
+        self.reader = SemiSupervisedTextClassificationJsonReader(tokenizer=WordTokenizer(word_splitter=word_splitter),
+                                                                 max_sequence_length=max_sequence_length,
+                                                                 ignore_labels=True)
+
+    @property
+    def feature_shape(self) -> Tuple[int, ...]:
+        dim = self.model.vae.encoder.get_output_dim()
+        return (dim,) if self.features == "mix" else (self.num_layers, dim)
+
+    def token_ids(self, text: str) -> List[int]:
+        """
+        The ids in the vampire namespace of the tokens of ``text``, as the ``vampire_tokens``
+        indexer of the classifier computes them.
+        """
+        tokens = self.reader.text_to_instance(text=text).fields['tokens'].tokens
+        return [self.model.vocab.get_token_index(token.text.lower(), "vampire") for token in tokens]
+
+    def encode(self, inputs) -> np.ndarray:
+        with torch.no_grad():
+            activations = torch.stack([activation for _, activation in self.model.encode(inputs)], dim=1)
+            if self.features == "mix":
+                activations = torch.einsum('l,bld->bd', self.scalar_mix, activations)
+        return activations.numpy()
+
+    @staticmethod
+    def pad_token_ids(documents: List[List[int]]) -> Dict[str, torch.Tensor]:
+        token_ids = torch.zeros(len(documents), max(1, max(map(len, documents))), dtype=torch.long)
+        for index, ids in enumerate(documents):
+            token_ids[index, :len(ids)] = torch.LongTensor(ids)
+        return {'tokens': token_ids}
+
+    def embed_texts(self, texts: List[str]) -> Tuple[List[str], np.ndarray]:
+        """
+        Embed a batch of texts, returning the hashes of the documents that are not empty
+        after tokenization, and their features.
+        """
+        documents = [ids for ids in map(self.token_ids, texts) if ids]
+        if not documents:
+            return [], np.zeros((0,) + self.feature_shape)
+        return [document_hash(ids) for ids in documents], self.encode(self.pad_token_ids(documents))
+
+
+_WORKER_ENCODER = None
+
+
+def share_with_workers(encoder: DocumentEncoder) -> None:
+    """
+    Make ``encoder`` the encoder of the worker processes forked after this call. Its
+    weights, and the embedding table of its first layer, are moved to shared memory
+    first, so that the workers neither load the archive again nor hold their own copy
+    of the weights.
+    """
+    global _WORKER_ENCODER  # pylint: disable=global-statement
+    encoder.model.share_memory()
+    _WORKER_ENCODER = encoder
+
+
+def _init_worker() -> None:
+    # The workers already run in parallel.
+    torch.set_num_threads(1)
+
+
+def _embed_batch(texts: List[str]) -> Tuple[List[str], np.ndarray]:
+    return _WORKER_ENCODER.embed_texts(texts)
+
+
+def iter_batches(input_path: str, batch_size: int) -> Iterator[List[str]]:
+    """
+    Yield lists of texts from a jsonl file.
+    """
+    with open(input_path) as input_file:
+        while True:
+            batch = [json.loads(line)["text"] for line in itertools.islice(input_file, batch_size)]
+            if not batch:
+                return
+            yield batch
+
+
+def count_documents(input_path: str) -> int:
+    with open(input_path, "rb") as input_file:
+        return sum(1 for _ in input_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--model-archive", type=str, required=True,
+                        help="Path to the pretrained VAMPIRE model.tar.gz.")
+    parser.add_argument("--input-path", type=str, required=True,
+                        help="A jsonl file with a 'text' field. Documents are looked up by the token ids "
+                             "that the classifier's dataset reader gives them, so bag-of-words matrices "
+                             "written by preprocess_data.py cannot be used.")
+    parser.add_argument("--serialization-dir", "-s", type=str, required=True,
+                        help="Directory to write the feature store to.")
+    parser.add_argument("--features", type=str, choices=["mix", "all"], default="mix",
+                        help="Store the scalar-mixed representation, or the activations of every layer "
+                             "(so that the classifier can learn its own mix).")
+    parser.add_argument("--scalar-mix", type=float, nargs="+", required=False,
+                        help="Scalar mix parameters used with --features mix. Defaults to the "
+                             "initial mix of the vampire token embedder.")
+    parser.add_argument("--dtype", type=str, choices=["float16", "float32"], default="float32",
+                        help="Storage type of the features.")
+    parser.add_argument("--tokenizer-type", type=str, choices=["just_spaces", "spacy"], default="just_spaces",
+                        help="Tokenizer of the classifier's dataset reader.")
+    parser.add_argument("--max-sequence-length", type=int, default=400,
+                        help="Truncation length of the classifier's dataset reader.")
+    parser.add_argument("--batch-size", type=int, default=1024,
+                        help="Number of documents encoded at a time.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes encoding batches.")
+    args = parser.parse_args()
+
+    encoder = DocumentEncoder(args.model_archive, args.features, args.scalar_mix,
+                              args.tokenizer_type, args.max_sequence_length)
+    metadata = {"model_archive": os.path.abspath(args.model_archive),
+                "features": args.features,
+                "scalar_mix": args.scalar_mix}
+    batches = iter_batches(args.input_path, args.batch_size)
+    with FeatureStoreWriter(args.serialization_dir, count_documents(args.input_path),
+                            encoder.feature_shape, args.dtype, metadata) as writer:
+        if args.workers > 1:
+            share_with_workers(encoder)
+            context = multiprocessing.get_context("fork")
+            with context.Pool(args.workers, initializer=_init_worker) as pool:
+                for keys, features in tqdm(pool.imap(_embed_batch, batches), desc="embedding"):
+                    writer.append(keys, features)
+        else:
+            for keys, features in tqdm(map(encoder.embed_texts, batches), desc="embedding"):
+                writer.append(keys, features)
+
+
+if __name__ == '__main__':
+    main()
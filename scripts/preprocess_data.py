@@ -1,7 +1,10 @@
 import argparse
+import itertools
 import json
+import multiprocessing
 import os
-from typing import List
+from collections import Counter
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
 
 import nltk
 import numpy as np
@@ -13,32 +16,253 @@ from sklearn.feature_extraction.text import CountVectorizer
 from spacy.tokenizer import Tokenizer
 from tqdm import tqdm
 
-from vampire.common.util import read_text, save_sparse, write_to_json
+from scripts.derive_vocabulary import FULL_VOCABULARY_DIR, TERM_COUNTS_FILE, derive_vocabulary
+from vampire.common.npmi import (compute_npmi_matrices, npmi_matrices_from_interactions, npmi_matrices_path,
+                                 save_npmi_matrices)
+from vampire.common.util import CSRWriter, read_text, save_matrix, write_to_json
 
 
-def load_data(data_path: str, tokenize: bool = False, tokenizer_type: str = "just_spaces") -> List[str]:
+def load_data(data_path: str, tokenize: bool = False, tokenizer_type: str = "just_spaces", workers: int = 1) -> List[str]:
+    return list(iter_data(data_path, tokenize, tokenizer_type, workers))
+
+def iter_data(data_path: str, tokenize: bool = False, tokenizer_type: str = "just_spaces", workers: int = 1) -> Iterator[str]:
+    if workers > 1:
+        yield from iter_data_parallel(data_path, tokenize, tokenizer_type, workers)
+        return
+    tokenizer = build_tokenizer(tokenizer_type)
+    with tqdm(open(data_path, "r"), desc=f"loading {data_path}") as f:
+        for line in f:
+            text = parse_line(line, data_path)
+            if tokenize:
+                text = tokenize_texts([text], tokenizer, tokenizer_type)[0]
+            yield text
+
+def build_tokenizer(tokenizer_type: str):
     if tokenizer_type == "just_spaces":
         tokenizer = SpacyWordSplitter()
     elif tokenizer_type == "spacy":
         nlp = spacy.load('en')
         tokenizer = Tokenizer(nlp.vocab)
-    tokenized_examples = []
-    with tqdm(open(data_path, "r"), desc=f"loading {data_path}") as f:
-        for line in f:
-            if data_path.endswith(".jsonl") or data_path.endswith(".json"):
-                example = json.loads(line)
-            else:
-                example = {"text": line}
-            if tokenize:
-                if tokenizer_type == 'just_spaces':
-                    tokens = list(map(str, tokenizer.split_words(example['text'])))
-                elif tokenizer_type == 'spacy':
-                    tokens = list(map(str, tokenizer(example['text'])))
-                text = ' '.join(tokens)
-            else:
-                text = example['text']
-            tokenized_examples.append(text)
-    return tokenized_examples
+    return tokenizer
+
+def parse_line(line: str, data_path: str) -> str:
+    if data_path.endswith(".jsonl") or data_path.endswith(".json"):
+        example = json.loads(line)
+    else:
+        example = {"text": line}
+    return example['text']
+
+def tokenize_texts(texts: List[str], tokenizer, tokenizer_type: str) -> List[str]:
+    if tokenizer_type == 'just_spaces':
+        if len(texts) == 1:
+            tokenized = [tokenizer.split_words(texts[0])]
+        else:
+            tokenized = tokenizer.batch_split_words(texts)
+    elif tokenizer_type == 'spacy':
+        tokenized = tokenizer.pipe(texts, batch_size=1000)
+    return [' '.join(map(str, tokens)) for tokens in tokenized]
+
+def shard_offsets(data_path: str, num_shards: int) -> List[Tuple[int, int]]:
+    """
+    Split 'data_path' into at most 'num_shards' (start, end) byte ranges, each starting
+    at the beginning of a line. A shard holds every line that starts inside its range.
+    """
+    size = os.path.getsize(data_path)
+    boundaries = [0]
+    with open(data_path, "rb") as f:
+        for shard in range(1, num_shards):
+            f.seek(size * shard // num_shards)
+            f.readline()
+            boundaries.append(max(f.tell(), boundaries[-1]))
+    boundaries.append(size)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start]
+
+_WORKER_TOKENIZER = None
+
+def _init_worker(tokenizer_type: str):
+    global _WORKER_TOKENIZER  # pylint: disable=global-statement
+    _WORKER_TOKENIZER = build_tokenizer(tokenizer_type)
+
+def _load_shard(shard: Tuple[str, int, int, bool, str]) -> List[str]:
+    data_path, start, end, tokenize, tokenizer_type = shard
+    texts = []
+    with open(data_path, "rb") as f:
+        f.seek(start)
+        while f.tell() < end:
+            texts.append(parse_line(f.readline().decode('utf-8'), data_path))
+    if tokenize:
+        texts = tokenize_texts(texts, _WORKER_TOKENIZER, tokenizer_type)
+    return texts
+
+def iter_data_parallel(data_path: str, tokenize: bool, tokenizer_type: str, workers: int,
+                       shard_size: int = 1 << 26) -> Iterator[str]:
+    """
+    Load and tokenize 'data_path' with a pool of 'workers' processes. The file is split
+    into shards of roughly 'shard_size' bytes, and shards are processed 'workers' at a
+    time so memory stays bounded. Output order matches the order of lines in the file.
+    """
+    num_shards = max(workers, -(-os.path.getsize(data_path) // shard_size))
+    shards = [(data_path, start, end, tokenize, tokenizer_type)
+              for start, end in shard_offsets(data_path, num_shards)]
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(tokenizer_type,)) as pool:
+        with tqdm(total=len(shards), desc=f"loading {data_path}") as progress:
+            for window in range(0, len(shards), workers):
+                for texts in pool.map(_load_shard, shards[window:window + workers]):
+                    yield from texts
+                    progress.update()
+
+def iter_chunks(iterable: Iterable[str], chunk_size: int) -> Iterator[List[str]]:
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def count_terms(texts: Iterable[str], analyzer, max_counter_size: int) -> Tuple[Counter, Counter]:
+    """
+    Count term and document frequencies in a single pass over 'texts'.
+
+    To bound memory, whenever the counters grow past 'max_counter_size' entries they are
+    pruned to their 'max_counter_size' // 2 most frequent terms. The counts are exact as
+    long as that never happens. Otherwise, a pruned term that appears again is counted from
+    zero, so its counts are short by whatever it had counted before each pruning, and a
+    term that is frequent overall but rare early on can miss the vocabulary.
+    """
+    term_counts: Counter = Counter()
+    doc_counts: Counter = Counter()
+    for text in texts:
+        tokens = analyzer(text)
+        term_counts.update(tokens)
+        doc_counts.update(set(tokens))
+        if len(term_counts) > max_counter_size:
+            term_counts = Counter(dict(term_counts.most_common(max_counter_size // 2)))
+            doc_counts = Counter({term: doc_counts[term] for term in term_counts})
+    return term_counts, doc_counts
+
+def streaming_preprocess(args, vocabulary_dir: str):
+    """
+    Preprocess the train, dev and reference data in memory that does not grow with the
+    number of documents. The first pass counts terms to pick the vocabulary, and the second
+    vectorizes fixed-size chunks and appends them to the output CSR matrices. The reference
+    corpus is written by 'streaming_save_reference'.
+    """
+    analyzer = CountVectorizer(stop_words='english', token_pattern=r'\b[^\d\W]{3,30}\b').build_analyzer()
+
+    print("counting terms...")
+    texts = itertools.chain(iter_data(args.train_path, args.tokenize, args.tokenizer_type, args.workers),
+                            iter_data(args.dev_path, args.tokenize, args.tokenizer_type, args.workers))
+    term_counts, doc_counts = count_terms(texts, analyzer, args.max_counter_size)
+    top_terms = sorted(term_counts, key=lambda term: (term_counts[term], doc_counts[term]), reverse=True)
+    if args.save_full_vocabulary:
+        # keep every counted term, in frequency order, and derive the top-k vocabulary afterwards
+        vocabulary = top_terms
+        output_dir = os.path.join(args.serialization_dir, FULL_VOCABULARY_DIR)
+        if not os.path.isdir(output_dir):
+            os.mkdir(output_dir)
+    else:
+        vocabulary = sorted(top_terms[:args.vocab_size])
+        output_dir = args.serialization_dir
+
+    count_vectorizer = CountVectorizer(stop_words='english', token_pattern=r'\b[^\d\W]{3,30}\b',
+                                       vocabulary=vocabulary)
+
+    # background frequency counts accumulate over both train and dev
+    num_cols = len(vocabulary) if args.save_full_vocabulary else len(vocabulary) + 1
+    word_counts = np.zeros(num_cols)
+    for split, data_path in (("train", args.train_path), ("dev", args.dev_path)):
+        output_path = os.path.join(output_dir, f"{split}.csr")
+        with CSRWriter(output_path, num_cols) as writer:
+            for chunk in iter_chunks(iter_data(data_path, args.tokenize, args.tokenizer_type, args.workers), args.chunk_size):
+                vectorized_chunk = count_vectorizer.transform(chunk)
+                if not args.save_full_vocabulary:
+                    # add @@unknown@@ token vector
+                    vectorized_chunk = sparse.hstack((np.zeros((len(chunk), 1), dtype=vectorized_chunk.dtype),
+                                                      vectorized_chunk))
+                writer.append(vectorized_chunk)
+                word_counts += np.asarray(vectorized_chunk.sum(0)).squeeze(0)
+
+    if args.save_full_vocabulary:
+        write_to_json([[term, int(count)] for term, count in zip(vocabulary, word_counts)],
+                      os.path.join(output_dir, TERM_COUNTS_FILE), indent=None)
+        derive_vocabulary(output_dir, args.vocab_size, args.serialization_dir)
+
+    if not args.reference_corpus_path:
+        print("fitting reference corpus using development data...")
+        load_reference = lambda: iter_data(args.dev_path, args.tokenize, args.tokenizer_type, args.workers)
+    else:
+        print(f"loading reference corpus at {args.reference_corpus_path}...")
+        load_reference = lambda: iter_data(args.reference_corpus_path, args.tokenize_reference,
+                                           args.reference_tokenizer_type, args.workers)
+    if not os.path.isdir(os.path.join(args.serialization_dir, "reference")):
+        os.mkdir(os.path.join(args.serialization_dir, "reference"))
+    streaming_save_reference(load_reference, args.serialization_dir, args.chunk_size)
+
+    if not args.save_full_vocabulary:
+        print("generating background frequency...")
+        bgfreq = dict(zip(vocabulary, word_counts / args.vocab_size))
+        write_to_json(bgfreq, os.path.join(args.serialization_dir, "vampire.bgfreq"))
+
+        write_list_to_file(['@@UNKNOWN@@'] + vocabulary, os.path.join(vocabulary_dir, "vampire.txt"))
+        write_list_to_file(['*tags', '*labels', 'vampire'], os.path.join(vocabulary_dir, "non_padded_namespaces.txt"))
+
+def save_reference(reference_matrix, reference_vocabulary: List[str], serialization_dir: str, output_format: str):
+    """
+    Save the reference corpus and its vocabulary, along with precomputed NPMI matrices
+    keyed by the hash of the reference files, which VAMPIRE loads instead of recomputing them.
+    """
+    reference_prefix = os.path.join(serialization_dir, "reference", "ref")
+    save_matrix(reference_matrix, reference_prefix, output_format)
+    write_to_json(reference_vocabulary, reference_prefix + ".vocab.json")
+    print("precomputing npmi matrices...")
+    npmi_path = npmi_matrices_path(f"{reference_prefix}.{output_format}", reference_prefix + ".vocab.json")
+    save_npmi_matrices(compute_npmi_matrices(reference_matrix), npmi_path)
+
+def streaming_save_reference(load_texts: Callable[[], Iterable[str]], serialization_dir: str, chunk_size: int):
+    """
+    Save the same reference files as 'save_reference' with 'csr' output, for the reference
+    corpus returned by each call of 'load_texts'. A first pass collects the vocabulary, and
+    a second vectorizes fixed-size chunks, appending them to the reference matrix and their
+    word co-occurrences to the NPMI interaction matrix. Only that (vocabulary x vocabulary)
+    matrix is held in memory; scripts/build_reference.py can also restrict the vocabulary
+    and spill it to disk.
+    """
+    analyzer = CountVectorizer(stop_words='english', token_pattern=r'\b[^\d\W]{3,30}\b').build_analyzer()
+    # CountVectorizer sorts the vocabulary it fits.
+    reference_vocabulary = sorted({term for text in load_texts() for term in analyzer(text)})
+    reference_vectorizer = CountVectorizer(stop_words='english', token_pattern=r'\b[^\d\W]{3,30}\b',
+                                           vocabulary=reference_vocabulary)
+    reference_prefix = os.path.join(serialization_dir, "reference", "ref")
+    interactions = sparse.csr_matrix((len(reference_vocabulary), len(reference_vocabulary)))
+    n_docs = 0
+    with CSRWriter(reference_prefix + ".csr", len(reference_vocabulary)) as writer:
+        for chunk in iter_chunks(load_texts(), chunk_size):
+            reference_chunk = reference_vectorizer.transform(chunk)
+            writer.append(reference_chunk)
+            doc_counts = (reference_chunk > 0).astype(float)
+            interactions = interactions + doc_counts.T.dot(doc_counts)
+            n_docs += reference_chunk.shape[0]
+    write_to_json(reference_vocabulary, reference_prefix + ".vocab.json")
+    print("precomputing npmi matrices...")
+    npmi_path = npmi_matrices_path(reference_prefix + ".csr", reference_prefix + ".vocab.json")
+    save_npmi_matrices(npmi_matrices_from_interactions(interactions, n_docs), npmi_path)
+
+def save_full_vocabulary(vectorized_examples: Dict[str, sparse.spmatrix], feature_names: List[str],
+                         full_dir: str, output_format: str):
+    """
+    Save the full-vocabulary matrices in 'vectorized_examples' with their columns sorted
+    by decreasing corpus frequency, together with the matching term-count table.
+    """
+    if not os.path.isdir(full_dir):
+        os.mkdir(full_dir)
+    counts = sum(np.asarray(matrix.sum(0)).squeeze(0) for matrix in vectorized_examples.values())
+    order = np.argsort(-counts, kind='stable')
+    for split, matrix in vectorized_examples.items():
+        save_matrix(matrix.tocsr()[:, order], os.path.join(full_dir, split), output_format)
+    write_to_json([[feature_names[index], int(counts[index])] for index in order],
+                  os.path.join(full_dir, TERM_COUNTS_FILE), indent=None)
 
 def main():
     parser = argparse.ArgumentParser(formatter_class = argparse.ArgumentDefaultsHelpFormatter)
@@ -60,8 +284,24 @@ def main():
                         help="Path to store the preprocessed corpus vocabulary (output file name).") 
     parser.add_argument("--reference-tokenizer-type", type=str, default="just_spaces",
                         help="Path to store the preprocessed corpus vocabulary (output file name).")
+    parser.add_argument("--output-format", type=str, choices=["npz", "csr"], default="npz",
+                        help="Format of the output matrices. 'csr' writes memory-mappable CSR files.")
+    parser.add_argument("--streaming", action='store_true',
+                        help="Preprocess in constant memory with two passes over the data. Requires --output-format csr.")
+    parser.add_argument("--chunk-size", type=int, default=10000,
+                        help="Number of documents vectorized at a time in streaming mode.")
+    parser.add_argument("--max-counter-size", type=int, default=5000000,
+                        help="Maximum number of distinct terms counted at once in streaming mode.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes used to load and tokenize the data.")
+    parser.add_argument("--save-full-vocabulary", action='store_true',
+                        help="Also save frequency-sorted full-vocabulary matrices, from which "
+                             "scripts/derive_vocabulary.py can derive any smaller vocabulary.")
     args = parser.parse_args()
 
+    if args.streaming and args.output_format != "csr":
+        parser.error("--streaming requires --output-format csr")
+
     if not os.path.isdir(args.serialization_dir):
         os.mkdir(args.serialization_dir)
     
@@ -70,19 +310,51 @@ def main():
     if not os.path.isdir(vocabulary_dir):
         os.mkdir(vocabulary_dir)
 
-    tokenized_train_examples = load_data(args.train_path, args.tokenize, args.tokenizer_type)
-    tokenized_dev_examples = load_data(args.dev_path, args.tokenize, args.tokenizer_type)
+    if args.streaming:
+        streaming_preprocess(args, vocabulary_dir)
+        return
 
-    print("fitting count vectorizer...")
+    tokenized_train_examples = load_data(args.train_path, args.tokenize, args.tokenizer_type, args.workers)
+    tokenized_dev_examples = load_data(args.dev_path, args.tokenize, args.tokenizer_type, args.workers)
 
-    count_vectorizer = CountVectorizer(stop_words='english', max_features=args.vocab_size, token_pattern=r'\b[^\d\W]{3,30}\b')
-    
-    text = tokenized_train_examples + tokenized_dev_examples
-    
-    count_vectorizer.fit(tqdm(text))
+    if args.save_full_vocabulary:
+        print("fitting full vocabulary count vectorizer...")
+        full_vectorizer = CountVectorizer(stop_words='english', token_pattern=r'\b[^\d\W]{3,30}\b')
+        full_vectorizer.fit(tqdm(tokenized_train_examples + tokenized_dev_examples))
+        full_dir = os.path.join(args.serialization_dir, FULL_VOCABULARY_DIR)
+        save_full_vocabulary({"train": full_vectorizer.transform(tqdm(tokenized_train_examples)),
+                              "dev": full_vectorizer.transform(tqdm(tokenized_dev_examples))},
+                             full_vectorizer.get_feature_names(), full_dir, args.output_format)
+        print(f"deriving vocabulary of size {args.vocab_size}...")
+        derive_vocabulary(full_dir, args.vocab_size, args.serialization_dir)
+    else:
+        print("fitting count vectorizer...")
+
+        count_vectorizer = CountVectorizer(stop_words='english', max_features=args.vocab_size, token_pattern=r'\b[^\d\W]{3,30}\b')
+
+        text = tokenized_train_examples + tokenized_dev_examples
 
-    vectorized_train_examples = count_vectorizer.transform(tqdm(tokenized_train_examples))
-    vectorized_dev_examples = count_vectorizer.transform(tqdm(tokenized_dev_examples))
+        count_vectorizer.fit(tqdm(text))
+
+        vectorized_train_examples = count_vectorizer.transform(tqdm(tokenized_train_examples))
+        vectorized_dev_examples = count_vectorizer.transform(tqdm(tokenized_dev_examples))
+
+        # add @@unknown@@ token vector
+        vectorized_train_examples = sparse.hstack((np.array([0] * len(tokenized_train_examples))[:,None], vectorized_train_examples))
+        vectorized_dev_examples = sparse.hstack((np.array([0] * len(tokenized_dev_examples))[:,None], vectorized_dev_examples))
+        master = sparse.vstack([vectorized_train_examples, vectorized_dev_examples])
+
+        # generate background frequency
+        print("generating background frequency...")
+        bgfreq = dict(zip(count_vectorizer.get_feature_names(), (np.array(master.sum(0)) / args.vocab_size).squeeze()))
+
+        print("saving data...")
+        save_matrix(vectorized_train_examples, os.path.join(args.serialization_dir, "train"), args.output_format)
+        save_matrix(vectorized_dev_examples, os.path.join(args.serialization_dir, "dev"), args.output_format)
+        write_to_json(bgfreq, os.path.join(args.serialization_dir, "vampire.bgfreq"))
+
+        write_list_to_file(['@@UNKNOWN@@'] + count_vectorizer.get_feature_names(), os.path.join(vocabulary_dir, "vampire.txt"))
+        write_list_to_file(['*tags', '*labels', 'vampire'], os.path.join(vocabulary_dir, "non_padded_namespaces.txt"))
 
     reference_vectorizer = CountVectorizer(stop_words='english', token_pattern=r'\b[^\d\W]{3,30}\b')
     if not args.reference_corpus_path:
@@ -90,32 +362,15 @@ def main():
         reference_matrix = reference_vectorizer.fit_transform(tqdm(tokenized_dev_examples))
     else:
         print(f"loading reference corpus at {args.reference_corpus_path}...")
-        reference_examples = load_data(args.reference_corpus_path, args.tokenize_reference, args.reference_tokenizer_type)
+        reference_examples = load_data(args.reference_corpus_path, args.tokenize_reference, args.reference_tokenizer_type, args.workers)
         print("fitting reference corpus...")
         reference_matrix = reference_vectorizer.fit_transform(tqdm(reference_examples))
 
     reference_vocabulary = reference_vectorizer.get_feature_names()
 
-    # add @@unknown@@ token vector
-    vectorized_train_examples = sparse.hstack((np.array([0] * len(tokenized_train_examples))[:,None], vectorized_train_examples))
-    vectorized_dev_examples = sparse.hstack((np.array([0] * len(tokenized_dev_examples))[:,None], vectorized_dev_examples))
-    master = sparse.vstack([vectorized_train_examples, vectorized_dev_examples])
-
-    # generate background frequency
-    print("generating background frequency...")
-    bgfreq = dict(zip(count_vectorizer.get_feature_names(), (np.array(master.sum(0)) / args.vocab_size).squeeze()))
-
-    print("saving data...")
-    save_sparse(vectorized_train_examples, os.path.join(args.serialization_dir, "train.npz"))
-    save_sparse(vectorized_dev_examples, os.path.join(args.serialization_dir, "dev.npz"))
     if not os.path.isdir(os.path.join(args.serialization_dir, "reference")):
         os.mkdir(os.path.join(args.serialization_dir, "reference"))
-    save_sparse(reference_matrix, os.path.join(args.serialization_dir, "reference", "ref.npz"))
-    write_to_json(reference_vocabulary, os.path.join(args.serialization_dir, "reference", "ref.vocab.json"))
-    write_to_json(bgfreq, os.path.join(args.serialization_dir, "vampire.bgfreq"))
-    
-    write_list_to_file(['@@UNKNOWN@@'] + count_vectorizer.get_feature_names(), os.path.join(vocabulary_dir, "vampire.txt"))
-    write_list_to_file(['*tags', '*labels', 'vampire'], os.path.join(vocabulary_dir, "non_padded_namespaces.txt"))
+    save_reference(reference_matrix, reference_vocabulary, args.serialization_dir, args.output_format)
 
 def write_list_to_file(ls, save_path):
     """
@@ -0,0 +1,134 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+from typing import Dict, List
+
+import numpy as np
+import torch
+
+from scripts.embed import DocumentEncoder
+from vampire.common.embedding_service import EmbeddingService, MicroBatcher
+
+
+def build_encode_function(encoder: DocumentEncoder):
+    """
+    Encode texts into the scalar-mixed VAMPIRE representation (``vector``) and ``theta``.
+    """
+    scalar_mix = encoder.scalar_mix.numpy()
+
+    def encode(texts: List[str]) -> Dict[str, np.ndarray]:
+        # Shape: (batch_size, num_layers, dim), as the encoder keeps every layer.
+        activations = encoder.encode(encoder.pad_token_ids([encoder.token_ids(text) for text in texts]))
+        return {"vector": np.einsum('l,bld->bd', scalar_mix, activations),
+                "theta": activations[:, -1]}
+    return encode
+
+
+def bind_socket(host: str, port: int, unix_socket: str = None) -> socket.socket:
+    """
+    A listening socket, for the worker processes to accept connections on.
+    """
+    if unix_socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(unix_socket)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+    sock.listen(socket.SOMAXCONN)
+    sock.setblocking(False)
+    return sock
+
+
+def serve(encoder: DocumentEncoder, args, sock: socket.socket = None) -> None:
+    batcher = MicroBatcher(build_encode_function(encoder),
+                           max_batch_size=args.max_batch_size,
+                           max_latency=args.max_latency_ms / 1000)
+    service = EmbeddingService(batcher, ["vector", "theta"])
+    # A forked worker must not reuse the event loop of its parent.
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(service.start(args.host, args.port, args.unix_socket, sock))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(service.stop())
+
+
+def _serve_worker(encoder: DocumentEncoder, args, sock: socket.socket) -> None:
+    # Split the cores between the workers, unless told otherwise.
+    torch.set_num_threads(args.threads or max(1, (os.cpu_count() or 1) // args.workers))
+    serve(encoder, args, sock)
+
+
+def serve_workers(encoder: DocumentEncoder, args) -> None:
+    """
+    Fork ``args.workers`` processes serving on one socket. The model is loaded once by
+    the parent, and its weights (with the embedding table of its first layer) are moved to
+    shared memory before forking, so the workers start immediately and share them instead
+    of each holding a copy.
+    """
+    sock = bind_socket(args.host, args.port, args.unix_socket)
+    encoder.model.share_memory()
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=_serve_worker, args=(encoder, args, sock), daemon=True)
+               for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.join()
+    finally:
+        sock.close()
+        if args.unix_socket and os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--model-archive", type=str, required=True,
+                        help="Path to the pretrained VAMPIRE model.tar.gz.")
+    parser.add_argument("--host", type=str, default="127.0.0.1",
+                        help="Host to listen on.")
+    parser.add_argument("--port", type=int, default=8000,
+                        help="Port to listen on.")
+    parser.add_argument("--unix-socket", type=str, required=False,
+                        help="Listen on this unix socket instead of --host and --port.")
+    parser.add_argument("--scalar-mix", type=float, nargs="+", required=False,
+                        help="Scalar mix parameters of the 'vector' output. Defaults to the "
+                             "initial mix of the vampire token embedder.")
+    parser.add_argument("--tokenizer-type", type=str, choices=["just_spaces", "spacy"], default="just_spaces",
+                        help="Tokenizer applied to the texts.")
+    parser.add_argument("--max-sequence-length", type=int, default=400,
+                        help="Number of tokens a text is truncated to.")
+    parser.add_argument("--max-batch-size", type=int, default=64,
+                        help="Number of documents encoded at a time.")
+    parser.add_argument("--max-latency-ms", type=float, default=5.0,
+                        help="How long a request can wait for a batch to fill up.")
+    parser.add_argument("--threads", type=int, required=False,
+                        help="Number of threads torch encodes a batch with, in every worker.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes, forked after loading the model once. "
+                             "Every worker batches its own requests.")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    encoder = DocumentEncoder(args.model_archive, "all", args.scalar_mix,
+                              args.tokenizer_type, args.max_sequence_length)
+    print(f"serving VAMPIRE embeddings on {args.unix_socket or f'{args.host}:{args.port}'}")
+    if args.workers > 1:
+        serve_workers(encoder, args)
+    else:
+        serve(encoder, args)
+
+
+if __name__ == '__main__':
+    main()
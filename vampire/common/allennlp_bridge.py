@@ -1,21 +1,150 @@
 import codecs
+import hashlib
+import json
 import logging
 import os
-from typing import Iterable
+import shutil
+import tarfile
+import tempfile
+from collections.abc import MutableMapping
+from typing import Dict, Iterable, Iterator, List
 
-from allennlp.common.file_utils import cached_path
+from allennlp.common.file_utils import CACHE_DIRECTORY, cached_path
 from allennlp.common.params import Params
 from allennlp.common.util import namespace_match
 from allennlp.data import instance as adi  # pylint: disable=unused-import
 from allennlp.data.vocabulary import Vocabulary
+from allennlp.models.archival import CONFIG_NAME, _WEIGHTS_NAME, Archive, load_archive
+import numpy as np
 from overrides import overrides
 
+from vampire.common.util import pickle_data, unpickle_data
+
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 DEFAULT_NON_PADDED_NAMESPACES = ("*tags", "*labels")
 DEFAULT_PADDING_TOKEN = "@@PADDING@@"
 DEFAULT_OOV_TOKEN = "@@UNKNOWN@@"
 NAMESPACE_PADDING_FILE = 'non_padded_namespaces.txt'
+BINARY_VOCABULARY_MAGIC = b"VAMPVOC1"
+
+
+def binary_vocabulary_path(directory: str, namespace: str) -> str:
+    # Hidden, so that loaders of the text format skip it.
+    return os.path.join(directory, f".{namespace}.vbin")
+
+
+def save_binary_namespace(tokens: List[str], filename: str) -> None:
+    """
+    Write the tokens of a namespace, in index order, as a binary vocabulary file: a magic
+    string, the number of tokens, the ``int64`` byte offsets of the tokens, and the tokens
+    as newline-terminated UTF-8, with newlines in tokens written as ``@@NEWLINE@@``.
+    """
+    encoded = [token.replace('\n', '@@NEWLINE@@').encode('utf-8') + b'\n' for token in tokens]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(token) for token in encoded], out=offsets[1:])
+    temporary_file = f"{filename}.{os.getpid()}"
+    with open(temporary_file, 'wb') as output_file:
+        output_file.write(BINARY_VOCABULARY_MAGIC)
+        output_file.write(np.int64(len(encoded)).tobytes())
+        output_file.write(offsets.tobytes())
+        output_file.write(b"".join(encoded))
+    os.replace(temporary_file, filename)
+
+
+class BinaryNamespace:
+    """
+    A memory-mapped binary vocabulary file written by ``save_binary_namespace``.
+    """
+    def __init__(self, filename: str) -> None:
+        data = np.memmap(filename, dtype=np.uint8, mode='r')
+        header_size = len(BINARY_VOCABULARY_MAGIC) + 8
+        if bytes(data[:len(BINARY_VOCABULARY_MAGIC)]) != BINARY_VOCABULARY_MAGIC:
+            raise ValueError(f"{filename} is not a binary vocabulary file")
+        num_tokens = int(data[len(BINARY_VOCABULARY_MAGIC):header_size].view(np.int64)[0])
+        self.offsets = data[header_size:header_size + 8 * (num_tokens + 1)].view(np.int64)
+        self.blob = data[header_size + 8 * (num_tokens + 1):]
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def token(self, index: int) -> str:
+        token = bytes(self.blob[self.offsets[index]:self.offsets[index + 1] - 1]).decode('utf-8')
+        return token.replace('@@NEWLINE@@', '\n')
+
+    def tokens(self) -> List[str]:
+        text = bytes(self.blob).decode('utf-8')
+        tokens = text.split('\n')[:-1]
+        if '@@NEWLINE@@' in text:
+            tokens = [token.replace('@@NEWLINE@@', '\n') for token in tokens]
+        return tokens
+
+
+class LazyTokenToIndex(MutableMapping):
+    """
+    The token to index mapping of a namespace loaded from a ``BinaryNamespace``. Its size
+    is known without decoding the file, and the tokens are only decoded, all at once, the
+    first time the mapping is looked up by token or modified.
+    """
+    def __init__(self, namespace: BinaryNamespace) -> None:
+        self._namespace = namespace
+        self._token_to_index = None
+
+    def _mapping(self) -> Dict[str, int]:
+        if self._token_to_index is None:
+            tokens = self._namespace.tokens()
+            self._token_to_index = dict(zip(tokens, range(len(tokens))))
+        return self._token_to_index
+
+    def __getitem__(self, token: str) -> int:
+        return self._mapping()[token]
+
+    def __setitem__(self, token: str, index: int) -> None:
+        self._mapping()[token] = index
+
+    def __delitem__(self, token: str) -> None:
+        del self._mapping()[token]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._mapping())
+
+    def __len__(self) -> int:
+        if self._token_to_index is None:
+            return len(self._namespace)
+        return len(self._token_to_index)
+
+
+class LazyIndexToToken(MutableMapping):
+    """
+    The index to token mapping of a namespace loaded from a ``BinaryNamespace``, which
+    only decodes the tokens that are looked up. Tokens added afterwards are kept in a dict.
+    """
+    def __init__(self, namespace: BinaryNamespace) -> None:
+        self._namespace = namespace
+        self._added = {}
+
+    def _in_file(self, index) -> bool:
+        return isinstance(index, (int, np.integer)) and 0 <= index < len(self._namespace)
+
+    def __getitem__(self, index) -> str:
+        if index in self._added:
+            return self._added[index]
+        if self._in_file(index):
+            return self._namespace.token(index)
+        raise KeyError(index)
+
+    def __setitem__(self, index, token: str) -> None:
+        self._added[index] = token
+
+    def __delitem__(self, index) -> None:
+        raise TypeError("tokens cannot be removed from a vocabulary namespace")
+
+    def __iter__(self) -> Iterator[int]:
+        yield from range(len(self._namespace))
+        yield from (index for index in self._added if not self._in_file(index))
+
+    def __len__(self) -> int:
+        return len(self._namespace) + sum(1 for index in self._added if not self._in_file(index))
 
 
 @Vocabulary.register("extended_vocabulary")
@@ -53,10 +182,43 @@ class ExtendedVocabulary(Vocabulary):
             else:
                 is_padded = True
             filename = os.path.join(directory, namespace_filename)
-            vocab.set_from_file(filename, is_padded, namespace=namespace)
+            # Only use the binary file written by save_to_files if neither the tokens nor the
+            # padded namespaces have changed since.
+            binary_filename = binary_vocabulary_path(directory, namespace)
+            sources = [filename, os.path.join(directory, NAMESPACE_PADDING_FILE)]
+            if not vocab.set_from_binary_file(binary_filename, is_padded, namespace, sources):
+                vocab.set_from_file(filename, is_padded, namespace=namespace)
 
         return vocab
 
+    def set_from_binary_file(self,
+                             filename: str,
+                             is_padded: bool = True,
+                             namespace: str = "tokens",
+                             sources: List[str] = ()) -> bool:
+        """
+        Set the tokens of ``namespace`` from a binary vocabulary file, which holds every
+        token of the namespace (including padding) in index order. The tokens are decoded
+        from the file as they are looked up by index, and all at once on the first lookup by
+        token. Returns ``False``, leaving the namespace unset, if the file does not exist,
+        is older than any of the ``sources`` it was written from, or does not match
+        ``is_padded``.
+        """
+        if not os.path.exists(filename):
+            return False
+        if any(os.path.getmtime(filename) < os.path.getmtime(source) for source in sources):
+            return False
+        binary_namespace = BinaryNamespace(filename)
+        if (len(binary_namespace) > 0 and binary_namespace.token(0) == self._padding_token) != is_padded:
+            return False
+        self._token_to_index[namespace] = LazyTokenToIndex(binary_namespace)
+        self._index_to_token[namespace] = LazyIndexToToken(binary_namespace)
+        return True
+
+    def save_to_binary_file(self, namespace: str, filename: str) -> None:
+        mapping = self._index_to_token[namespace]
+        save_binary_namespace([mapping[index] for index in range(len(mapping))], filename)
+
     @overrides
     def save_to_files(self, directory: str) -> None:
         """
@@ -83,24 +245,135 @@ class ExtendedVocabulary(Vocabulary):
                 start_index = 1 if mapping[0] == self._padding_token else 0
                 for i in range(start_index, num_tokens):
                     print(mapping[i].replace('\n', '@@NEWLINE@@'), file=token_file)
+            self.save_to_binary_file(namespace, binary_vocabulary_path(directory, namespace))
 
 @Vocabulary.register("vocabulary_with_vampire")
-class VocabularyWithPretrainedVAE(Vocabulary):
+class VocabularyWithPretrainedVAE(ExtendedVocabulary):
     """
     Augment the allennlp Vocabulary with filtered vocabulary
     Idea: override from_params to "set" the vocab from a file before
     constructing in a normal fashion.
+
+    If ``cache_directory`` is given, the vocabulary is pickled there, under a hash of the
+    contents of the ``vampire_vocab_file`` and of the ``dataset_paths`` it is built from,
+    and of ``cache_key``, which should describe anything else the instances depend on
+    (e.g. the dataset reader's configuration). Later runs with the same hash load the
+    vocabulary instead of building it from the instances, which are then not read.
     """
 
     @classmethod
     def from_params(cls, params: Params, instances: Iterable['adi.Instance'] = None):
-        vampire_vocab_file = params.pop('vampire_vocab_file')
+        vampire_vocab_file = cached_path(params.pop('vampire_vocab_file'))
+        cache_directory = params.pop('cache_directory', None)
+        cache_key = params.pop('cache_key', "")
+        dataset_paths = params.pop('dataset_paths', [])
+        cache_file = None
+        if cache_directory:
+            key = [cls.__name__, cache_key, _file_sha1(vampire_vocab_file)]
+            key.extend(_file_sha1(cached_path(path)) for path in dataset_paths)
+            cache_file = os.path.join(cache_directory,
+                                      hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest() + ".pkl")
+            if os.path.exists(cache_file):
+                logger.info("Loading cached vocabulary from %s.", cache_file)
+                return unpickle_data(cache_file)
+
         vocab = cls()
         vocab = vocab.from_instances(instances=instances,
                                      tokens_to_add={"classifier": ["@@UNKNOWN@@"]})
-        vampire_vocab_file = cached_path(vampire_vocab_file)
-        vocab.set_from_file(filename=vampire_vocab_file,
-                            namespace="vampire",
-                            oov_token="@@UNKNOWN@@",
-                            is_padded=False)
+        # The vocabulary directory of a pretrained VAMPIRE has a binary copy of the namespace.
+        binary_filename = binary_vocabulary_path(os.path.dirname(vampire_vocab_file), "vampire")
+        if not (os.path.basename(vampire_vocab_file) == "vampire.txt"
+                and vocab.set_from_binary_file(binary_filename, False, "vampire", [vampire_vocab_file])):
+            vocab.set_from_file(filename=vampire_vocab_file,
+                                namespace="vampire",
+                                oov_token="@@UNKNOWN@@",
+                                is_padded=False)
+
+        if cache_file is not None:
+            os.makedirs(cache_directory, exist_ok=True)
+            # Concurrent trials may build the same vocabulary, so never expose a partial file.
+            temporary_file = f"{cache_file}.{os.getpid()}"
+            pickle_data(vocab, temporary_file)
+            os.replace(temporary_file, cache_file)
         return vocab
+
+
+def _file_sha1(*filenames: str) -> str:
+    sha1 = hashlib.sha1()
+    for filename in filenames:
+        with open(filename, "rb") as input_file:
+            for block in iter(lambda: input_file.read(1 << 20), b""):  # pylint: disable=cell-var-from-loop
+                sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _recorded_file_sha1(filename: str, cache_directory: str) -> str:
+    """
+    ``_file_sha1`` of ``filename``, recorded in ``cache_directory`` along with the path,
+    size and modification time of the file, so that it is only hashed again once one of
+    them changes.
+    """
+    filename = os.path.realpath(filename)
+    stat = os.stat(filename)
+    signature = [filename, stat.st_size, stat.st_mtime_ns]
+    record_file = os.path.join(cache_directory, "hashes", hashlib.sha1(filename.encode("utf-8")).hexdigest() + ".json")
+    try:
+        with open(record_file) as input_file:
+            record = json.load(input_file)
+        if record["signature"] == signature:
+            return record["sha1"]
+    except (OSError, ValueError, KeyError):
+        pass
+    sha1 = _file_sha1(filename)
+    os.makedirs(os.path.dirname(record_file), exist_ok=True)
+    temporary_file = f"{record_file}.{os.getpid()}"
+    with open(temporary_file, "w") as output_file:
+        json.dump({"signature": signature, "sha1": sha1}, output_file)
+    os.replace(temporary_file, record_file)
+    return sha1
+
+
+def archive_hash(archive_file: str, cache_directory: str = None) -> str:
+    """
+    A hash of the contents of a model archive, or of the config and weights of an
+    extracted one. Hashes are recorded under ``cache_directory`` (by default, the
+    allennlp cache), and only recomputed once a file is modified.
+    """
+    resolved_archive_file = cached_path(archive_file)
+    cache_directory = cache_directory or os.path.join(CACHE_DIRECTORY, "archives")
+    if os.path.isdir(resolved_archive_file):
+        hashes = [_recorded_file_sha1(os.path.join(resolved_archive_file, filename), cache_directory)
+                  for filename in (CONFIG_NAME, _WEIGHTS_NAME)]
+        return hashlib.sha1("".join(hashes).encode("utf-8")).hexdigest()
+    return _recorded_file_sha1(resolved_archive_file, cache_directory)
+
+
+def load_cached_archive(archive_file: str,
+                        cuda_device: int = -1,
+                        overrides: str = "",
+                        cache_directory: str = None) -> Archive:
+    """
+    ``load_archive``, but the archive is only extracted the first time it is loaded, to a
+    directory under ``cache_directory`` (by default, the allennlp cache) named after the hash
+    of its contents. Later loads of the same archive read the extracted directory directly,
+    and only hash the archive again if it was modified (see ``archive_hash``).
+    """
+    resolved_archive_file = cached_path(archive_file)
+    if os.path.isdir(resolved_archive_file):
+        return load_archive(resolved_archive_file, cuda_device=cuda_device, overrides=overrides)
+    cache_directory = cache_directory or os.path.join(CACHE_DIRECTORY, "archives")
+    serialization_dir = os.path.join(cache_directory, archive_hash(resolved_archive_file, cache_directory))
+    if not os.path.isdir(serialization_dir):
+        logger.info("extracting archive file %s to %s", resolved_archive_file, serialization_dir)
+        os.makedirs(cache_directory, exist_ok=True)
+        # Extract next to the final directory and move it into place, so that concurrent
+        # loads never see a partial extraction.
+        tempdir = tempfile.mkdtemp(dir=cache_directory)
+        with tarfile.open(resolved_archive_file, 'r:gz') as archive:
+            archive.extractall(tempdir)
+        try:
+            os.rename(tempdir, serialization_dir)
+        except OSError:
+            # Another process extracted it first.
+            shutil.rmtree(tempdir)
+    return load_archive(serialization_dir, cuda_device=cuda_device, overrides=overrides)
@@ -0,0 +1,254 @@
+import asyncio
+import bisect
+import collections
+import json
+import logging
+import socket
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Maps a batch of texts to named outputs (e.g. the mixed representation and theta),
+# each an array with one row per text.
+EncodeFunction = Callable[[List[str]], Dict[str, np.ndarray]]
+
+_PendingRequest = collections.namedtuple("_PendingRequest", ["texts", "future", "arrival"])
+
+
+class Histogram:
+    """
+    Counts observations in buckets with the given inclusive upper bounds, and one last
+    bucket for observations above all of them.
+    """
+    def __init__(self, bounds: List[float]) -> None:
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_json(self) -> Dict[str, Any]:
+        return {"bounds": self.bounds, "counts": self.counts, "count": self.count, "sum": self.sum}
+
+
+class MicroBatcher:
+    """
+    Collects the documents of concurrent requests into micro-batches, and encodes one
+    micro-batch at a time in a worker thread, so that the event loop keeps accepting requests.
+
+    A micro-batch is encoded once it holds ``max_batch_size`` documents, or ``max_latency``
+    seconds after its oldest request arrived. Requests that arrive while a micro-batch is
+    being encoded form the next one. Requests are never split, so a request with more than
+    ``max_batch_size`` documents is encoded on its own.
+
+    Parameters
+    ----------
+    encode : ``EncodeFunction``
+        Encodes a list of texts into named outputs with one row per text.
+    max_batch_size : ``int``, optional (default=64)
+        The number of documents in a micro-batch.
+    max_latency : ``float``, optional (default=0.005)
+        How long, in seconds, a request can wait for a micro-batch to fill up.
+    """
+    def __init__(self,
+                 encode: EncodeFunction,
+                 max_batch_size: int = 64,
+                 max_latency: float = 0.005) -> None:
+        self._encode = encode
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self._pending: collections.deque = collections.deque()
+        self._pending_documents = 0
+        self._arrived = None
+        self._worker = None
+        powers = [2 ** power for power in range(int(np.log2(max(1, max_batch_size))) + 3)]
+        # Documents waiting when a micro-batch is formed, up to four micro-batches' worth.
+        self.queue_depth = Histogram([0] + powers)
+        self.batch_size = Histogram(powers[:-2])
+        self.num_requests = 0
+        self.num_documents = 0
+
+    def start(self) -> None:
+        """
+        Start encoding micro-batches, on the running event loop.
+        """
+        self._arrived = asyncio.Event()
+        self._worker = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+
+    async def embed(self, texts: List[str]) -> Dict[str, np.ndarray]:
+        """
+        The outputs of ``encode`` for ``texts``, computed in a micro-batch.
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending.append(_PendingRequest(texts, future, loop.time()))
+        self._pending_documents += len(texts)
+        self._arrived.set()
+        return await future
+
+    def _next_batch(self) -> List[_PendingRequest]:
+        batch = [self._pending.popleft()]
+        size = len(batch[0].texts)
+        while self._pending and size + len(self._pending[0].texts) <= self.max_batch_size:
+            batch.append(self._pending.popleft())
+            size += len(batch[-1].texts)
+        self._pending_documents -= size
+        return batch
+
+    async def _run(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            while not self._pending:
+                self._arrived.clear()
+                await self._arrived.wait()
+            deadline = self._pending[0].arrival + self.max_latency
+            while self._pending_documents < self.max_batch_size and loop.time() < deadline:
+                self._arrived.clear()
+                try:
+                    await asyncio.wait_for(self._arrived.wait(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+            self.queue_depth.observe(self._pending_documents)
+            batch = self._next_batch()
+            texts = [text for request in batch for text in request.texts]
+            self.batch_size.observe(len(texts))
+            self.num_requests += len(batch)
+            self.num_documents += len(texts)
+            try:
+                outputs = await loop.run_in_executor(None, self._encode, texts)
+            except Exception as error:  # pylint: disable=broad-except
+                logger.exception("failed to encode a batch of %d documents", len(texts))
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(error)
+                continue
+            start = 0
+            for request in batch:
+                end = start + len(request.texts)
+                # The client may have disconnected, cancelling its request.
+                if not request.future.done():
+                    request.future.set_result({name: output[start:end] for name, output in outputs.items()})
+                start = end
+
+    def metrics(self) -> Dict[str, Any]:
+        return {"requests": self.num_requests,
+                "documents": self.num_documents,
+                "pending_documents": self._pending_documents,
+                "queue_depth": self.queue_depth.to_json(),
+                "batch_size": self.batch_size.to_json()}
+
+
+class EmbeddingService:
+    """
+    A minimal HTTP/1.1 server over a ``MicroBatcher``, with two endpoints:
+
+    * ``POST /embed`` with a JSON body ``{"texts": [...], "output": ...}`` responds with
+      ``{"embeddings": [...]}``, one embedding per text. ``output`` names one of the outputs
+      of the encoder, and defaults to the first of ``outputs``.
+    * ``GET /metrics`` responds with the batcher's request counts and its histograms of
+      queue depth and batch size.
+
+    Parameters
+    ----------
+    batcher : ``MicroBatcher``
+        The batcher that encodes the documents.
+    outputs : ``List[str]``
+        The names of the outputs of the batcher's encoder that can be requested.
+    """
+    def __init__(self, batcher: MicroBatcher, outputs: List[str]) -> None:
+        self.batcher = batcher
+        self.outputs = outputs
+        self._server = None
+
+    async def start(self,
+                    host: str = None,
+                    port: int = None,
+                    unix_socket: str = None,
+                    sock: socket.socket = None) -> None:
+        """
+        Listen on ``host`` and ``port``, on ``unix_socket`` if it is given, or on the bound
+        socket ``sock`` (e.g. one shared by pre-forked worker processes).
+        """
+        self.batcher.start()
+        if sock is not None and sock.family == getattr(socket, "AF_UNIX", None):
+            self._server = await asyncio.start_unix_server(self._handle_connection, sock=sock)
+        elif sock is not None:
+            self._server = await asyncio.start_server(self._handle_connection, sock=sock)
+        elif unix_socket:
+            self._server = await asyncio.start_unix_server(self._handle_connection, path=unix_socket)
+        else:
+            self._server = await asyncio.start_server(self._handle_connection, host, port)
+
+    @property
+    def sockets(self):
+        return self._server.sockets
+
+    async def stop(self) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+        await self.batcher.stop()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            # Connections are kept alive until the client closes them.
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, response = await self._respond(method, path, body)
+                payload = json.dumps(response).encode("utf-8")
+                writer.write(f"HTTP/1.1 {status}\r\n"
+                             "Content-Type: application/json\r\n"
+                             f"Content-Length: {len(payload)}\r\n\r\n".encode("latin-1") + payload)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, method: str, path: str, body: bytes) -> Tuple[str, Dict[str, Any]]:
+        if path == "/metrics" and method == "GET":
+            return "200 OK", self.batcher.metrics()
+        if path != "/embed" or method != "POST":
+            return "404 Not Found", {"error": f"no endpoint {method} {path}"}
+        try:
+            request = json.loads(body.decode("utf-8"))
+            texts = request["texts"]
+            output = request.get("output", self.outputs[0])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return "400 Bad Request", {"error": 'expected a JSON object with a "texts" list'}
+        if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+            return "400 Bad Request", {"error": '"texts" must be a list of strings'}
+        if output not in self.outputs:
+            return "400 Bad Request", {"error": f'"output" must be one of {self.outputs}'}
+        if not texts:
+            return "200 OK", {"embeddings": []}
+        try:
+            outputs = await self.batcher.embed(texts)
+        except Exception as error:  # pylint: disable=broad-except
+            return "500 Internal Server Error", {"error": str(error)}
+        return "200 OK", {"embeddings": outputs[output].tolist()}
@@ -0,0 +1,113 @@
+import json
+import os
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+FEATURES_FILE = "features.bin"
+KEYS_FILE = "keys.npy"
+ROWS_FILE = "rows.npy"
+METADATA_FILE = "metadata.json"
+
+
+class FeatureStoreWriter:
+    """
+    Write precomputed per-document features to a directory that ``FeatureStore`` can
+    memory-map. Features are appended in batches along with the ``document_hash`` of
+    every document, which is what they are looked up by.
+
+    Parameters
+    ----------
+    directory : ``str``
+        The directory to write the store to.
+    max_documents : ``int``
+        An upper bound on the number of documents that will be appended.
+    feature_shape : ``Tuple[int, ...]``
+        The shape of the features of one document.
+    dtype : ``str``
+        The dtype the features are stored as, e.g. ``float16`` or ``float32``.
+    metadata : ``Dict[str, Any]``, optional
+        Anything else to record in the store's metadata.
+    """
+    def __init__(self,
+                 directory: str,
+                 max_documents: int,
+                 feature_shape: Tuple[int, ...],
+                 dtype: str = "float32",
+                 metadata: Dict[str, Any] = None) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.feature_shape = tuple(feature_shape)
+        self.dtype = np.dtype(dtype)
+        self.metadata = metadata or {}
+        self.num_documents = 0
+        self._keys: List[str] = []
+        self._features = np.memmap(os.path.join(directory, FEATURES_FILE), dtype=self.dtype, mode="w+",
+                                   shape=(max(1, max_documents),) + self.feature_shape)
+
+    def append(self, keys: List[str], features: np.ndarray) -> None:
+        end = self.num_documents + len(keys)
+        self._features[self.num_documents:end] = features
+        self._keys.extend(keys)
+        self.num_documents = end
+
+    def close(self) -> None:
+        self._features.flush()
+        del self._features
+        # Drop the space reserved for documents that were never appended.
+        row_bytes = int(np.prod(self.feature_shape)) * self.dtype.itemsize
+        os.truncate(os.path.join(self.directory, FEATURES_FILE), self.num_documents * row_bytes)
+        # The index is sorted for binary search. Duplicate documents point to their first row.
+        keys, rows = np.unique(np.array(self._keys, dtype="S40"), return_index=True)
+        np.save(os.path.join(self.directory, KEYS_FILE), keys)
+        np.save(os.path.join(self.directory, ROWS_FILE), rows.astype(np.int64))
+        metadata = dict(self.metadata,
+                        num_documents=self.num_documents,
+                        feature_shape=list(self.feature_shape),
+                        dtype=self.dtype.name)
+        with open(os.path.join(self.directory, METADATA_FILE), "w") as metadata_file:
+            json.dump(metadata, metadata_file, indent=2, sort_keys=True)
+
+    def __enter__(self) -> 'FeatureStoreWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class FeatureStore:
+    """
+    Read-only, memory-mapped access to the features written by ``FeatureStoreWriter``.
+
+    Parameters
+    ----------
+    directory : ``str``
+        The directory of the store.
+    """
+    def __init__(self, directory: str) -> None:
+        with open(os.path.join(directory, METADATA_FILE)) as metadata_file:
+            self.metadata = json.load(metadata_file)
+        self.feature_shape = tuple(self.metadata["feature_shape"])
+        self.num_documents = self.metadata["num_documents"]
+        self._keys = np.load(os.path.join(directory, KEYS_FILE))
+        self._rows = np.load(os.path.join(directory, ROWS_FILE))
+        if self.num_documents:
+            self.features = np.memmap(os.path.join(directory, FEATURES_FILE), dtype=self.metadata["dtype"],
+                                      mode="r", shape=(self.num_documents,) + self.feature_shape)
+        else:
+            self.features = np.zeros((0,) + self.feature_shape, dtype=self.metadata["dtype"])
+
+    def __len__(self) -> int:
+        return self.num_documents
+
+    def lookup(self, keys: List[str]) -> np.ndarray:
+        """
+        The feature rows of the documents with hashes ``keys``, -1 for documents not in the store.
+        """
+        keys = np.array(keys, dtype="S40")
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        if len(self._keys):
+            positions = np.searchsorted(self._keys, keys).clip(max=len(self._keys) - 1)
+            found = self._keys[positions] == keys
+            rows[found] = self._rows[positions[found]]
+        return rows
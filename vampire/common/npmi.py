@@ -0,0 +1,384 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import weakref
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+def generate_npmi_vals(interactions, document_sums):
+    """
+    Compute npmi values from interaction matrix and document sums
+
+    Parameters
+    ----------
+    interactions: ``np.ndarray``
+        Interaction matrix of size reference vocab size x reference vocab size,
+        where cell [i][j] indicates how many times word i and word j co-occur
+        in the corpus.
+    document_sums: ``np.ndarray``
+        Matrix of size number of docs x reference vocab size, where
+        cell [i][j] indicates how many times word i occur in documents
+        in the corpus
+    TODO(suchin): update this documentation
+    """
+    interaction_rows, interaction_cols = interactions.nonzero()
+    logger.info("generating doc sums...")
+    doc_sums = sparse.csr_matrix((np.log10(document_sums[interaction_rows])
+                                  + np.log10(document_sums[interaction_cols]),
+                                  (interaction_rows, interaction_cols)),
+                                 shape=interactions.shape)
+    logger.info("generating numerator...")
+    interactions.data = np.log10(interactions.data)
+    numerator = interactions - doc_sums
+    logger.info("generating denominator...")
+    denominator = interactions
+    return numerator, denominator
+
+
+def compute_npmi_matrices(ref_count_mat) -> Dict[str, Any]:
+    """
+    Compute everything needed to score NPMI from a (documents x reference vocabulary)
+    count matrix.
+
+    Returns
+    -------
+    A ``Dict`` containing the ``numerator`` and ``denominator`` sparse matrices produced by
+    ``generate_npmi_vals``, the per-word document frequencies ``doc_sums``, and ``n_docs``.
+    """
+    logger.info("Computing word interaction matrix.")
+    ref_doc_counts = (ref_count_mat > 0).astype(float)
+    ref_interaction = ref_doc_counts.T.dot(ref_doc_counts)
+    return npmi_matrices_from_interactions(ref_interaction, ref_count_mat.shape[0])
+
+
+def npmi_matrices_from_interactions(interactions, n_docs: int) -> Dict[str, Any]:
+    """
+    Compute the NPMI matrices of ``compute_npmi_matrices`` from the symmetric (reference
+    vocabulary x reference vocabulary) matrix of document co-occurrence counts, whose
+    diagonal holds the document frequency of every word. Like ``generate_npmi_vals``, this
+    may overwrite the values of ``interactions``.
+    """
+    interactions = sparse.csr_matrix(interactions, dtype=float)
+    doc_sums = interactions.diagonal()
+    logger.info("Generating npmi matrices.")
+    numerator, denominator = generate_npmi_vals(interactions, doc_sums)
+    return {"numerator": numerator.tocsr(),
+            "denominator": denominator.tocsr(),
+            "doc_sums": doc_sums,
+            "n_docs": n_docs}
+
+
+def reference_hash(*filenames: str) -> str:
+    """
+    Hash the contents of the reference files, to key precomputed NPMI matrices.
+    """
+    sha = hashlib.sha1()
+    for filename in filenames:
+        with open(filename, 'rb') as input_file:
+            for block in iter(lambda: input_file.read(1 << 20), b''):  # pylint: disable=cell-var-from-loop
+                sha.update(block)
+    return sha.hexdigest()
+
+
+def npmi_matrices_path(reference_counts: str, reference_vocabulary: str) -> str:
+    """
+    The path of the precomputed NPMI matrices for these (local) reference files, which
+    lives next to the reference counts.
+    """
+    key = reference_hash(reference_counts, reference_vocabulary)
+    return os.path.join(os.path.dirname(reference_counts), f"npmi.{key[:16]}.npz")
+
+
+def save_npmi_matrices(npmi_matrices: Dict[str, Any], output_filename: str) -> None:
+    arrays = {"doc_sums": npmi_matrices["doc_sums"], "n_docs": npmi_matrices["n_docs"]}
+    for name in ("numerator", "denominator"):
+        matrix = npmi_matrices[name].tocsr()
+        arrays[f"{name}_data"] = matrix.data
+        arrays[f"{name}_indices"] = matrix.indices
+        arrays[f"{name}_indptr"] = matrix.indptr
+        arrays[f"{name}_shape"] = matrix.shape
+    # np.savez appends .npz to names without it
+    with open(output_filename, 'wb') as output_file:
+        np.savez(output_file, **arrays)
+
+
+def load_npmi_matrices(input_filename: str) -> Dict[str, Any]:
+    npy = np.load(input_filename)
+    npmi_matrices = {"doc_sums": npy["doc_sums"], "n_docs": int(npy["n_docs"])}
+    for name in ("numerator", "denominator"):
+        npmi_matrices[name] = sparse.csr_matrix((npy[f"{name}_data"],
+                                                 npy[f"{name}_indices"],
+                                                 npy[f"{name}_indptr"]),
+                                                shape=tuple(npy[f"{name}_shape"]))
+    return npmi_matrices
+
+
+class NpmiReference:
+    """
+    Access to the precomputed NPMI matrices of a reference corpus, as dense
+    submatrices over the handful of words that NPMI is scored for.
+
+    Parameters
+    ----------
+    numerator: ``sparse.csr_matrix``
+        The ``numerator`` matrix of ``generate_npmi_vals``.
+    denominator: ``sparse.csr_matrix``
+        The ``denominator`` matrix of ``generate_npmi_vals``.
+    n_docs: ``int``
+        The number of documents in the reference corpus.
+    """
+    def __init__(self, numerator, denominator, n_docs: int) -> None:
+        self.numerator = numerator.tocsr()
+        self.denominator = denominator.tocsr()
+        self.n_docs = n_docs
+
+    @classmethod
+    def from_matrices(cls, npmi_matrices: Dict[str, Any]) -> 'NpmiReference':
+        return cls(npmi_matrices["numerator"], npmi_matrices["denominator"], npmi_matrices["n_docs"])
+
+    def submatrices(self, words: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The dense (len(words), len(words)) numerator and denominator submatrices
+        restricted to the reference indices in ``words``.
+        """
+        numerator = self.numerator[words][:, words].toarray()
+        denominator = self.denominator[words][:, words].toarray()
+        return numerator, denominator
+
+    def pair_terms(self, words: np.ndarray, rows: np.ndarray, cols: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The numerator and denominator values of the word pairs ``(words[rows], words[cols])``,
+        gathered from the dense submatrices over ``words``.
+        """
+        numerator, denominator = self.submatrices(words)
+        return numerator[rows, cols], denominator[rows, cols]
+
+
+# Number of set bits in every byte value.
+_POPCOUNT = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint8)
+
+
+class BitsetNpmiReference:
+    """
+    A compact NPMI reference that stores, for every reference word, the set of documents
+    it occurs in as a packed bit array. The co-occurrence count of a pair of words is the
+    popcount of the AND of their bit arrays, computed only for the pairs being scored.
+    Memory grows with documents x vocabulary bits, rather than with the vocabulary x
+    vocabulary interaction matrix of ``NpmiReference``.
+
+    Parameters
+    ----------
+    doc_bits: ``np.ndarray``
+        ``uint8`` array of shape (reference vocab size, ceil(n_docs / 8)), holding the
+        ``np.packbits`` document-presence bits of every word.
+    n_docs: ``int``
+        The number of documents in the reference corpus.
+    """
+    def __init__(self, doc_bits: np.ndarray, n_docs: int, max_chunk_bytes: int = 1 << 26) -> None:
+        self.doc_bits = doc_bits
+        self.n_docs = n_docs
+        self.doc_sums = self._popcount(doc_bits)
+        self._max_chunk_rows = max(1, max_chunk_bytes // max(1, doc_bits.shape[1]))
+
+    @classmethod
+    def from_counts(cls, ref_count_mat) -> 'BitsetNpmiReference':
+        """
+        Pack a (documents x reference vocabulary) count matrix.
+        """
+        doc_counts = sparse.csc_matrix(ref_count_mat)
+        n_docs, vocab_size = doc_counts.shape
+        word_ids = np.repeat(np.arange(vocab_size), np.diff(doc_counts.indptr))
+        # Explicitly stored zeros are not occurrences.
+        present = doc_counts.data > 0
+        docs = doc_counts.indices[present].astype(np.int64)
+        doc_bits = np.zeros((vocab_size, -(-n_docs // 8)), dtype=np.uint8)
+        # Same bit order as np.packbits: the first document is the high bit of the first byte.
+        np.bitwise_or.at(doc_bits, (word_ids[present], docs >> 3), (128 >> (docs & 7)).astype(np.uint8))
+        return cls(doc_bits, n_docs)
+
+    @staticmethod
+    def _popcount(bits: np.ndarray) -> np.ndarray:
+        return _POPCOUNT[bits].sum(-1, dtype=np.int64)
+
+    def cooccurrences(self, first: np.ndarray, second: np.ndarray) -> np.ndarray:
+        """
+        The number of documents in which both reference words ``first[i]`` and ``second[i]`` occur.
+        """
+        counts = np.zeros(len(first), dtype=np.int64)
+        for start in range(0, len(first), self._max_chunk_rows):
+            end = start + self._max_chunk_rows
+            counts[start:end] = self._popcount(self.doc_bits[first[start:end]] & self.doc_bits[second[start:end]])
+        return counts
+
+    def pair_terms(self, words: np.ndarray, rows: np.ndarray, cols: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The values ``NpmiReference`` would give for the word pairs ``(words[rows], words[cols])``.
+        """
+        first, second = words[rows], words[cols]
+        interactions = self.cooccurrences(first, second)
+        cooccur = interactions > 0
+        numerator = np.zeros(len(first))
+        denominator = np.zeros(len(first))
+        denominator[cooccur] = np.log10(interactions[cooccur])
+        numerator[cooccur] = (denominator[cooccur]
+                              - np.log10(self.doc_sums[first[cooccur]])
+                              - np.log10(self.doc_sums[second[cooccur]]))
+        return numerator, denominator
+
+
+def score_npmi(reference, topic_indices: np.ndarray) -> np.ndarray:
+    """
+    Score the NPMI of every topic in one pass.
+
+    Parameters
+    ----------
+    reference: ``NpmiReference``
+        Any object with an ``n_docs`` attribute and a ``pair_terms(words, rows, cols)`` method,
+        such as ``NpmiReference`` or ``BitsetNpmiReference``.
+    topic_indices: ``np.ndarray``
+        Integer array of shape ``(..., num_topics, k)`` holding reference vocabulary
+        indices of the top k words of each topic, with -1 for words missing from the
+        reference vocabulary. Leading dimensions let several topic sets (e.g. from
+        different checkpoints or seeds) be scored in one call.
+
+    Returns
+    -------
+    ``np.ndarray`` of shape ``(..., num_topics)`` with the mean NPMI over the k choose 2
+    word pairs of each topic. Pairs involving a missing word, or that never co-occur,
+    score 0.
+    """
+    topic_indices = np.asarray(topic_indices, dtype=np.int64)
+    num_words = topic_indices.shape[-1]
+    if num_words < 2:
+        return np.zeros(topic_indices.shape[:-1])
+    words = np.unique(topic_indices[topic_indices >= 0])
+    # Missing words get the local index len(words).
+    local_indices = np.where(topic_indices >= 0, np.searchsorted(words, topic_indices), len(words))
+    rows, cols = np.triu_indices(num_words, 1)
+    pair_rows, pair_cols = local_indices[..., rows], local_indices[..., cols]
+    # Every distinct pair of words is looked up once.
+    pair_keys = (np.minimum(pair_rows, pair_cols) * (len(words) + 1)
+                 + np.maximum(pair_rows, pair_cols))
+    unique_keys, inverse = np.unique(pair_keys.ravel(), return_inverse=True)
+    unique_rows, unique_cols = np.divmod(unique_keys, len(words) + 1)
+    valid = unique_cols < len(words)
+    numerator, denominator = reference.pair_terms(words, unique_rows[valid], unique_cols[valid])
+    log_n_docs = np.log10(reference.n_docs)
+    npmi = np.zeros(len(unique_keys))
+    npmi[valid] = (log_n_docs + numerator) / (log_n_docs - denominator)
+    npmi[npmi == 1.0] = 0.0
+    return npmi[inverse].reshape(pair_keys.shape).mean(-1)
+
+
+class IncrementalNpmi:
+    """
+    Scores the NPMI of a set of topics repeatedly, e.g. once per epoch. Word pair scores
+    are cached, and topics whose top-k words are unchanged since the last call are not
+    rescored, so the cost of a call grows with how many topics changed rather than with
+    the number of topics.
+
+    Parameters
+    ----------
+    reference: ``NpmiReference``
+        The reference to score against, as for ``score_npmi``.
+    max_cached_pairs: ``int``
+        Once the pair cache grows beyond this size, it is pruned to the pairs of the
+        current topics.
+    """
+    def __init__(self, reference, max_cached_pairs: int = 1000000) -> None:
+        self.reference = reference
+        self._max_cached_pairs = max_cached_pairs
+        self._pair_scores: Dict[Tuple[int, int], float] = {}
+        self._previous_topics = None
+        self._previous_scores = None
+
+    def score(self, topic_indices: np.ndarray) -> np.ndarray:
+        """
+        Score ``(num_topics, k)`` reference indices as ``score_npmi`` does, returning the
+        ``(num_topics,)`` per-topic NPMI.
+        """
+        # Sorting makes each row a canonical top-k set, and gives every pair as (smaller, larger).
+        topics = np.sort(np.asarray(topic_indices, dtype=np.int64), axis=1)
+        num_topics, num_words = topics.shape
+        if num_words < 2:
+            return np.zeros(num_topics)
+        if self._previous_topics is not None and self._previous_topics.shape == topics.shape:
+            changed = np.any(topics != self._previous_topics, axis=1)
+            scores = self._previous_scores.copy()
+        else:
+            changed = np.ones(num_topics, dtype=bool)
+            scores = np.zeros(num_topics)
+
+        rows, cols = np.triu_indices(num_words, 1)
+        changed_pairs = np.stack([topics[changed][:, rows], topics[changed][:, cols]], axis=-1).tolist()
+        # Pairs with a word missing from the reference score 0 and are not cached.
+        new_pairs = sorted({tuple(pair) for topic_pairs in changed_pairs for pair in topic_pairs
+                            if pair[0] >= 0 and tuple(pair) not in self._pair_scores})
+        if new_pairs:
+            new_scores = score_npmi(self.reference, np.array(new_pairs))
+            self._pair_scores.update(zip(new_pairs, new_scores.tolist()))
+        for topic, topic_pairs in zip(np.flatnonzero(changed), changed_pairs):
+            scores[topic] = sum(self._pair_scores.get(tuple(pair), 0.0) for pair in topic_pairs) / len(rows)
+
+        if len(self._pair_scores) > self._max_cached_pairs:
+            current_pairs = {pair for pair in zip(topics[:, rows].ravel().tolist(), topics[:, cols].ravel().tolist())}
+            self._pair_scores = {pair: score for pair, score in self._pair_scores.items() if pair in current_pairs}
+        self._previous_topics = topics
+        self._previous_scores = scores
+        return scores.copy()
+
+
+_WORKER_NPMI = None
+
+
+def _init_npmi_worker(reference) -> None:
+    global _WORKER_NPMI  # pylint: disable=global-statement
+    _WORKER_NPMI = IncrementalNpmi(reference)
+
+
+def _score_npmi_in_worker(topic_indices: np.ndarray) -> np.ndarray:
+    return _WORKER_NPMI.score(topic_indices)
+
+
+class AsyncNpmiScorer:
+    """
+    Scores NPMI with an ``IncrementalNpmi`` in a background worker process, which holds
+    its own copy of the reference so that only topic index arrays are sent to it.
+
+    Parameters
+    ----------
+    reference: ``NpmiReference``
+        The reference to score against.
+    """
+    def __init__(self, reference) -> None:
+        self._pool = multiprocessing.Pool(1, initializer=_init_npmi_worker, initargs=(reference,))
+        self._pending = None
+        # The worker is stopped once the scorer is garbage collected, or at exit.
+        self._finalizer = weakref.finalize(self, self._pool.terminate)
+
+    def submit(self, topic_indices: np.ndarray) -> None:
+        """
+        Start scoring ``topic_indices``. A result that has not been collected yet is dropped.
+        """
+        self._pending = self._pool.apply_async(_score_npmi_in_worker, (topic_indices,))
+
+    def result(self, block: bool = False) -> Optional[np.ndarray]:
+        """
+        The per-topic scores of the last submitted topics, or ``None`` if nothing is pending
+        or, unless ``block`` is set, if the worker has not finished yet. A result is only
+        returned once.
+        """
+        if self._pending is None or (not block and not self._pending.ready()):
+            return None
+        scores = self._pending.get()
+        self._pending = None
+        return scores
+
+    def close(self) -> None:
+        self._finalizer()
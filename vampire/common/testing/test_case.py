@@ -4,8 +4,10 @@ import logging
 import os
 import pathlib
 import shutil
+import sys
 import tempfile
 from typing import Any, Dict, Iterable, Set, Union
+from unittest import mock
 
 import torch
 from allennlp.commands.train import train_model_from_file
@@ -48,6 +50,36 @@ class VAETestCase(AllenNlpTestCase):  # pylint: disable=too-many-public-methods
 
         os.makedirs(self.TEST_DIR, exist_ok=True)
 
+    def preprocess_data(self, serialization_dir: Union[str, pathlib.Path], *flags: str) -> None:
+        """
+        Run ``scripts/preprocess_data.py`` with the IMDB fixtures as train and dev data,
+        writing to ``serialization_dir``, with additional command line ``flags``.
+        """
+        # The scripts are not part of the vampire package.
+        from scripts.preprocess_data import main  # pylint: disable=import-outside-toplevel
+        argv = ["preprocess_data.py",
+                "--train-path", str(self.FIXTURES_ROOT / "imdb" / "train.jsonl"),
+                "--dev-path", str(self.FIXTURES_ROOT / "imdb" / "test.jsonl"),
+                "--serialization-dir", str(serialization_dir),
+                *flags]
+        with mock.patch.object(sys, "argv", argv):
+            main()
+
+    @staticmethod
+    def patch_to_call_once(target: Any, attribute: str):
+        """
+        Patch the function ``attribute`` of ``target`` to fail when it is called a second
+        time, including in processes forked after the first call, which inherit the count.
+        """
+        function = getattr(target, attribute)
+        calls = []
+
+        def call_once(*args, **kwargs):
+            assert not calls, f"{attribute} was called again"
+            calls.append(args)
+            return function(*args, **kwargs)
+        return mock.patch.object(target, attribute, side_effect=call_once)
+
     def set_up_model(self, param_file, dataset_file):
         # pylint: disable=attribute-defined-outside-init
         self.param_file = param_file
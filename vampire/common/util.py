@@ -1,39 +1,85 @@
 import codecs
+import hashlib
+import itertools
 import json
 import os
 import pickle
-from typing import Any, Dict, List
+import shutil
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
 
 import numpy as np
 import torch
+from allennlp.common.file_utils import CACHE_DIRECTORY
 from allennlp.data import Vocabulary
 from scipy import sparse
 
 
-def compute_background_log_frequency(vocab: Vocabulary, vocab_namespace: str, precomputed_bg_file=None):
+SPECIAL_TOKENS = ("@@UNKNOWN@@", "@@PADDING@@", '@@START@@', '@@END@@')
+
+
+def align_background_log_frequency(tokens: List[str], frequencies: Dict[str, float]) -> torch.Tensor:
+    """
+    The log of the frequency of every token in ``tokens``, with ``1e-12`` for special tokens
+    and for tokens without a (non-zero) frequency.
+    """
+    aligned = np.fromiter(map(frequencies.get, tokens, itertools.repeat(0.0)), dtype=np.float32, count=len(tokens))
+    aligned[np.isin(tokens, SPECIAL_TOKENS)] = 0.0
+    aligned[aligned == 0] = 1e-12
+    return torch.log(torch.from_numpy(aligned))
+
+
+def _background_cache_key(vocab: Vocabulary, vocab_namespace: str, precomputed_bg_file: str) -> str:
+    # The cache is valid as long as neither the frequencies nor the vocabulary file change.
+    filenames = [os.path.abspath(precomputed_bg_file),
+                 os.path.abspath(os.path.join(vocab.serialization_dir, vocab_namespace + '.txt'))]
+    stats = [(os.stat(filename).st_size, os.stat(filename).st_mtime_ns) if os.path.exists(filename) else None
+             for filename in filenames]
+    return json.dumps([filenames, stats, vocab.get_vocab_size(vocab_namespace)])
+
+
+def compute_background_log_frequency(vocab: Vocabulary,
+                                     vocab_namespace: str,
+                                     precomputed_bg_file=None,
+                                     cache_directory: str = None):
     """
     Load in the word counts from the JSON file and compute the
     background log term frequency w.r.t this vocabulary.
+
+    If the vocabulary was loaded from a directory, the result is cached in
+    ``cache_directory`` (by default, under the allennlp cache), and reused until the
+    JSON file or the vocabulary changes.
     """
-    # precomputed_word_counts = json.load(open(precomputed_word_counts, "r"))
-    log_term_frequency = torch.FloatTensor(vocab.get_vocab_size(vocab_namespace))
-    if precomputed_bg_file is not None:
-        with open(precomputed_bg_file, "r") as file_:
-            precomputed_bg = json.load(file_)
-    else:
-        precomputed_bg = vocab._retained_counter.get(vocab_namespace)  # pylint: disable=protected-access
+    vocab_size = vocab.get_vocab_size(vocab_namespace)
+    index_to_token = vocab.get_index_to_token_vocabulary(vocab_namespace)
+    if precomputed_bg_file is None:
+        precomputed_bg = (vocab._retained_counter or {}).get(vocab_namespace)  # pylint: disable=protected-access
         if precomputed_bg is None:
-            return log_term_frequency
-    for i in range(vocab.get_vocab_size(vocab_namespace)):
-        token = vocab.get_token_from_index(i, vocab_namespace)
-        if token in ("@@UNKNOWN@@", "@@PADDING@@", '@@START@@', '@@END@@') or token not in precomputed_bg:
-            log_term_frequency[i] = 1e-12
-        elif token in precomputed_bg:
-            if precomputed_bg[token] == 0:
-                log_term_frequency[i] = 1e-12
-            else:
-                log_term_frequency[i] = precomputed_bg[token]
-    log_term_frequency = torch.log(log_term_frequency)
+            return torch.FloatTensor(vocab_size)
+        return align_background_log_frequency(list(map(index_to_token.get, range(vocab_size))), precomputed_bg)
+
+    cache_file = None
+    if getattr(vocab, "serialization_dir", None):
+        cache_key = _background_cache_key(vocab, vocab_namespace, precomputed_bg_file)
+        cache_directory = cache_directory or os.path.join(CACHE_DIRECTORY, "background_frequencies")
+        cache_file = os.path.join(cache_directory, hashlib.sha1(cache_key.encode("utf-8")).hexdigest() + ".npz")
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as cached:
+                if str(cached["key"]) == cache_key:
+                    return torch.from_numpy(cached["log_frequency"])
+    with open(precomputed_bg_file, "r") as file_:
+        precomputed_bg = json.load(file_)
+    log_term_frequency = align_background_log_frequency(list(map(index_to_token.get, range(vocab_size))),
+                                                        precomputed_bg)
+    if cache_file is not None:
+        temporary_file = f"{cache_file}.{os.getpid()}.npz"
+        try:
+            os.makedirs(cache_directory, exist_ok=True)
+            np.savez(temporary_file, key=cache_key, log_frequency=log_term_frequency.numpy())
+            os.replace(temporary_file, cache_file)
+        except OSError:
+            # The cache is only an optimization.
+            pass
     return log_term_frequency
 
 
@@ -171,6 +217,235 @@ def save_sparse(sparse_matrix, output_filename):
 
 
 def load_sparse(input_filename):
+    if is_csr_file(input_filename):
+        return load_csr(input_filename)
     npy = np.load(input_filename)
     coo_matrix = sparse.coo_matrix((npy['data'], (npy['row'], npy['col'])), shape=npy['shape'])
     return coo_matrix.tocsc()
+
+
+# On-disk CSR format: an 8-byte magic string, the length of a JSON header as
+# a little-endian uint64, the JSON header itself, and then the raw ``indptr``,
+# ``indices`` and ``data`` arrays, each aligned to CSR_ALIGNMENT bytes. The
+# header records the shape of the matrix and the dtype and offset of each array.
+CSR_MAGIC = b"VAMPCSR1"
+CSR_ALIGNMENT = 64
+
+
+def _csr_index_dtype(nnz: int, num_cols: int):
+    # scipy copies index arrays that could be stored with a smaller dtype,
+    # so store int32 indices whenever they fit to keep loading zero-copy.
+    if max(nnz, num_cols) < np.iinfo(np.int32).max:
+        return np.dtype(np.int32)
+    return np.dtype(np.int64)
+
+
+def _write_csr_header(output_file, shape, arrays: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """
+    Write the CSR header given the (dtype, size) of each array, returning the header layout.
+    """
+    layout: Dict[str, Dict[str, Any]] = {}
+    # The header has a fixed layout, so compute offsets assuming a generously padded header.
+    header_size = 1024
+    offset = len(CSR_MAGIC) + 8 + header_size
+    for name in ("indptr", "indices", "data"):
+        dtype, size = arrays[name]
+        offset += -offset % CSR_ALIGNMENT
+        layout[name] = {"dtype": np.dtype(dtype).str, "offset": offset, "size": int(size)}
+        offset += np.dtype(dtype).itemsize * int(size)
+    header = json.dumps({"shape": [int(dim) for dim in shape], "arrays": layout}).encode('utf-8')
+    assert len(header) <= header_size
+    output_file.seek(0)
+    output_file.write(CSR_MAGIC)
+    output_file.write(np.uint64(header_size).tobytes())
+    output_file.write(header.ljust(header_size))
+    return layout
+
+
+def save_csr(sparse_matrix, output_filename):
+    """
+    Save a sparse matrix in the memory-mappable CSR format read by ``load_csr``.
+    """
+    assert sparse.issparse(sparse_matrix)
+    csr = sparse_matrix.tocsr()
+    csr.sum_duplicates()
+    index_dtype = _csr_index_dtype(csr.nnz, csr.shape[1])
+    arrays = {"indptr": csr.indptr.astype(index_dtype),
+              "indices": csr.indices.astype(index_dtype),
+              "data": csr.data}
+    with open(output_filename, 'wb') as output_file:
+        layout = _write_csr_header(output_file, csr.shape,
+                                   {name: (array.dtype, array.size) for name, array in arrays.items()})
+        for name, array in arrays.items():
+            output_file.seek(layout[name]["offset"])
+            output_file.write(np.ascontiguousarray(array).tobytes())
+
+
+def save_matrix(sparse_matrix, output_prefix, output_format="npz"):
+    """
+    Save a sparse matrix to ``output_prefix`` plus an extension matching ``output_format``,
+    either ``npz`` (``save_sparse``) or ``csr`` (``save_csr``).
+    """
+    if output_format == "csr":
+        save_csr(sparse_matrix, output_prefix + ".csr")
+    else:
+        save_sparse(sparse_matrix, output_prefix + ".npz")
+
+
+def is_csr_file(input_filename) -> bool:
+    try:
+        with open(input_filename, 'rb') as input_file:
+            return input_file.read(len(CSR_MAGIC)) == CSR_MAGIC
+    except (IOError, OSError):
+        return False
+
+
+def load_csr(input_filename, mmap: bool = True):
+    """
+    Load a matrix saved by ``save_csr``. By default the underlying arrays are
+    memory-mapped read-only, so loading is near-instant and does not copy the data.
+    """
+    with open(input_filename, 'rb') as input_file:
+        assert input_file.read(len(CSR_MAGIC)) == CSR_MAGIC, f"{input_filename} is not a CSR file"
+        header_size = int(np.frombuffer(input_file.read(8), dtype=np.uint64)[0])
+        header = json.loads(input_file.read(header_size).decode('utf-8'))
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        if mmap and spec["size"] > 0:
+            arrays[name] = np.memmap(input_filename, dtype=np.dtype(spec["dtype"]), mode='r',
+                                     offset=spec["offset"], shape=(spec["size"],))
+        else:
+            arrays[name] = np.fromfile(input_filename, dtype=np.dtype(spec["dtype"]),
+                                       count=spec["size"], offset=spec["offset"])
+    return sparse.csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]),
+                             shape=tuple(header["shape"]), copy=False)
+
+
+class CSRWriter:
+    """
+    Incrementally write a CSR file (see ``save_csr``) by appending blocks of rows,
+    so that matrices larger than memory can be built chunk by chunk.
+
+    Parameters
+    ----------
+    output_filename : ``str``
+        Where to write the CSR file.
+    num_cols : ``int``
+        The number of columns every appended block must have.
+    """
+    def __init__(self, output_filename: str, num_cols: int) -> None:
+        self.output_filename = output_filename
+        self.num_cols = num_cols
+        self.num_rows = 0
+        self.nnz = 0
+        self._data_dtype = None
+        self._indptr = [np.zeros(1, dtype=np.int64)]
+        self._indices_file = open(output_filename + ".indices.tmp", 'wb')
+        self._data_file = open(output_filename + ".data.tmp", 'wb')
+
+    def append(self, rows) -> None:
+        csr = sparse.csr_matrix(rows)
+        assert csr.shape[1] == self.num_cols
+        csr.sum_duplicates()
+        if self._data_dtype is None:
+            self._data_dtype = csr.data.dtype
+        self._indptr.append(csr.indptr[1:].astype(np.int64) + self.nnz)
+        self._indices_file.write(csr.indices.astype(np.int64).tobytes())
+        self._data_file.write(csr.data.astype(self._data_dtype).tobytes())
+        self.num_rows += csr.shape[0]
+        self.nnz += csr.nnz
+
+    def close(self) -> None:
+        self._indices_file.close()
+        self._data_file.close()
+        index_dtype = _csr_index_dtype(self.nnz, self.num_cols)
+        data_dtype = self._data_dtype or np.dtype(np.float64)
+        indptr = np.concatenate(self._indptr).astype(index_dtype)
+        with open(self.output_filename, 'wb') as output_file:
+            layout = _write_csr_header(output_file, (self.num_rows, self.num_cols),
+                                       {"indptr": (index_dtype, indptr.size),
+                                        "indices": (index_dtype, self.nnz),
+                                        "data": (data_dtype, self.nnz)})
+            output_file.seek(layout["indptr"]["offset"])
+            output_file.write(indptr.tobytes())
+            # Narrow the temporary int64 indices in bounded-size chunks.
+            output_file.seek(layout["indices"]["offset"])
+            indices = np.memmap(self._indices_file.name, dtype=np.int64, mode='r') if self.nnz else []
+            chunk_size = 1 << 24
+            for start in range(0, self.nnz, chunk_size):
+                output_file.write(np.asarray(indices[start:start + chunk_size]).astype(index_dtype).tobytes())
+            del indices
+            output_file.seek(layout["data"]["offset"])
+            with open(self._data_file.name, 'rb') as data_file:
+                shutil.copyfileobj(data_file, output_file)
+        os.remove(self._indices_file.name)
+        os.remove(self._data_file.name)
+
+    def __enter__(self) -> 'CSRWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def document_hash(token_ids) -> str:
+    """
+    A content hash of a document given as token ids, ignoring their order and any
+    padding (id 0). Documents with the same bag of words get the same hash.
+    """
+    token_ids = np.asarray(token_ids).ravel()
+    bag_of_words = np.sort(token_ids[token_ids != 0]).astype(np.int64)
+    return hashlib.sha1(bag_of_words.tobytes()).hexdigest()
+
+
+class RepresentationCache:
+    """
+    An LRU cache of fixed-size ``np.ndarray`` values, bounded by a memory budget. If a
+    ``spill_directory`` is given, evicted values are written there and read back on
+    a later miss, instead of being dropped.
+
+    Parameters
+    ----------
+    max_bytes : ``int``
+        The memory budget for the cached arrays.
+    spill_directory : ``str``, optional
+        Where evicted values are stored.
+    """
+    def __init__(self, max_bytes: int, spill_directory: str = None) -> None:
+        self.max_bytes = max_bytes
+        self.spill_directory = spill_directory
+        self.num_bytes = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._spilled = set()
+        if spill_directory:
+            os.makedirs(spill_directory, exist_ok=True)
+            self._spilled = {filename[:-len(".npy")] for filename in os.listdir(spill_directory)
+                             if filename.endswith(".npy")}
+
+    def __len__(self) -> int:
+        return len(self._entries) + len(self._spilled - self._entries.keys())
+
+    def _spill_path(self, key: str) -> str:
+        return os.path.join(self.spill_directory, key + ".npy")
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        elif key in self._spilled:
+            value = np.load(self._spill_path(key))
+            self.put(key, value)
+        return value
+
+    def put(self, key: str, value: np.ndarray) -> None:
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+        self._entries[key] = value
+        self.num_bytes += value.nbytes
+        while self.num_bytes > self.max_bytes and self._entries:
+            evicted_key, evicted = self._entries.popitem(last=False)
+            self.num_bytes -= evicted.nbytes
+            if self.spill_directory and evicted_key not in self._spilled:
+                np.save(self._spill_path(evicted_key), evicted)
+                self._spilled.add(evicted_key)
@@ -8,6 +8,7 @@ from allennlp.data.instance import Instance
 from overrides import overrides
 
 from vampire.common.util import load_sparse
+from vampire.data.fields import SparseBlockField
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
@@ -18,11 +19,16 @@ class VampireReader(DatasetReader):
     Reads bag of word vectors from a sparse matrices representing training and validation data.
 
     Expects a sparse matrix of size N documents x vocab size, which can be created via
-    the scripts/preprocess_data.py file.
+    the scripts/preprocess_data.py file, either as an ``.npz`` file or in the
+    memory-mapped CSR format written by ``save_csr``.
 
     The output of ``read`` is a list of ``Instances`` with the field:
         vec: ``ArrayField``
 
+    If ``block_size`` is set, each ``Instance`` instead holds a contiguous block of
+    ``block_size`` rows in a ``SparseBlockField``, which is tensorized directly into a
+    ``(block_size, vocab_size)`` batch. Use this with an iterator ``batch_size`` of 1.
+
     Parameters
     ----------
     lazy : ``bool``, optional, (default = ``False``)
@@ -33,21 +39,33 @@ class VampireReader(DatasetReader):
     min_sequence_length : ``int`` (default = ``3``)
         Only consider examples from data that are greater than
         the supplied minimum sequence length.
+    block_size : ``int``, optional, (default = ``None``)
+        If specified, read the matrix in contiguous blocks of this many rows,
+        yielding one ``Instance`` per block rather than one per document.
+    sparse : ``bool``, optional, (default = ``False``)
+        If True (and ``block_size`` is set), blocks are tensorized as torch sparse
+        tensors, which ``VAMPIRE`` consumes without densifying.
     """
     def __init__(self,
                  lazy: bool = False,
                  sample: int = None,
-                 min_sequence_length: int = 0) -> None:
+                 min_sequence_length: int = 0,
+                 block_size: int = None,
+                 sparse: bool = False) -> None:
         super().__init__(lazy=lazy)
         self._sample = sample
         self._min_sequence_length = min_sequence_length
+        self._block_size = block_size
+        self._sparse = sparse
 
     @overrides
     def _read(self, file_path):
-        # load sparse matrix
-        mat = load_sparse(file_path)
-        # convert to lil format for row-wise iteration
-        mat = mat.tolil()
+        if self._block_size:
+            yield from self._read_blocks(file_path)
+            return
+
+        # load sparse matrix, in csr format for row-wise iteration
+        mat = load_sparse(file_path).tocsr()
 
         # optionally sample the matrix
         if self._sample:
@@ -56,10 +74,29 @@ class VampireReader(DatasetReader):
             indices = range(mat.shape[0])
 
         for index in indices:
-            instance = self.text_to_instance(vec=mat[index].toarray().squeeze())
-            if instance is not None and mat[index].toarray().sum() > self._min_sequence_length:
+            vec = mat[index].toarray().squeeze()
+            instance = self.text_to_instance(vec=vec)
+            if instance is not None and vec.sum() > self._min_sequence_length:
                 yield instance
 
+    def _read_blocks(self, file_path):
+        # CSR supports cheap contiguous row slicing.
+        mat = load_sparse(file_path).tocsr()
+
+        # optionally sample the matrix
+        if self._sample:
+            mat = mat[np.random.choice(range(mat.shape[0]), self._sample)]
+
+        # filter short documents with a single vectorized row-sum
+        row_sums = np.asarray(mat.sum(axis=1)).ravel()
+        keep = np.flatnonzero(row_sums > self._min_sequence_length)
+        if keep.shape[0] < mat.shape[0]:
+            mat = mat[keep]
+
+        for start in range(0, mat.shape[0], self._block_size):
+            block = mat[start:start + self._block_size]
+            yield Instance({'tokens': SparseBlockField(block, sparse=self._sparse)})
+
     @overrides
     def text_to_instance(self, vec: str = None) -> Instance:  # type: ignore
         """
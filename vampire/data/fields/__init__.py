@@ -0,0 +1 @@
+from vampire.data.fields.sparse_block_field import SparseBlockField
@@ -0,0 +1,60 @@
+from typing import Dict, List
+
+import numpy as np
+import torch
+from allennlp.data.fields.field import Field
+from overrides import overrides
+from scipy import sparse
+
+
+class SparseBlockField(Field[torch.Tensor]):
+    """
+    A ``SparseBlockField`` holds a contiguous block of rows from a sparse bag-of-words
+    matrix. Unlike an ``ArrayField``, which holds a single document, one of these fields
+    already represents a full batch, so its tensors are concatenated (rather than stacked)
+    when batched.
+
+    The block stays in CSR form until it is tensorized, so only one dense
+    ``(block_size, vocab_size)`` array is materialized per batch. With ``sparse=True``
+    not even that happens: the block becomes a torch sparse COO tensor.
+
+    Parameters
+    ----------
+    block : ``sparse.csr_matrix``
+        The rows of the bag-of-words matrix making up this block.
+    sparse : ``bool``, optional (default = ``False``)
+        If True, produce a sparse tensor instead of a dense one.
+    """
+    def __init__(self, block: sparse.csr_matrix, sparse: bool = False) -> None:  # pylint: disable=redefined-outer-name
+        self.block = block
+        self.sparse = sparse
+
+    @overrides
+    def get_padding_lengths(self) -> Dict[str, int]:
+        return {}
+
+    @overrides
+    def as_tensor(self, padding_lengths: Dict[str, int]) -> torch.Tensor:
+        # pylint: disable=unused-argument
+        if not self.sparse:
+            return torch.from_numpy(self.block.toarray().astype(np.float32))
+        coo = self.block.tocoo()
+        indices = torch.from_numpy(np.vstack([coo.row, coo.col]).astype(np.int64))
+        values = torch.from_numpy(coo.data.astype(np.float32))
+        return torch.sparse_coo_tensor(indices, values, coo.shape)
+
+    @overrides
+    def empty_field(self):  # pylint: disable=no-self-use
+        return SparseBlockField(sparse.csr_matrix((0, self.block.shape[1]), dtype=np.float32),
+                                sparse=self.sparse)
+
+    @overrides
+    def batch_tensors(self, tensor_list: List[torch.Tensor]) -> torch.Tensor:  # type: ignore
+        # pylint: disable=no-self-use
+        return torch.cat(tensor_list, dim=0)
+
+    def __len__(self) -> int:
+        return self.block.shape[0]
+
+    def __str__(self) -> str:
+        return f"SparseBlockField with shape: {self.block.shape}."
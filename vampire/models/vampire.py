@@ -1,8 +1,5 @@
 import logging
 import os
-from functools import partial
-from itertools import combinations
-from operator import is_not
 from typing import Dict, List, Optional, Tuple, Union
 
 import numpy as np
@@ -12,12 +9,17 @@ from allennlp.common.file_utils import cached_path
 from allennlp.data.vocabulary import Vocabulary
 from allennlp.models.model import Model
 from allennlp.modules import TokenEmbedder
+from allennlp.modules.token_embedders.bag_of_word_counts_token_embedder import BagOfWordCountsTokenEmbedder
 from allennlp.nn import InitializerApplicator, RegularizerApplicator
 from allennlp.training.metrics import Average
 from overrides import overrides
-from scipy import sparse
 from tabulate import tabulate
 
+from vampire.common.npmi import (AsyncNpmiScorer, BitsetNpmiReference,
+                                 IncrementalNpmi, NpmiReference,
+                                 compute_npmi_matrices,
+                                 generate_npmi_vals, load_npmi_matrices,
+                                 npmi_matrices_path, score_npmi)
 from vampire.common.util import (compute_background_log_frequency, load_sparse,
                                  read_json)
 from vampire.modules import VAE
@@ -52,15 +54,32 @@ class VAMPIRE(Model):
     background_data_path: ``str``
         Path to a JSON file containing word frequencies accumulated over the training corpus.
     reference_counts: ``str``
-        Path to reference counts for NPMI calculation
+        Path to reference counts for NPMI calculation. These are only loaded when NPMI is
+        first computed, and precomputed NPMI matrices next to them are used if present.
     reference_vocabulary: ``str``
         Path to reference vocabulary for NPMI calculation
+    reference_npmi: ``str``
+        Path to NPMI matrices written by ``scripts/build_reference.py``. If given, these are
+        used instead of computing them from ``reference_counts``, which is then optional.
+    npmi_reference_type: ``str``
+        How the reference is held in memory for NPMI. ``sparse`` keeps the vocabulary x vocabulary
+        NPMI matrices, ``bitset`` keeps only the packed document-presence bits of every reference
+        word and counts co-occurrences of the scored pairs on demand.
     update_background_freq: ``bool``:
         Whether to allow the background frequency to be learnable.
     track_topics: ``bool``:
         Whether to periodically print the learned topics.
     track_npmi: ``bool``:
         Whether to track NPMI every epoch.
+    track_topic_npmi: ``bool``:
+        Whether to also report the NPMI of each topic, as ``npmi_<topic>`` metrics.
+    async_npmi: ``bool``:
+        Whether to score NPMI in a background process instead of at the start of
+        validation. The result is reported by ``get_metrics`` once it is ready.
+    block_on_npmi: ``bool``:
+        With ``async_npmi``, whether to wait for the pending NPMI score when the validation
+        metrics are reset at the end of an epoch. Set this when ``+npmi`` is the validation
+        metric, so that early stopping and checkpointing see the score of this epoch.
     initializer : ``InitializerApplicator``, optional (default=``InitializerApplicator()``)
         Used to initialize the model parameters.
     regularizer : ``RegularizerApplicator``, optional (default=``None``)
@@ -76,10 +95,15 @@ class VAMPIRE(Model):
                  sigmoid_weight_2: float = 15,
                  reference_counts: str = None,
                  reference_vocabulary: str = None,
+                 reference_npmi: str = None,
                  background_data_path: str = None,
+                 npmi_reference_type: str = "sparse",
                  update_background_freq: bool = False,
                  track_topics: bool = True,
                  track_npmi: bool = True,
+                 track_topic_npmi: bool = False,
+                 async_npmi: bool = False,
+                 block_on_npmi: bool = False,
                  initializer: InitializerApplicator = InitializerApplicator(),
                  regularizer: Optional[RegularizerApplicator] = None) -> None:
         super().__init__(vocab, regularizer)
@@ -90,30 +114,26 @@ class VAMPIRE(Model):
         self.vae = vae
         self.track_topics = track_topics
         self.track_npmi = track_npmi
+        self._track_topic_npmi = track_topic_npmi
+        self._async_npmi = async_npmi
+        self._block_on_npmi = block_on_npmi
+        self._npmi_scorer = None
         self.vocab_namespace = "vampire"
         self._update_background_freq = update_background_freq
         self._background_freq = self.initialize_bg_from_file(file_=background_data_path)
         self._ref_counts = reference_counts
+        self._ref_vocabulary = reference_vocabulary
+        self._ref_npmi = reference_npmi
+        if npmi_reference_type not in ("sparse", "bitset"):
+            raise ConfigurationError("npmi reference type {} not found".format(npmi_reference_type))
+        if npmi_reference_type == "bitset" and reference_vocabulary and not reference_counts:
+            raise ConfigurationError("the bitset npmi reference requires reference_counts")
+        self._npmi_reference_type = npmi_reference_type
+        # The reference data for NPMI is loaded lazily, the first time NPMI is computed.
+        self._ref_vocab = None
 
         self._npmi_updated = False
 
-        if reference_vocabulary is not None:
-            # Compute data necessary to compute NPMI every epoch
-            logger.info("Loading reference vocabulary.")
-            self._ref_vocab = read_json(cached_path(reference_vocabulary))
-            self._ref_vocab_index = dict(zip(self._ref_vocab, range(len(self._ref_vocab))))
-            logger.info("Loading reference count matrix.")
-            self._ref_count_mat = load_sparse(cached_path(self._ref_counts))
-            logger.info("Computing word interaction matrix.")
-            self._ref_doc_counts = (self._ref_count_mat > 0).astype(float)
-            self._ref_interaction = (self._ref_doc_counts).T.dot(self._ref_doc_counts)
-            self._ref_doc_sum = np.array(self._ref_doc_counts.sum(0).tolist()[0])
-            logger.info("Generating npmi matrices.")
-            (self._npmi_numerator,
-             self._npmi_denominator) = self.generate_npmi_vals(self._ref_interaction,
-                                                               self._ref_doc_sum)
-            self.n_docs = self._ref_count_mat.shape[0]
-
         vampire_vocab_size = self.vocab.get_vocab_size(self.vocab_namespace)
         self._bag_of_words_embedder = bow_embedder
 
@@ -168,7 +188,7 @@ class VAMPIRE(Model):
         ``reconstructed_bow`` : torch.Tensor
             reconstructed bag of words from VAE
         ``target_bow`` : torch.Tensor
-            target bag of words tensor
+            target bag of words tensor, either dense or sparse
 
         Returns
         -------
@@ -176,6 +196,12 @@ class VAMPIRE(Model):
             Cross entropy loss between reconstruction and target
         """
         log_reconstructed_bow = torch.nn.functional.log_softmax(reconstructed_bow + 1e-10, dim=-1)
+        if target_bow.is_sparse:
+            # Only gather the log-probabilities of words that occur in each document.
+            target_bow = target_bow.coalesce()
+            rows, cols = target_bow.indices()
+            word_losses = target_bow.values() * log_reconstructed_bow[rows, cols]
+            return log_reconstructed_bow.new_zeros(target_bow.size(0)).index_add_(0, rows, word_losses)
         reconstruction_loss = torch.sum(target_bow * log_reconstructed_bow, dim=-1)
         return reconstruction_loss
 
@@ -233,6 +259,54 @@ class VAMPIRE(Model):
 
             self._metric_epoch_tracker = epoch_num[0]
 
+    def load_npmi_reference(self) -> None:
+        """
+        Load the reference data needed to compute NPMI. If ``scripts/preprocess_data.py``
+        precomputed NPMI matrices for these reference files, they are loaded directly;
+        otherwise they are computed from the reference count matrix. With the ``bitset``
+        reference type, the count matrix is packed into a ``BitsetNpmiReference`` instead.
+        """
+        if self._ref_vocab is not None:
+            return
+        logger.info("Loading reference vocabulary.")
+        reference_vocabulary = cached_path(self._ref_vocabulary)
+        self._ref_vocab = read_json(reference_vocabulary)
+        self._ref_vocab_index = dict(zip(self._ref_vocab, range(len(self._ref_vocab))))
+        if self._npmi_reference_type == "bitset":
+            logger.info("Packing reference count matrix.")
+            self._npmi_reference = BitsetNpmiReference.from_counts(load_sparse(cached_path(self._ref_counts)))
+            self._ref_doc_sum = self._npmi_reference.doc_sums
+            self.n_docs = self._npmi_reference.n_docs
+            self._load_npmi_tracker()
+            return
+        if self._ref_npmi:
+            npmi_path = cached_path(self._ref_npmi)
+        else:
+            reference_counts = cached_path(self._ref_counts)
+            npmi_path = npmi_matrices_path(reference_counts, reference_vocabulary)
+        if os.path.exists(npmi_path):
+            logger.info("Loading precomputed npmi matrices from %s.", npmi_path)
+            npmi_matrices = load_npmi_matrices(npmi_path)
+        else:
+            logger.info("Loading reference count matrix.")
+            self._ref_count_mat = load_sparse(reference_counts)
+            npmi_matrices = compute_npmi_matrices(self._ref_count_mat)
+        self._npmi_numerator = npmi_matrices["numerator"]
+        self._npmi_denominator = npmi_matrices["denominator"]
+        # The denominator is the log of the interaction matrix.
+        self._ref_interaction = self._npmi_denominator
+        self._ref_doc_sum = npmi_matrices["doc_sums"]
+        self.n_docs = npmi_matrices["n_docs"]
+        self._npmi_reference = NpmiReference.from_matrices(npmi_matrices)
+        self._load_npmi_tracker()
+
+    def _load_npmi_tracker(self) -> None:
+        self._npmi_tracker = IncrementalNpmi(self._npmi_reference)
+        # Reference index of every word in the vampire namespace, -1 if it is not in the reference.
+        index_to_token = self.vocab.get_index_to_token_vocabulary(self.vocab_namespace)
+        self._vampire_to_ref = np.array([self._ref_vocab_index.get(index_to_token[index], -1)
+                                         for index in range(len(index_to_token))], dtype=np.int64)
+
     def update_npmi(self) -> None:
         """
         Update topics and NPMI at the beginning of validation.
@@ -243,14 +317,50 @@ class VAMPIRE(Model):
             epoch tracker output (containing current epoch number)
         """
 
-        if self.track_npmi and self._ref_vocab and not self.training and not self._npmi_updated:
-            topics = self.extract_topics(self.vae.get_beta())
-            self._cur_npmi = self.compute_npmi(topics[1:])
+        if self.track_npmi and self._ref_vocabulary and not self.training and not self._npmi_updated:
+            self.load_npmi_reference()
+            _, topic_indices = self.extract_topic_indices(self.vae.get_beta(), k=10)
+            if self._async_npmi:
+                if self._npmi_scorer is None:
+                    self._npmi_scorer = AsyncNpmiScorer(self._npmi_reference)
+                self._npmi_scorer.submit(self.topic_reference_indices(topic_indices))
+            else:
+                self.update_npmi_metrics(self._npmi_tracker.score(self.topic_reference_indices(topic_indices)))
             self._npmi_updated = True
         elif self.training:
             self._npmi_updated = False
 
 
+    def extract_topic_indices(self, weights: torch.Tensor, k: int = 20) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Given the learned (K, vocabulary size) weights, find the indices of
+        the top k words of each row, and of the background frequency.
+
+        Parameters
+        ----------
+        weights: ``torch.Tensor``
+            The weight matrix whose second dimension equals the vocabulary size.
+        k: ``int``
+            The number of words per topic.
+
+        Returns
+        -------
+        background: ``torch.LongTensor``
+            Shape ``(k,)`` indices of the words with highest background frequency.
+        topics: ``torch.LongTensor``
+            Shape ``(K, k)`` indices of the top words of each topic, strongest first.
+        """
+        k = min(k, weights.size(1))
+        _, background = torch.topk(self._background_freq.detach(), k)
+        _, topics = torch.topk(weights, k, dim=1)
+        return background, topics
+
+    def indices_to_words(self, indices: torch.Tensor) -> List[str]:
+        """
+        Map a 1-D tensor of indices in the vampire namespace to their tokens.
+        """
+        return [self.vocab.get_token_from_index(index, self.vocab_namespace) for index in indices.tolist()]
+
     def extract_topics(self, weights: torch.Tensor, k: int = 20) -> List[Tuple[str, List[int]]]:
         """
         Given the learned (K, vocabulary size) weights, print the
@@ -268,58 +378,54 @@ class VAMPIRE(Model):
         topics: ``List[Tuple[str, List[int]]]``
             collection of learned topics
         """
-
-        words = list(range(weights.size(1)))
-        words = [self.vocab.get_token_from_index(i, self.vocab_namespace) for i in words]
-
-        topics = []
-
-        word_strengths = list(zip(words, self._background_freq.tolist()))
-        sorted_by_strength = sorted(word_strengths,
-                                    key=lambda x: x[1],
-                                    reverse=True)
-        background = [x[0] for x in sorted_by_strength][:k]
-        topics.append(('bg', background))
-
-        for i, topic in enumerate(weights):
-            word_strengths = list(zip(words, topic.tolist()))
-            sorted_by_strength = sorted(word_strengths,
-                                        key=lambda x: x[1],
-                                        reverse=True)
-            top_k = [x[0] for x in sorted_by_strength][:k]
-            topics.append((str(i), top_k))
-
+        background, topic_indices = self.extract_topic_indices(weights, k)
+        topics = [('bg', self.indices_to_words(background))]
+        for i, topic in enumerate(topic_indices):
+            topics.append((str(i), self.indices_to_words(topic)))
         return topics
 
     @staticmethod
     def generate_npmi_vals(interactions, document_sums):
         """
-        Compute npmi values from interaction matrix and document sums
+        Compute npmi values from interaction matrix and document sums.
+        See ``vampire.common.npmi.generate_npmi_vals``.
+        """
+        return generate_npmi_vals(interactions, document_sums)
+
+    def update_npmi_metrics(self, npmi: np.ndarray) -> None:
+        """
+        Record the per-topic NPMI scores ``npmi`` in the metrics.
+        """
+        self._cur_npmi = float(npmi.mean())
+        self.metrics['npmi'] = self._cur_npmi
+        if self._track_topic_npmi:
+            for topic, topic_npmi in enumerate(npmi.tolist()):
+                self.metrics[f'npmi_{topic}'] = topic_npmi
+
+    def score_topic_indices(self, topic_indices: torch.Tensor) -> np.ndarray:
+        """
+        Per-topic NPMI of topics given as indices in the vampire namespace.
 
         Parameters
         ----------
-        interactions: ``np.ndarray``
-            Interaction matrix of size reference vocab size x reference vocab size,
-            where cell [i][j] indicates how many times word i and word j co-occur
-            in the corpus.
-        document_sums: ``np.ndarray``
-            Matrix of size number of docs x reference vocab size, where
-            cell [i][j] indicates how many times word i occur in documents
-            in the corpus
-        TODO(suchin): update this documentation
-        """
-        interaction_rows, interaction_cols = interactions.nonzero()
-        logger.info("generating doc sums...")
-        doc_sums = sparse.csr_matrix((np.log10(document_sums[interaction_rows])
-                                      + np.log10(document_sums[interaction_cols]),
-                                      (interaction_rows, interaction_cols)),
-                                     shape=interactions.shape)
-        logger.info("generating numerator...")
-        interactions.data = np.log10(interactions.data)
-        numerator = interactions - doc_sums
-        logger.info("generating denominator...")
-        denominator = interactions
-        return numerator, denominator
+        topic_indices: ``torch.LongTensor``
+            Shape ``(..., num_topics, k)``, e.g. the output of ``extract_topic_indices``,
+            or a stack of those for several checkpoints.
+
+        Returns
+        -------
+        ``np.ndarray`` of shape ``(..., num_topics)``.
+        """
+        reference_indices = self.topic_reference_indices(topic_indices)
+        return score_npmi(self._npmi_reference, reference_indices)
+
+    def topic_reference_indices(self, topic_indices: torch.Tensor) -> np.ndarray:
+        """
+        Map indices in the vampire namespace to reference vocabulary indices, with -1 for
+        words missing from the reference vocabulary.
+        """
+        self.load_npmi_reference()
+        return self._vampire_to_ref[topic_indices.cpu().numpy()]
 
     def compute_npmi(self, topics, num_words=10):
         """
@@ -332,29 +438,14 @@ class VAMPIRE(Model):
         num_words: ``int``
             number of words to compute npmi over
         """
-        topics_idx = [[self._ref_vocab_index.get(word)
-                       for word in topic[1][:num_words]] for topic in topics]
-        rows = []
-        cols = []
-        res_rows = []
-        res_cols = []
+        self.load_npmi_reference()
+        topics_idx = [[self._ref_vocab_index.get(word, -1) for word in topic[1][:num_words]] for topic in topics]
         max_seq_len = max([len(topic) for topic in topics_idx])
-
+        # Shorter topics are padded with missing words, which score 0.
+        topic_indices = np.full((len(topics_idx), max_seq_len), -1, dtype=np.int64)
         for index, topic in enumerate(topics_idx):
-            topic = list(filter(partial(is_not, None), topic))
-            if len(topic) > 1:
-                _rows, _cols = zip(*combinations(topic, 2))
-                res_rows.extend([index] * len(_rows))
-                res_cols.extend(range(len(_rows)))
-                rows.extend(_rows)
-                cols.extend(_cols)
-
-        npmi_data = ((np.log10(self.n_docs) + self._npmi_numerator[rows, cols])
-                     / (np.log10(self.n_docs) - self._npmi_denominator[rows, cols]))
-        npmi_data[npmi_data == 1.0] = 0.0
-        npmi_shape = (len(topics), len(list(combinations(range(max_seq_len), 2))))
-        npmi = sparse.csr_matrix((npmi_data.tolist()[0], (res_rows, res_cols)), shape=npmi_shape)
-        return npmi.mean()
+            topic_indices[index, :len(topic)] = topic
+        return score_npmi(self._npmi_reference, topic_indices).mean()
 
     def freeze_weights(self) -> None:
         """
@@ -364,6 +455,13 @@ class VAMPIRE(Model):
         for item in model_parameters:
             model_parameters[item].requires_grad = False
 
+    @overrides
+    def share_memory(self):
+        super().share_memory()
+        # This only moves the parameters and buffers, so let the VAE share what else it keeps.
+        self.vae.share_memory()
+        return self
+
     @overrides
     def forward(self,  # pylint: disable=arguments-differ
                 tokens: Union[Dict[str, torch.IntTensor], torch.IntTensor],
@@ -377,7 +475,8 @@ class VAMPIRE(Model):
                 must be done on the fly. If token IDs are provided, we use the bag-of-word-counts embedder to embed these
                 tokens during training.
                 2. As pre-computed bag of words vectors. This representation will be used during pretraining, where we can
-                precompute bag-of-word counts and train much faster.
+                precompute bag-of-word counts and train much faster. These may also be torch sparse tensors
+                (see ``VampireReader``'s ``sparse`` option), which are never densified.
         epoch_num: ``List[int]``
             Output of epoch tracker
         """
@@ -394,12 +493,7 @@ class VAMPIRE(Model):
         else:
             self.update_kld_weight(epoch_num)
 
-        # if you supply input as token IDs, embed them into bag-of-word-counts with a token embedder
-        if isinstance(tokens, dict):
-            embedded_tokens = (self._bag_of_words_embedder(tokens['tokens'])
-                               .to(device=self.device))
-        else:
-            embedded_tokens = tokens
+        embedded_tokens = self.embed_tokens(tokens)
 
         # Perform variational inference.
         variational_output = self.vae(embedded_tokens)
@@ -437,8 +531,64 @@ class VAMPIRE(Model):
 
         return output_dict
 
+    def embed_tokens(self, tokens: Union[Dict[str, torch.IntTensor], torch.IntTensor]) -> torch.Tensor:
+        """
+        Embed ``tokens`` (as passed to ``forward``) into bag-of-word counts.
+        """
+        # if you supply input as token IDs, embed them into bag-of-word-counts with a token embedder
+        if isinstance(tokens, dict):
+            return self._bag_of_words_embedder(tokens['tokens']).to(device=self.vae.get_beta().device)
+        return tokens
+
+    def encode(self,
+               tokens: Union[Dict[str, torch.IntTensor], torch.IntTensor],
+               num_layers: int = None) -> List[Tuple[str, torch.Tensor]]:
+        """
+        Compute only the VAE's encoder activations and theta for ``tokens``, which is what
+        downstream models use. Unlike ``forward``, this skips topic and NPMI tracking, the
+        decoder, the batchnorm over the vocabulary, the loss and the metrics.
+
+        Parameters
+        ----------
+        tokens: ``Union[Dict[str, torch.IntTensor], torch.IntTensor]``
+            A batch of tokens, as for ``forward``.
+        num_layers: ``int``, optional
+            If given, only compute the first ``num_layers`` activations.
+
+        Returns
+        -------
+        activations: ``List[Tuple[str, torch.Tensor]]``
+            The ``activations`` that ``forward`` returns.
+        """
+        if isinstance(tokens, dict):
+            token_mask = self.bag_of_words_mask(tokens['tokens'])
+            if token_mask is not None:
+                # Apply the first layer to the token ids directly, without building their bag of words.
+                return self.vae.encode_activations(tokens['tokens'], num_layers, token_mask)
+        return self.vae.encode_activations(self.embed_tokens(tokens), num_layers)
+
+    def bag_of_words_mask(self, token_ids: torch.Tensor) -> Optional[torch.Tensor]:
+        """
+        The mask of the token ids that ``bow_embedder`` counts, or ``None`` if the tokens must
+        be embedded by ``bow_embedder`` itself, as it is not a plain ``bag_of_word_counts`` embedder.
+        """
+        # pylint: disable=protected-access
+        embedder = self._bag_of_words_embedder
+        if not isinstance(embedder, BagOfWordCountsTokenEmbedder) or embedder._projection is not None:
+            return None
+        mask = token_ids != 0
+        if embedder._ignore_oov:
+            mask = mask & (token_ids != embedder._oov_idx)
+        return mask
+
     @overrides
     def get_metrics(self, reset: bool = False) -> Dict[str, float]:
+        if self._npmi_scorer is not None:
+            # The trainer resets the metrics in eval mode only at the end of validation.
+            block = self._block_on_npmi and reset and not self.training
+            npmi = self._npmi_scorer.result(block=block)
+            if npmi is not None:
+                self.update_npmi_metrics(npmi)
         output = {}
         for metric_name, metric in self.metrics.items():
             if isinstance(metric, float):
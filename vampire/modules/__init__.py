@@ -1,5 +1,7 @@
 from vampire.modules.encoder import *
+from vampire.modules.bag_of_words_linear import BagOfWordsLinear
 from vampire.modules.pretrained_vae import PretrainedVAE
 from vampire.modules.token_embedders.vampire_token_embedder import VampireTokenEmbedder
+from vampire.modules.token_embedders.precomputed_vampire_token_embedder import PrecomputedVampireTokenEmbedder
 from vampire.modules.vae import LogisticNormal
 from vampire.modules.vae import VAE
@@ -0,0 +1,69 @@
+import torch
+
+
+class BagOfWordsLinear:
+    """
+    Applies a ``torch.nn.Linear`` layer over the vocabulary to the bag of words of a batch
+    of token ids, without building the bag of words: the layer's weight is the table of a
+    summing ``embedding_bag``, so a batch costs ``O(tokens x hidden)`` rather than
+    ``O(vocabulary x hidden)``.
+
+    This is deliberately not a ``torch.nn.Module``, so that it shares the parameters of
+    the layer without adding them to the state dict of its owner a second time.
+
+    Parameters
+    ----------
+    linear : ``torch.nn.Linear``
+        The layer, whose input dimension is the size of the vocabulary.
+    """
+    def __init__(self, linear: torch.nn.Linear) -> None:
+        self.linear = linear
+        self._table = None
+        self._table_version = None
+
+    def table(self) -> torch.Tensor:
+        """
+        The layer's weight as a contiguous ``(vocabulary, hidden)`` embedding table.
+        """
+        weight = self.linear.weight
+        if torch.is_grad_enabled() and weight.requires_grad:
+            return weight.t().contiguous()
+        # Without autograd, the transposed copy is kept until the weight is modified in place
+        # (by an optimizer step or by loading a state dict), or moved.
+        version = (weight.data_ptr(), weight._version, weight.dtype)  # pylint: disable=protected-access
+        if self._table_version != version:
+            self._table = weight.detach().t().contiguous()
+            self._table_version = version
+        return self._table
+
+    def share_memory(self) -> None:
+        """
+        Build the embedding table now and move it to shared memory, so that processes forked
+        afterwards use this table instead of each building its own copy. The layer's weight
+        should already be in shared memory, as moving it would invalidate the table.
+        """
+        with torch.no_grad():
+            self.table().share_memory_()
+
+    def __call__(self, token_ids: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        """
+        Parameters
+        ----------
+        token_ids : ``torch.LongTensor``
+            Shape ``(batch_size, timesteps)`` of token ids.
+        mask : ``torch.Tensor``
+            Shape ``(batch_size, timesteps)``, zero for the tokens (e.g. padding) that are
+            not counted in the bag of words.
+
+        Returns
+        -------
+        The output of the layer for the bag of words of every document, shape
+        ``(batch_size, hidden)``.
+        """
+        table = self.table()
+        output = torch.nn.functional.embedding_bag(token_ids, table,
+                                                   per_sample_weights=mask.to(dtype=table.dtype),
+                                                   mode="sum")
+        if self.linear.bias is not None:
+            output = output + self.linear.bias
+        return output
@@ -1,52 +1,81 @@
+import hashlib
+import json
 import logging
-from typing import Union, List, Dict
+import os
+import warnings
+from typing import Union, List, Dict, Tuple
+import numpy as np
 import torch
 from overrides import overrides
 from allennlp.common import Params
-from allennlp.models.archival import load_archive
-from allennlp.common.file_utils import cached_path
 from allennlp.modules.scalar_mix import ScalarMix
 
+from vampire.common.allennlp_bridge import archive_hash, load_cached_archive
+from vampire.common.util import RepresentationCache, document_hash
+
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
+# The background frequencies are restored with the weights, so they need not be
+# computed from the training data of the archived model.
+ARCHIVE_OVERRIDES = json.dumps({"model": {"background_data_path": None}})
+
 
 class _PretrainedVAE:
     def __init__(self,
                  model_archive: str,
                  device: int,
-                 background_frequency: str,
                  requires_grad: bool = False) -> None:
 
         super(_PretrainedVAE, self).__init__()
         logger.info("Initializing pretrained VAMPIRE")
         self.cuda_device = device if torch.cuda.is_available() else -1
-        archive = load_archive(cached_path(model_archive), cuda_device=self.cuda_device)
+        archive = load_cached_archive(model_archive, cuda_device=self.cuda_device, overrides=ARCHIVE_OVERRIDES)
         self.vae = archive.model
+        # NPMI is only tracked during pretraining, so never load the reference data here.
+        self.vae.track_npmi = False
         if not requires_grad:
             self.vae.eval()
             self.vae.freeze_weights()
-        self.vae.initialize_bg_from_file(cached_path(background_frequency))
         self._requires_grad = requires_grad
 
 
 class PretrainedVAE(torch.nn.Module):
     """
     Core Pretrained VAMPIRE module
+
+    If ``scalar_mix`` is given, the mix is frozen, and layers whose mixing weight (after the
+    softmax) is below ``scalar_mix_prune_threshold`` are neither computed nor mixed. The
+    encoder stops after the last layer that is mixed.
+
+    If the VAE is frozen and ``cache_size_mb`` is given, the layer activations of every
+    document are cached, keyed by a hash of its bag of words, so that documents seen in an
+    earlier epoch skip the VAE. Least recently used activations beyond ``cache_size_mb``
+    are evicted, to a subdirectory of ``cache_directory`` (if given) named after a hash of
+    the archive and of the mixed layers.
+
+    ``background_frequency`` is deprecated and ignored, as the background frequencies are
+    restored from the archive.
     """
     def __init__(self,
                  model_archive: str,
                  device: int,
-                 background_frequency: str,
+                 background_frequency: str = None,
                  requires_grad: bool = False,
                  scalar_mix: List[int] = None,
-                 dropout: float = None) -> None:
+                 dropout: float = None,
+                 scalar_mix_prune_threshold: float = 1e-6,
+                 cache_size_mb: float = None,
+                 cache_directory: str = None) -> None:
 
         super(PretrainedVAE, self).__init__()
         logger.info("Initializing pretrained VAMPIRE")
+        if background_frequency is not None:
+            warnings.warn("background_frequency is ignored, as the background frequencies are restored "
+                          "from the archive. It will be removed in a future release.",
+                          DeprecationWarning, stacklevel=2)
         self._pretrained_model = _PretrainedVAE(model_archive=model_archive,
                                                 device=device,
-                                                background_frequency=background_frequency,
                                                 requires_grad=requires_grad)
         self._requires_grad = requires_grad
         if dropout:
@@ -64,6 +93,26 @@ class PretrainedVAE(torch.nn.Module):
                 initial_scalar_parameters=initial_params,
                 trainable=not scalar_mix)
         self.add_module('scalar_mix', self.scalar_mix)
+        # Indices of the layers that are computed and mixed.
+        self._mixed_layers = list(range(num_layers))
+        if scalar_mix and scalar_mix_prune_threshold:
+            weights = torch.softmax(torch.FloatTensor(initial_params), dim=0)
+            self._mixed_layers = [index for index, weight in enumerate(weights.tolist())
+                                  if weight >= scalar_mix_prune_threshold or index == weights.argmax().item()]
+            if len(self._mixed_layers) < num_layers:
+                logger.info("Pruning VAMPIRE layers %s from the frozen scalar mix.",
+                            sorted(set(range(num_layers)) - set(self._mixed_layers)))
+        self._layer_names = [f"encoder_layer_{index}" if index < num_layers - 1 else "theta"
+                             for index in self._mixed_layers]
+        self._cache = None
+        if cache_size_mb and requires_grad:
+            logger.warning("Not caching VAMPIRE representations, since the VAE is being fine-tuned.")
+        elif cache_size_mb:
+            if cache_directory:
+                # The spilled activations are only valid for this archive and these layers.
+                key = json.dumps([archive_hash(model_archive), self._mixed_layers])
+                cache_directory = os.path.join(cache_directory, hashlib.sha1(key.encode("utf-8")).hexdigest())
+            self._cache = RepresentationCache(int(cache_size_mb * (1 << 20)), cache_directory)
 
     def get_output_dim(self) -> int:
         output_dim = self._pretrained_model.vae.vae.encoder.get_output_dim()
@@ -87,32 +136,77 @@ class PretrainedVAE(torch.nn.Module):
         ``'mask'``:  ``torch.Tensor``
             Shape ``(batch_size, timesteps)`` long tensor with sequence mask.
         """
-        vae_output = self._pretrained_model.vae(tokens={'tokens': inputs})
+        if self._cache is not None:
+            activations = self._cached_layer_activations(inputs)
+        else:
+            activations = self.encode_layers(inputs)
 
-        layers, layer_activations = zip(*vae_output['activations'])
+        layers, layer_activations = zip(*activations)
 
         scalar_mix = getattr(self, 'scalar_mix')
-        representation = scalar_mix(layer_activations)
+        if len(self._mixed_layers) == scalar_mix.mixture_size:
+            representation = scalar_mix(layer_activations)
+        else:
+            # The pruned layers' weights are effectively zero, so the mix is over the rest.
+            normed_weights = torch.softmax(torch.cat(list(scalar_mix.scalar_parameters)), dim=0)
+            representation = scalar_mix.gamma * sum(normed_weights[index] * activation
+                                                    for index, activation in zip(self._mixed_layers,
+                                                                                 layer_activations))
 
         if self._dropout:
             representation = self._dropout(representation)
 
         return {'vae_representation': representation, 'layers': layers}
 
+    def encode_layers(self, inputs: torch.Tensor) -> List[Tuple[str, torch.Tensor]]:
+        """
+        The named activations of the layers that are mixed, for word ids ``inputs``.
+        """
+        num_layers = self._mixed_layers[-1] + 1
+        if self._requires_grad:
+            activations = self._pretrained_model.vae.encode({'tokens': inputs}, num_layers)
+        else:
+            # The frozen VAE needs no autograd graph. The activations can still be saved
+            # for the backward pass of a trainable scalar mix, unlike inference-mode tensors.
+            with torch.no_grad():
+                activations = self._pretrained_model.vae.encode({'tokens': inputs}, num_layers)
+        return [activations[index] for index in self._mixed_layers]
+
+    def _cached_layer_activations(self, inputs: torch.Tensor) -> List[Tuple[str, torch.Tensor]]:
+        keys = [document_hash(document) for document in inputs.cpu().numpy()]
+        documents = [self._cache.get(key) for key in keys]
+        missing = [index for index, document in enumerate(documents) if document is None]
+        if missing:
+            activations = self.encode_layers(inputs[torch.tensor(missing, device=inputs.device)])
+            # Shape: (num_missing, num_mixed_layers, dim)
+            stacked = torch.stack([activation for _, activation in activations], dim=1).cpu().numpy()
+            for index, document in zip(missing, stacked):
+                documents[index] = document.copy()
+                self._cache.put(keys[index], documents[index])
+        layer_activations = torch.from_numpy(np.stack(documents)).to(device=inputs.device).unbind(1)
+        return list(zip(self._layer_names, layer_activations))
+
     @classmethod
     def from_params(cls, params: Params) -> 'PretrainedVAE':
         # Add files to archive
         params.add_file_to_archive('model_archive')
         model_archive = params.pop('model_archive')
         device = params.pop('device')
-        background_frequency = params.pop('background_frequency')
+        if params.pop('background_frequency', None) is not None:
+            logger.warning("Ignoring background_frequency, as the background frequencies are restored "
+                           "from the archive.")
         requires_grad = params.pop('requires_grad', False)
         dropout = params.pop_float('dropout', None)
         scalar_mix = params.pop('scalar_mix', None)
+        scalar_mix_prune_threshold = params.pop_float('scalar_mix_prune_threshold', 1e-6)
+        cache_size_mb = params.pop_float('cache_size_mb', None)
+        cache_directory = params.pop('cache_directory', None)
         params.assert_empty(cls.__name__)
         return cls(model_archive=model_archive,
                    device=device,
-                   background_frequency=background_frequency,
                    requires_grad=requires_grad,
                    scalar_mix=scalar_mix,
-                   dropout=dropout)
+                   dropout=dropout,
+                   scalar_mix_prune_threshold=scalar_mix_prune_threshold,
+                   cache_size_mb=cache_size_mb,
+                   cache_directory=cache_directory)
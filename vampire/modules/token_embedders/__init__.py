@@ -1 +1,2 @@
 from vampire.modules.token_embedders.vampire_token_embedder import VampireTokenEmbedder
+from vampire.modules.token_embedders.precomputed_vampire_token_embedder import PrecomputedVampireTokenEmbedder
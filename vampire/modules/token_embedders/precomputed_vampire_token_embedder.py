@@ -0,0 +1,97 @@
+from typing import List
+
+import numpy as np
+import torch
+from allennlp.common.checks import ConfigurationError
+from allennlp.modules.scalar_mix import ScalarMix
+from allennlp.modules.token_embedders.token_embedder import TokenEmbedder
+
+from vampire.common.feature_store import FeatureStore
+from vampire.common.util import document_hash
+
+
+@TokenEmbedder.register("vampire_precomputed")
+class PrecomputedVampireTokenEmbedder(TokenEmbedder):
+    """
+    Look up VAMPIRE representations precomputed by ``scripts/embed.py``, instead of running
+    the VAE. Documents are found by the hash of their token ids in the ``vampire`` namespace,
+    so they must be tokenized as they were when the features were computed.
+
+    Parameters
+    ----------
+    feature_store : ``str``, required.
+        The directory written by ``scripts/embed.py``.
+    scalar_mix : ``List[int]``, optional, (default=None)
+        If the store holds every layer's activations, use these fixed scalar mix parameters
+        to weight them. If ``None``, the mix is learned, starting from the initial mix of
+        ``VampireTokenEmbedder``. Ignored for stores of mixed features.
+    dropout : ``float``, optional.
+        The dropout value to be applied to the VAMPIRE representations.
+    projection_dim : ``int``, optional
+        If given, we will project the VAMPIRE embedding down to this dimension.
+    expand_dim : `bool``, optional
+        If True, expand the dimensions of the output to a 3-dimensional matrix that can be concatenated with
+        word vectors.
+    """
+    def __init__(self,
+                 feature_store: str,
+                 scalar_mix: List[int] = None,
+                 dropout: float = None,
+                 projection_dim: int = None,
+                 expand_dim: bool = False) -> None:
+        super(PrecomputedVampireTokenEmbedder, self).__init__()
+        self._feature_store = FeatureStore(feature_store)
+        self._expand_dim = expand_dim
+        self._dropout = torch.nn.Dropout(dropout) if dropout else None
+        if len(self._feature_store.feature_shape) == 2:
+            num_layers = self._feature_store.feature_shape[0]
+            self.scalar_mix = ScalarMix(num_layers,
+                                        do_layer_norm=False,
+                                        initial_scalar_parameters=scalar_mix or [1] + [-20] * (num_layers - 2) + [1],
+                                        trainable=not scalar_mix)
+        else:
+            self.scalar_mix = None
+        vampire_dim = self._feature_store.feature_shape[-1]
+        if projection_dim:
+            self._projection = torch.nn.Linear(vampire_dim, projection_dim)
+            self.output_dim = projection_dim
+        else:
+            self._projection = None
+            self.output_dim = vampire_dim
+
+    def get_output_dim(self) -> int:
+        return self.output_dim
+
+    def forward(self,  # pylint: disable=arguments-differ
+                inputs: torch.Tensor) -> torch.Tensor:
+        """
+        Parameters
+        ----------
+        inputs: ``torch.Tensor``
+            Shape ``(batch_size, timesteps)`` of token ids in the ``vampire`` namespace.
+        Returns
+        -------
+        The VAMPIRE representations for the input sequence, shape
+        ``(batch_size, timesteps, embedding_dim)`` or ``(batch_size, embedding_dim)``
+        depending on whether expand_dim is set to True. The former is a broadcast view,
+        which is not contiguous.
+        """
+        rows = self._feature_store.lookup([document_hash(document) for document in inputs.cpu().numpy()])
+        if (rows < 0).any():
+            raise ConfigurationError(f"{int((rows < 0).sum())} documents are not in the VAMPIRE feature store. "
+                                     "Compute their features with scripts/embed.py, using the same tokenizer.")
+        features = np.asarray(self._feature_store.features[np.sort(rows)], dtype=np.float32)
+        # Memory-mapped reads are fastest in file order, so undo the sort afterwards.
+        features = torch.from_numpy(features[np.argsort(np.argsort(rows))]).to(device=inputs.device)
+        if self.scalar_mix is not None:
+            embedded = self.scalar_mix(features.unbind(1))
+        else:
+            embedded = features
+        if self._dropout:
+            embedded = self._dropout(embedded)
+        if self._projection:
+            embedded = self._projection(embedded)
+        if self._expand_dim:
+            # A broadcast view, as in VampireTokenEmbedder.
+            embedded = embedded.unsqueeze(1).expand(-1, inputs.shape[1], -1)
+        return embedded
@@ -1,13 +1,15 @@
+import logging
 from typing import List
 
 import torch
 from allennlp.common import Params
 from allennlp.data import Vocabulary
-from allennlp.modules.time_distributed import TimeDistributed
 from allennlp.modules.token_embedders.token_embedder import TokenEmbedder
 
 from vampire.modules.pretrained_vae import PretrainedVAE
 
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
 
 @TokenEmbedder.register("vampire_token_embedder")
 class VampireTokenEmbedder(TokenEmbedder):
@@ -20,12 +22,21 @@ class VampireTokenEmbedder(TokenEmbedder):
         A path to the pretrained VAMPIRE model archive
     device : ``int``, required.
         The device you'd like to load the VAE on.
-    background_frequency : ``str``, required.
-        Path to the precomputed background frequency file used with this VAMPIRE
+    background_frequency : ``str``, optional
+        Deprecated and ignored, as the background frequencies are restored from the archive.
     scalar_mix : ``List[int]``, optional, (default=None)
         If not ``None``, use these scalar mix parameters to weight the representations
         produced by different layers. These mixing weights are not updated during
         training.
+    scalar_mix_prune_threshold : ``float``, optional, (default=1e-6)
+        With a fixed ``scalar_mix``, layers whose mixing weight after the softmax is below this
+        threshold are not computed. Set to 0 to compute and mix every layer.
+    cache_size_mb : ``float``, optional
+        If given and ``requires_grad`` is False, cache up to this many megabytes of VAMPIRE
+        layer activations, keyed by a hash of each document's bag of words, so that
+        documents seen before skip the VAE.
+    cache_directory : ``str``, optional
+        If given, activations evicted from the cache are stored here rather than dropped.
     dropout : ``float``, optional.
         The dropout value to be applied to the VAMPIRE representations.
     requires_grad : ``bool``, optional
@@ -41,12 +52,15 @@ class VampireTokenEmbedder(TokenEmbedder):
     def __init__(self,
                  model_archive: str,
                  device: int,
-                 background_frequency: str,
+                 background_frequency: str = None,
                  scalar_mix: List[int] = None,
                  dropout: float = None,
                  requires_grad: bool = False,
                  projection_dim: int = None,
-                 expand_dim: bool = False) -> None:
+                 expand_dim: bool = False,
+                 scalar_mix_prune_threshold: float = 1e-6,
+                 cache_size_mb: float = None,
+                 cache_directory: str = None) -> None:
         super(VampireTokenEmbedder, self).__init__()
 
         self._vae = PretrainedVAE(model_archive,
@@ -54,7 +68,10 @@ class VampireTokenEmbedder(TokenEmbedder):
                                   background_frequency,
                                   requires_grad,
                                   scalar_mix,
-                                  dropout)
+                                  dropout,
+                                  scalar_mix_prune_threshold,
+                                  cache_size_mb,
+                                  cache_directory)
         self._expand_dim = expand_dim
         self._layers = None
         if projection_dim:
@@ -77,21 +94,20 @@ class VampireTokenEmbedder(TokenEmbedder):
         Returns
         -------
         The VAMPIRE representations for the input sequence, shape
-        ``(batch_size, timesteps, embedding_dim)`` or ``(batch_size, timesteps)``
-        depending on whether expand_dim is set to True.
+        ``(batch_size, timesteps, embedding_dim)`` or ``(batch_size, embedding_dim)``
+        depending on whether expand_dim is set to True. The former is a broadcast view,
+        which is not contiguous.
         """
         vae_output = self._vae(inputs)
         embedded = vae_output['vae_representation']
         self._layers = vae_output['layers']
-        if self._expand_dim:
-            embedded = (embedded.unsqueeze(0)
-                        .expand(inputs.shape[1], inputs.shape[0], -1)
-                        .permute(1, 0, 2).contiguous())
         if self._projection:
-            projection = self._projection
-            for _ in range(embedded.dim() - 2):
-                projection = TimeDistributed(projection)
-            embedded = projection(embedded)
+            embedded = self._projection(embedded)
+        if self._expand_dim:
+            # Every timestep gets the same document vector, so it is projected once and then
+            # broadcast as a view, rather than copied for every timestep. The copy is left to
+            # the concatenation with the other token embeddings.
+            embedded = embedded.unsqueeze(1).expand(-1, inputs.shape[1], -1)
         return embedded
 
     # Custom vocab_to_cache logic requires a from_params implementation.
@@ -103,18 +119,25 @@ class VampireTokenEmbedder(TokenEmbedder):
         params.add_file_to_archive('model_archive')
         model_archive = params.pop('model_archive')
         device = params.pop_int('device')
-        background_frequency = params.pop('background_frequency')
+        if params.pop('background_frequency', None) is not None:
+            logger.warning("Ignoring background_frequency, as the background frequencies are restored "
+                           "from the archive.")
         requires_grad = params.pop('requires_grad', False)
         scalar_mix = params.pop("scalar_mix", None)
         dropout = params.pop_float("dropout", None)
         expand_dim = params.pop_float("expand_dim", False)
         projection_dim = params.pop_int("projection_dim", None)
+        scalar_mix_prune_threshold = params.pop_float("scalar_mix_prune_threshold", 1e-6)
+        cache_size_mb = params.pop_float("cache_size_mb", None)
+        cache_directory = params.pop("cache_directory", None)
         params.assert_empty(cls.__name__)
         return cls(expand_dim=expand_dim,
                    scalar_mix=scalar_mix,
-                   background_frequency=background_frequency,
                    device=device,
                    model_archive=model_archive,
                    dropout=dropout,
                    requires_grad=requires_grad,
-                   projection_dim=projection_dim)
+                   projection_dim=projection_dim,
+                   scalar_mix_prune_threshold=scalar_mix_prune_threshold,
+                   cache_size_mb=cache_size_mb,
+                   cache_directory=cache_directory)
@@ -4,6 +4,7 @@ import torch
 from allennlp.modules import FeedForward
 from overrides import overrides
 
+from vampire.modules.bag_of_words_linear import BagOfWordsLinear
 from vampire.modules.vae.vae import VAE
 
 
@@ -30,6 +31,7 @@ class LogisticNormal(VAE):
         self._z_dropout = torch.nn.Dropout(z_dropout)
 
         self.latent_dim = mean_projection.get_output_dim()
+        self._bag_of_words_layer = BagOfWordsLinear(encoder._linear_layers[0])  # pylint: disable=protected-access
 
     @overrides
     def forward(self, input_repr: torch.FloatTensor):  # pylint: disable = W0221
@@ -37,13 +39,12 @@ class LogisticNormal(VAE):
         Given the input representation, produces the reconstruction from theta
         as well as the negative KL-divergence, theta itself, and the parameters
         of the distribution.
+
+        ``input_repr`` may be a torch sparse tensor, in which case the first
+        encoder layer is applied with a sparse matmul.
         """
-        activations: List[Tuple[str, torch.FloatTensor]] = []
-        intermediate_input = input_repr
-        for layer_index, layer in enumerate(self.encoder._linear_layers):  # pylint: disable=protected-access
-            intermediate_input = layer(intermediate_input)
-            activations.append((f"encoder_layer_{layer_index}", intermediate_input))
-        output = self.generate_latent_code(intermediate_input)
+        activations = self.encode_layers(input_repr)
+        output = self.generate_latent_code(activations[-1][1])
         theta = output["theta"]
         activations.append(('theta', theta))
         reconstruction = self._decoder(theta)
@@ -52,6 +53,53 @@ class LogisticNormal(VAE):
 
         return output
 
+    def encode_layers(self,
+                      input_repr: torch.FloatTensor,
+                      num_layers: int = None,
+                      token_mask: torch.Tensor = None) -> List[Tuple[str, torch.FloatTensor]]:
+        """
+        The named activations of the first ``num_layers`` encoder layers (all by default).
+
+        If ``token_mask`` is given, ``input_repr`` holds token ids of shape
+        ``(batch_size, timesteps)`` rather than their bag of words. The first layer then
+        sums the embeddings of the tokens that are not masked, which is equivalent.
+        """
+        activations: List[Tuple[str, torch.FloatTensor]] = []
+        intermediate_input = input_repr
+        layers = self.encoder._linear_layers[:num_layers]  # pylint: disable=protected-access
+        for layer_index, layer in enumerate(layers):
+            if token_mask is not None and layer_index == 0:
+                intermediate_input = self._bag_of_words_layer(intermediate_input, token_mask)
+            elif intermediate_input.is_sparse:
+                intermediate_input = torch.sparse.addmm(layer.bias, intermediate_input, layer.weight.t())
+            else:
+                intermediate_input = layer(intermediate_input)
+            activations.append((f"encoder_layer_{layer_index}", intermediate_input))
+        return activations
+
+    @overrides
+    def share_memory(self):
+        super(LogisticNormal, self).share_memory()
+        # The first layer is also applied with a transposed copy of its weight, which is not a parameter.
+        self._bag_of_words_layer.share_memory()
+        return self
+
+    @overrides
+    def encode_activations(self,
+                           input_repr: torch.FloatTensor,
+                           num_layers: int = None,
+                           token_mask: torch.Tensor = None) -> List[Tuple[str, torch.FloatTensor]]:
+        """
+        The ``activations`` of ``forward``, without decoding the reconstruction. If
+        ``num_layers`` is given, only the first ``num_layers`` activations are computed.
+        See ``encode_layers`` for ``token_mask``.
+        """
+        activations = self.encode_layers(input_repr, num_layers, token_mask)
+        if num_layers is None or num_layers > len(activations):
+            theta = self.generate_latent_code(activations[-1][1])["theta"]
+            activations.append(('theta', theta))
+        return activations
+
     @overrides
     def estimate_params(self, input_repr: torch.FloatTensor):
         """
@@ -67,3 +67,25 @@ class VAE(Model):
         Encode the input_vector to the VAE's internal representation.
         """
         raise NotImplementedError
+
+    def encode_activations(self, input_repr: torch.Tensor, num_layers: int = None, token_mask: torch.Tensor = None):
+        """
+        Encode the input representation into the named activations that ``forward``
+        returns, without decoding it.
+
+        Parameters
+        ----------
+        input_repr : ``torch.Tensor``
+            Input representation, as for ``forward``.
+        num_layers : ``int``, optional
+            If given, only compute the first ``num_layers`` activations.
+        token_mask : ``torch.Tensor``, optional
+            If given, ``input_repr`` holds token ids of shape ``(batch_size, timesteps)``
+            instead of their bag of words, and this masks the tokens that are not counted.
+
+        Returns
+        -------
+        activations : ``List[Tuple[str, torch.Tensor]]``
+            The activations of every encoder layer, followed by theta.
+        """
+        raise NotImplementedError
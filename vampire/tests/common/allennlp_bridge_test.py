@@ -0,0 +1,109 @@
+# pylint: disable=no-self-use,invalid-name,protected-access
+import os
+import shutil
+from unittest import mock
+
+import torch
+from allennlp.common import Params
+from allennlp.data import Instance, Token
+from allennlp.data.fields import TextField
+from allennlp.data.token_indexers import SingleIdTokenIndexer
+from allennlp.models.archival import load_archive
+
+from vampire.common import allennlp_bridge
+from vampire.common.allennlp_bridge import (ExtendedVocabulary, LazyIndexToToken, VocabularyWithPretrainedVAE,
+                                            archive_hash, binary_vocabulary_path, load_cached_archive)
+from vampire.common.testing import VAETestCase
+
+
+class TestAllennlpBridge(VAETestCase):
+
+    def test_binary_vocabulary_round_trip(self):
+        vocab = ExtendedVocabulary(non_padded_namespaces=["vampire"])
+        for token in ["movie", "héllo", "new\nline"]:
+            vocab.add_token_to_namespace(token, "tokens")
+            vocab.add_token_to_namespace(token, "vampire")
+        directory = self.TEST_DIR / "vocabulary"
+        vocab.save_to_files(directory)
+        assert os.path.exists(binary_vocabulary_path(directory, "vampire"))
+
+        loaded = ExtendedVocabulary.from_files(directory)
+        assert isinstance(loaded.get_index_to_token_vocabulary("tokens"), LazyIndexToToken)
+        # The size is known before any token is decoded.
+        assert loaded.get_vocab_size("tokens") == vocab.get_vocab_size("tokens")
+        assert loaded.get_token_to_index_vocabulary("tokens")._token_to_index is None
+        for namespace in ["tokens", "vampire"]:
+            assert loaded.get_token_to_index_vocabulary(namespace) == vocab.get_token_to_index_vocabulary(namespace)
+            assert dict(loaded.get_index_to_token_vocabulary(namespace)) == \
+                    vocab.get_index_to_token_vocabulary(namespace)
+        # Tokens can still be added to a namespace loaded from a binary file.
+        index = loaded.add_token_to_namespace("added", "tokens")
+        assert loaded.get_token_from_index(index, "tokens") == "added"
+        assert loaded.get_vocab_size("tokens") == vocab.get_vocab_size("tokens") + 1
+
+    def test_reading_a_vocabulary_does_not_write_binary_files(self):
+        directory = self.FIXTURES_ROOT / "imdb" / "vocabulary"
+        filenames = sorted(os.listdir(directory))
+        vocab = ExtendedVocabulary.from_files(directory)
+        assert sorted(os.listdir(directory)) == filenames
+        assert not isinstance(vocab.get_index_to_token_vocabulary("vampire"), LazyIndexToToken)
+
+    def test_binary_vocabulary_is_ignored_once_the_padding_changes(self):
+        vocab = ExtendedVocabulary(non_padded_namespaces=[])
+        vocab.add_token_to_namespace("movie", "vampire")
+        directory = self.TEST_DIR / "vocabulary"
+        vocab.save_to_files(directory)
+        binary_mtime = os.path.getmtime(binary_vocabulary_path(directory, "vampire"))
+        padding_file = directory / "non_padded_namespaces.txt"
+        padding_file.write_text("vampire\n")
+        os.utime(padding_file, (binary_mtime + 1, binary_mtime + 1))
+
+        loaded = ExtendedVocabulary.from_files(directory)
+        assert not isinstance(loaded.get_index_to_token_vocabulary("vampire"), LazyIndexToToken)
+        assert loaded.get_token_to_index_vocabulary("vampire") == {"@@UNKNOWN@@": 0, "movie": 1}
+        # A binary file with the wrong padding is not used, even when it is newer.
+        os.utime(padding_file, (binary_mtime - 1, binary_mtime - 1))
+        loaded = ExtendedVocabulary.from_files(directory)
+        assert not isinstance(loaded.get_index_to_token_vocabulary("vampire"), LazyIndexToToken)
+
+    def test_vocabulary_with_vampire_is_cached(self):
+        def params():
+            return Params({"vampire_vocab_file": str(self.FIXTURES_ROOT / "imdb" / "vocabulary" / "vampire.txt"),
+                           "cache_directory": str(self.TEST_DIR / "vocabulary_cache"),
+                           "cache_key": "reader",
+                           "dataset_paths": [str(self.FIXTURES_ROOT / "imdb" / "train.jsonl")]})
+        instances = [Instance({"tokens": TextField([Token("a"), Token("movie")], {"tokens": SingleIdTokenIndexer()})})]
+        vocab = VocabularyWithPretrainedVAE.from_params(params(), instances)
+        assert len(os.listdir(self.TEST_DIR / "vocabulary_cache")) == 1
+
+        def unread_instances():
+            raise AssertionError("the instances were read")
+            yield  # pylint: disable=unreachable
+        cached = VocabularyWithPretrainedVAE.from_params(params(), unread_instances())
+        for namespace in ["tokens", "vampire"]:
+            assert cached.get_token_to_index_vocabulary(namespace) == vocab.get_token_to_index_vocabulary(namespace)
+
+    def test_cached_archive_is_extracted_once_and_loads_the_same_model(self):
+        archive_file = self.FIXTURES_ROOT / "vae" / "model.tar.gz"
+        cache_directory = self.TEST_DIR / "archives"
+        expected = load_archive(archive_file).model.state_dict()
+        for _ in range(2):
+            model = load_cached_archive(archive_file, cache_directory=cache_directory).model
+            assert len([name for name in os.listdir(cache_directory) if name != "hashes"]) == 1
+            state_dict = model.state_dict()
+            assert state_dict.keys() == expected.keys()
+            for name, parameter in expected.items():
+                assert torch.equal(state_dict[name], parameter)
+
+    def test_archive_is_only_hashed_again_once_modified(self):
+        archive_file = self.TEST_DIR / "model.tar.gz"
+        shutil.copy(self.FIXTURES_ROOT / "vae" / "model.tar.gz", archive_file)
+        cache_directory = self.TEST_DIR / "archives"
+        with mock.patch.object(allennlp_bridge, "_file_sha1", wraps=allennlp_bridge._file_sha1) as file_sha1:
+            archive_sha1 = archive_hash(archive_file, cache_directory)
+            assert archive_hash(archive_file, cache_directory) == archive_sha1
+            assert file_sha1.call_count == 1
+            stat = os.stat(archive_file)
+            os.utime(archive_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+            assert archive_hash(archive_file, cache_directory) == archive_sha1
+            assert file_sha1.call_count == 2
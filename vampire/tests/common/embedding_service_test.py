@@ -0,0 +1,60 @@
+# pylint: disable=no-self-use,invalid-name
+import asyncio
+import json
+import time
+
+import numpy as np
+
+from vampire.common.embedding_service import EmbeddingService, MicroBatcher
+from vampire.common.testing import VAETestCase
+
+
+def encode(texts):
+    # Slow enough that concurrent requests queue up behind a batch.
+    time.sleep(0.05)
+    lengths = np.array([[len(text.split())] for text in texts], dtype=np.float32)
+    return {"vector": np.hstack([lengths, 2 * lengths]), "theta": lengths}
+
+
+async def request(port, method, path, body=None):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    payload = json.dumps(body).encode("utf-8") if body is not None else b""
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n"
+                 f"Content-Length: {len(payload)}\r\n\r\n".encode("latin-1") + payload)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, content = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), json.loads(content.decode("utf-8"))
+
+
+class TestEmbeddingService(VAETestCase):
+
+    def test_concurrent_requests_are_batched(self):
+        async def run():
+            service = EmbeddingService(MicroBatcher(encode, max_batch_size=8, max_latency=0.01), ["vector", "theta"])
+            await service.start("127.0.0.1", 0)
+            port = service.sockets[0].getsockname()[1]
+            texts = [["a b", "a b c"], ["a"], ["a b c d"]] * 4
+            responses = await asyncio.gather(*[request(port, "POST", "/embed", {"texts": documents})
+                                               for documents in texts])
+            theta = await request(port, "POST", "/embed", {"texts": ["a b"], "output": "theta"})
+            bad_request = await request(port, "POST", "/embed", {"text": "a b"})
+            metrics = await request(port, "GET", "/metrics")
+            await service.stop()
+            return texts, responses, theta, bad_request, metrics
+
+        texts, responses, theta, bad_request, metrics = asyncio.get_event_loop().run_until_complete(run())
+        for documents, (status, response) in zip(texts, responses):
+            assert status == 200
+            assert response["embeddings"] == encode(documents)["vector"].tolist()
+        assert theta == (200, {"embeddings": [[2.0]]})
+        assert bad_request[0] == 400
+        status, metrics = metrics
+        assert status == 200
+        assert metrics["requests"] == 13
+        assert metrics["documents"] == 17
+        # The 12 concurrent requests did not need 12 batches, and no batch is over the limit.
+        assert metrics["batch_size"]["count"] < 12
+        assert sum(metrics["batch_size"]["counts"][-1:]) == 0
+        assert metrics["queue_depth"]["count"] == metrics["batch_size"]["count"]
@@ -0,0 +1,24 @@
+# pylint: disable=no-self-use,invalid-name
+import numpy as np
+
+from vampire.common.feature_store import FeatureStore, FeatureStoreWriter
+from vampire.common.testing import VAETestCase
+
+
+class TestFeatureStore(VAETestCase):
+
+    def test_written_features_can_be_looked_up(self):
+        features = np.random.rand(5, 3, 4).astype(np.float32)
+        keys = ["a" * 40, "b" * 40, "c" * 40, "a" * 40, "d" * 40]
+        # Reserve more rows than are written.
+        with FeatureStoreWriter(self.TEST_DIR, 10, (3, 4), "float32", {"features": "all"}) as writer:
+            writer.append(keys[:2], features[:2])
+            writer.append(keys[2:], features[2:])
+        store = FeatureStore(self.TEST_DIR)
+        assert len(store) == 5
+        assert store.feature_shape == (3, 4)
+        assert store.metadata["features"] == "all"
+        rows = store.lookup(["d" * 40, "a" * 40, "e" * 40])
+        # Duplicate documents point to their first row, missing ones to -1.
+        np.testing.assert_array_equal(rows, [4, 0, -1])
+        np.testing.assert_array_equal(store.features[rows[:2]], features[[4, 0]])
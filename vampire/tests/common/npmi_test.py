@@ -0,0 +1,83 @@
+# pylint: disable=no-self-use,invalid-name
+from itertools import combinations
+
+import numpy as np
+
+from vampire.common.npmi import (AsyncNpmiScorer, BitsetNpmiReference, IncrementalNpmi,
+                                 NpmiReference, compute_npmi_matrices, score_npmi)
+from vampire.common.testing import VAETestCase
+from vampire.common.util import load_sparse
+
+
+class TestNpmi(VAETestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.ref_counts = load_sparse(self.FIXTURES_ROOT / "reference_corpus" / "dev.npz")
+        self.reference = NpmiReference.from_matrices(compute_npmi_matrices(self.ref_counts))
+
+    def brute_force_npmi(self, topic):
+        doc_counts = self.ref_counts.toarray() > 0
+        n_docs = doc_counts.shape[0]
+        npmi_vals = []
+        for index1, index2 in combinations(topic, 2):
+            interaction = np.sum(doc_counts[:, index1] & doc_counts[:, index2])
+            if index1 < 0 or index2 < 0 or interaction == 0:
+                npmi_vals.append(0.0)
+                continue
+            numerator = (np.log10(n_docs) + np.log10(interaction)
+                         - np.log10(doc_counts[:, index1].sum()) - np.log10(doc_counts[:, index2].sum()))
+            npmi_vals.append(numerator / (np.log10(n_docs) - np.log10(interaction)))
+        return np.mean(npmi_vals)
+
+    def test_score_npmi_matches_brute_force(self):
+        rng = np.random.RandomState(0)
+        vocab_size = self.ref_counts.shape[1]
+        # -1 marks a word missing from the reference vocabulary.
+        topics = np.array([rng.choice(np.arange(-1, vocab_size), 10, replace=False) for _ in range(4)])
+        scores = score_npmi(self.reference, topics)
+        assert scores.shape == (4,)
+        expected = [self.brute_force_npmi(topic) for topic in topics]
+        np.testing.assert_allclose(scores, expected)
+
+        # Several topic sets can be scored in one call.
+        batch = np.stack([topics, topics[::-1]])
+        np.testing.assert_allclose(score_npmi(self.reference, batch), np.stack([scores, scores[::-1]]))
+
+    def test_bitset_reference_matches_sparse_reference(self):
+        bitset_reference = BitsetNpmiReference.from_counts(self.ref_counts)
+        np.testing.assert_array_equal(bitset_reference.doc_bits,
+                                      np.packbits(self.ref_counts.toarray().T > 0, axis=1))
+        rng = np.random.RandomState(0)
+        vocab_size = self.ref_counts.shape[1]
+        topics = np.array([rng.choice(np.arange(-1, vocab_size), 10, replace=False) for _ in range(4)])
+        np.testing.assert_allclose(score_npmi(bitset_reference, topics), score_npmi(self.reference, topics))
+
+    def test_incremental_npmi_matches_full_scoring(self):
+        rng = np.random.RandomState(0)
+        vocab_size = self.ref_counts.shape[1]
+        topics = np.array([rng.choice(np.arange(-1, vocab_size), 10, replace=False) for _ in range(4)])
+        tracker = IncrementalNpmi(self.reference)
+        for _ in range(5):
+            np.testing.assert_allclose(tracker.score(topics), score_npmi(self.reference, topics))
+            # Replace one topic, and reorder another without changing its words.
+            topics = topics.copy()
+            topics[rng.randint(4)] = rng.choice(np.arange(-1, vocab_size), 10, replace=False)
+            reordered = rng.randint(4)
+            topics[reordered] = topics[reordered][::-1]
+
+    def test_async_scorer_matches_synchronous_npmi(self):
+        rng = np.random.RandomState(0)
+        vocab_size = self.ref_counts.shape[1]
+        scorer = AsyncNpmiScorer(self.reference)
+        try:
+            assert scorer.result() is None
+            for _ in range(2):
+                topics = np.array([rng.choice(np.arange(-1, vocab_size), 10, replace=False) for _ in range(4)])
+                scorer.submit(topics)
+                np.testing.assert_allclose(scorer.result(block=True), score_npmi(self.reference, topics))
+                # A result is only returned once.
+                assert scorer.result(block=True) is None
+        finally:
+            scorer.close()
+        assert not scorer._finalizer.alive  # pylint: disable=protected-access
@@ -0,0 +1,73 @@
+# pylint: disable=no-self-use,invalid-name
+import json
+import os
+import shutil
+from unittest import mock
+
+import numpy as np
+import torch
+from scipy import sparse
+
+from vampire.common.allennlp_bridge import ExtendedVocabulary
+from vampire.common.testing import VAETestCase
+from vampire.common.util import (RepresentationCache, compute_background_log_frequency, document_hash,
+                                 is_csr_file, load_csr, load_sparse, save_csr)
+
+
+class TestUtil(VAETestCase):
+
+    def test_csr_round_trip(self):
+        matrix = load_sparse(self.FIXTURES_ROOT / "imdb" / "train.npz")
+        path = self.TEST_DIR / "train.csr"
+        save_csr(matrix, path)
+        assert is_csr_file(path)
+        assert not is_csr_file(self.FIXTURES_ROOT / "imdb" / "train.npz")
+
+        loaded = load_csr(path)
+        assert sparse.isspmatrix_csr(loaded)
+        # The arrays are read-only memory maps rather than in-memory copies.
+        assert not loaded.data.flags.writeable
+        np.testing.assert_allclose(loaded.toarray(), matrix.toarray())
+        # load_sparse dispatches on the file format.
+        np.testing.assert_allclose(load_sparse(path).toarray(), matrix.toarray())
+
+    def test_background_log_frequency_is_aligned_and_cached(self):
+        vocabulary_directory = self.TEST_DIR / "vocabulary"
+        shutil.copytree(self.FIXTURES_ROOT / "imdb" / "vocabulary", vocabulary_directory)
+        bgfreq_file = self.FIXTURES_ROOT / "imdb" / "vampire.bgfreq"
+        vocab = ExtendedVocabulary.from_files(vocabulary_directory)
+        with open(bgfreq_file) as file_:
+            frequencies = json.load(file_)
+        expected = torch.FloatTensor([frequencies.get(vocab.get_token_from_index(index, "vampire")) or 1e-12
+                                      for index in range(vocab.get_vocab_size("vampire"))])
+        expected[vocab.get_token_index("@@UNKNOWN@@", "vampire")] = 1e-12
+        cache_directory = self.TEST_DIR / "background_frequencies"
+        log_frequency = compute_background_log_frequency(vocab, "vampire", bgfreq_file, cache_directory)
+        assert torch.equal(log_frequency, torch.log(expected))
+        assert len(os.listdir(cache_directory)) == 1
+        # Nothing is written next to the vocabulary, and the cache is used on the next call.
+        assert sorted(os.listdir(vocabulary_directory)) == sorted(os.listdir(self.FIXTURES_ROOT / "imdb" / "vocabulary"))
+        vocab = ExtendedVocabulary.from_files(vocabulary_directory)
+        with mock.patch("vampire.common.util.align_background_log_frequency") as align:
+            assert torch.equal(compute_background_log_frequency(vocab, "vampire", bgfreq_file, cache_directory),
+                               log_frequency)
+        assert not align.called
+
+    def test_document_hash_ignores_order_and_padding(self):
+        assert document_hash([3, 2, 2, 0, 0]) == document_hash([2, 3, 2])
+        assert document_hash([3, 2, 2]) != document_hash([3, 2])
+
+    def test_representation_cache_evicts_least_recently_used(self):
+        value_size = np.zeros((2, 5), dtype=np.float32).nbytes
+        spill_directory = self.TEST_DIR / "spill"
+        cache = RepresentationCache(3 * value_size, str(spill_directory))
+        for index in range(4):
+            cache.put(str(index), np.full((2, 5), index, dtype=np.float32))
+            if index == 2:
+                cache.get("0")
+        # "1" was least recently used, so it was spilled to disk.
+        assert cache.num_bytes == 3 * value_size
+        assert (spill_directory / "1.npy").exists()
+        assert len(cache) == 4
+        np.testing.assert_array_equal(cache.get("1"), np.full((2, 5), 1))
+        assert cache.get("missing") is None
@@ -0,0 +1,33 @@
+# pylint: disable=no-self-use,invalid-name
+import numpy as np
+from allennlp.common.util import ensure_list
+from allennlp.data.dataset import Batch
+
+from vampire.common.testing import VAETestCase
+from vampire.data.dataset_readers import VampireReader
+
+
+class TestVampireReader(VAETestCase):
+
+    def test_block_reader_matches_row_reader(self):
+        path = self.FIXTURES_ROOT / "imdb" / "train.npz"
+        row_instances = ensure_list(VampireReader(min_sequence_length=3).read(path))
+        block_instances = ensure_list(VampireReader(min_sequence_length=3, block_size=2).read(path))
+
+        assert len(block_instances) == (len(row_instances) + 1) // 2
+
+        expected = np.stack([instance.fields['tokens'].array for instance in row_instances])
+        batch = Batch(block_instances)
+        batch.index_instances(None)
+        blocks = batch.as_tensor_dict()['tokens'].numpy()
+        np.testing.assert_allclose(blocks, expected)
+
+    def test_sparse_blocks_match_dense_blocks(self):
+        path = self.FIXTURES_ROOT / "imdb" / "train.npz"
+        dense = ensure_list(VampireReader(block_size=2).read(path))
+        sparse = ensure_list(VampireReader(block_size=2, sparse=True).read(path))
+        for dense_instance, sparse_instance in zip(dense, sparse):
+            dense_tensor = dense_instance.fields['tokens'].as_tensor({})
+            sparse_tensor = sparse_instance.fields['tokens'].as_tensor({})
+            assert sparse_tensor.is_sparse
+            np.testing.assert_allclose(sparse_tensor.to_dense().numpy(), dense_tensor.numpy())
@@ -1,7 +1,9 @@
 # pylint: disable=no-self-use,invalid-name,unused-import
 import numpy as np
 from allennlp.commands.train import train_model_from_file
+from allennlp.common import Params
 from allennlp.common.testing import ModelTestCase
+from allennlp.models import Model
 
 from vampire.common.allennlp_bridge import ExtendedVocabulary
 from vampire.common.testing.test_case import VAETestCase
@@ -18,6 +20,21 @@ class TestVampire(ModelTestCase):
     def test_model_can_train_save_and_load_unsupervised(self):
         self.ensure_model_can_train_save_and_load(self.param_file)
 
+    def test_async_npmi_metric_matches_synchronous_npmi(self):
+        params = Params.from_file(self.param_file)
+        params["model"]["async_npmi"] = True
+        params["model"]["block_on_npmi"] = True
+        model = Model.from_params(vocab=self.vocab, params=params["model"])
+        model.eval()
+        model.update_npmi()
+        try:
+            # The end of validation waits for the pending score.
+            metrics = model.get_metrics(reset=True)
+        finally:
+            model._npmi_scorer.close()
+        _, topic_indices = model.extract_topic_indices(model.vae.get_beta(), k=10)
+        assert np.isclose(metrics["npmi"], model.score_topic_indices(topic_indices).mean())
+
     def test_npmi_computed_correctly(self):
         save_dir = self.TEST_DIR / "save_and_load_test"
         model = train_model_from_file(self.param_file, save_dir, overrides="")
@@ -0,0 +1,68 @@
+# pylint: disable=no-self-use,invalid-name,protected-access
+from unittest import mock
+
+import numpy as np
+import pytest
+import torch
+
+from vampire.common.testing import VAETestCase
+from vampire.modules.pretrained_vae import PretrainedVAE
+
+
+class TestPretrainedVAE(VAETestCase):
+
+    def pretrained_vae(self, scalar_mix, scalar_mix_prune_threshold=1e-6, **kwargs):
+        return PretrainedVAE(str(self.FIXTURES_ROOT / 'vae' / 'model.tar.gz'),
+                             device=-1,
+                             scalar_mix=scalar_mix,
+                             scalar_mix_prune_threshold=scalar_mix_prune_threshold,
+                             **kwargs)
+
+    def test_pruned_scalar_mix_matches_the_full_scalar_mix(self):
+        inputs = torch.LongTensor([[6, 5, 4, 3, 0], [3, 2, 1, 0, 0]])
+        threshold = 1e-6
+        for weight, mixed_layers in [(1e-9, [0, 2]), (0.9 * threshold, [0, 2]), (1.1 * threshold, [0, 1, 2])]:
+            # The middle layer gets this weight after the softmax.
+            scalar_mix = [0, float(np.log(2 * weight / (1 - weight))), 0]
+            pruned = self.pretrained_vae(scalar_mix, threshold)
+            assert pruned._mixed_layers == mixed_layers
+            full = self.pretrained_vae(scalar_mix, scalar_mix_prune_threshold=0)
+            assert full._mixed_layers == [0, 1, 2]
+            np.testing.assert_allclose(pruned(inputs)['vae_representation'].detach().numpy(),
+                                       full(inputs)['vae_representation'].detach().numpy(),
+                                       rtol=1e-5, atol=1e-5)
+
+    def test_encoder_stops_at_the_last_mixed_layer(self):
+        pretrained_vae = self.pretrained_vae([1, 1, -20])
+        assert pretrained_vae._mixed_layers == [0, 1]
+        vae = pretrained_vae._pretrained_model.vae.vae
+        # Theta is not mixed, so the latent code is never computed.
+        with mock.patch.object(vae, 'generate_latent_code', side_effect=AssertionError("theta was computed")):
+            output = pretrained_vae(torch.LongTensor([[6, 5, 4, 3, 0], [3, 2, 1, 0, 0]]))
+        assert output['layers'] == ('encoder_layer_0', 'encoder_layer_1')
+
+    def test_spilled_representations_are_kept_apart_by_mixed_layers(self):
+        cache_directory = str(self.TEST_DIR / "representations")
+        inputs = torch.LongTensor([[6, 5, 4, 3, 0], [3, 2, 1, 0, 0]])
+        all_layers = self.pretrained_vae([1, 1, 1], cache_size_mb=1e-6, cache_directory=cache_directory)
+        expected = all_layers(inputs)['vae_representation'].detach().numpy()
+        # A second run with the same archive and layers reads back the spilled activations.
+        again = self.pretrained_vae([1, 1, 1], cache_size_mb=1e-6, cache_directory=cache_directory)
+        assert again._cache.spill_directory == all_layers._cache.spill_directory
+        assert len(again._cache) == 2
+        np.testing.assert_allclose(again(inputs)['vae_representation'].detach().numpy(), expected, rtol=1e-6)
+        # Fewer mixed layers must not pick up activations of a different shape.
+        two_layers = self.pretrained_vae([1, 1, -20], cache_size_mb=1e-6, cache_directory=cache_directory)
+        assert two_layers._cache.spill_directory != all_layers._cache.spill_directory
+        assert len(two_layers._cache) == 0
+        two_layers(inputs)
+
+    def test_background_frequency_is_deprecated_and_ignored(self):
+        with pytest.warns(DeprecationWarning):
+            pretrained_vae = PretrainedVAE(str(self.FIXTURES_ROOT / 'vae' / 'model.tar.gz'),
+                                           -1,
+                                           str(self.FIXTURES_ROOT / 'imdb' / 'vampire.bgfreq'),
+                                           False,
+                                           [1, 1, -20])
+        # The positional arguments after it keep their places.
+        assert pretrained_vae._mixed_layers == [0, 1]
@@ -0,0 +1,48 @@
+# pylint: disable=no-self-use,invalid-name
+import numpy as np
+import pytest
+import torch
+from allennlp.common.checks import ConfigurationError
+from allennlp.data.dataset import Batch
+from allennlp.data.token_indexers import SingleIdTokenIndexer
+from allennlp.data.tokenizers import WordTokenizer
+from allennlp.data.tokenizers.word_splitter import JustSpacesWordSplitter
+
+from scripts.embed import DocumentEncoder, iter_batches
+from vampire.common.feature_store import FeatureStoreWriter
+from vampire.common.testing import VAETestCase
+from vampire.data.dataset_readers import SemiSupervisedTextClassificationJsonReader
+from vampire.modules.token_embedders import PrecomputedVampireTokenEmbedder
+
+
+class TestPrecomputedVampireTokenEmbedder(VAETestCase):
+
+    def test_embedder_finds_the_features_of_the_classifiers_documents(self):
+        data_path = str(self.FIXTURES_ROOT / "imdb" / "train.jsonl")
+        encoder = DocumentEncoder(str(self.FIXTURES_ROOT / "vae" / "model.tar.gz"), "all")
+        store = str(self.TEST_DIR / "features")
+        with FeatureStoreWriter(store, 10, encoder.feature_shape) as writer:
+            for texts in iter_batches(data_path, batch_size=1):
+                writer.append(*encoder.embed_texts(texts))
+
+        # Index the documents as the classifier does.
+        reader = SemiSupervisedTextClassificationJsonReader(
+                token_indexers={"vampire_tokens": SingleIdTokenIndexer(namespace="vampire", lowercase_tokens=True)},
+                tokenizer=WordTokenizer(word_splitter=JustSpacesWordSplitter()),
+                max_sequence_length=400,
+                ignore_labels=True)
+        batch = Batch(list(reader.read(data_path)))
+        batch.index_instances(encoder.model.vocab)
+        token_ids = batch.as_tensor_dict()["tokens"]["vampire_tokens"]
+
+        embedder = PrecomputedVampireTokenEmbedder(store)
+        embedded = embedder(token_ids)
+        assert embedded.shape == (token_ids.shape[0], embedder.get_output_dim())
+        texts = [text for batch_texts in iter_batches(data_path, batch_size=10) for text in batch_texts]
+        _, features = encoder.embed_texts(texts)
+        # The embedder's initial scalar mix is the encoder's default one.
+        expected = np.einsum('l,bld->bd', encoder.scalar_mix.numpy(), features)
+        np.testing.assert_allclose(embedded.detach().numpy(), expected, rtol=1e-5, atol=1e-6)
+
+        with pytest.raises(ConfigurationError):
+            embedder(torch.LongTensor([[1, 2, 3]]))
@@ -131,4 +131,39 @@ class TestVampireTokenEmbedder(ModelTestCase):
         assert embedding_layer.get_output_dim() == 20
         input_tensor = torch.LongTensor([word1, word2])
         embedded = embedding_layer(input_tensor).data.numpy()
-        assert embedded.shape == (2, 50, 20)
\ No newline at end of file
+        assert embedded.shape == (2, 50, 20)
+
+    def test_encoding_token_ids_matches_encoding_their_bag_of_words(self):
+        params = Params({
+                'model_archive': VAETestCase.FIXTURES_ROOT / 'vae' / 'model.tar.gz',
+                'background_frequency': VAETestCase.FIXTURES_ROOT / 'imdb' / 'vampire.bgfreq',
+                'device': -1
+                })
+        embedding_layer = VampireTokenEmbedder.from_params(vocab=None, params=params)
+        model = embedding_layer._vae._pretrained_model.vae
+        model.eval()
+        tokens = {'tokens': torch.LongTensor([[6, 5, 4, 3, 6, 0, 0], [3, 2, 1, 0, 0, 0, 0]])}
+        assert model.bag_of_words_mask(tokens['tokens']) is not None
+        expected = model.vae.encode_activations(model.embed_tokens(tokens))
+        for (name, activation), (expected_name, expected_activation) in zip(model.encode(tokens), expected):
+            assert name == expected_name
+            np.testing.assert_allclose(activation.detach().numpy(), expected_activation.detach().numpy(),
+                                       rtol=1e-5, atol=1e-6)
+
+    def test_expanded_projection_is_a_broadcast_of_the_projected_document(self):
+        params = Params({
+                'model_archive': VAETestCase.FIXTURES_ROOT / 'vae' / 'model.tar.gz',
+                'background_frequency': VAETestCase.FIXTURES_ROOT / 'imdb' / 'vampire.bgfreq',
+                'device': -1,
+                'projection_dim': 20,
+                'expand_dim': True
+                })
+        embedding_layer = VampireTokenEmbedder.from_params(vocab=None, params=params)
+        input_tensor = torch.LongTensor([[6, 5, 4, 3, 0], [3, 2, 1, 0, 0]])
+        embedded = embedding_layer(input_tensor)
+        assert embedded.shape == (2, 5, 20)
+        assert embedded.stride(1) == 0
+        document = embedding_layer._projection(embedding_layer._vae(input_tensor)['vae_representation'])
+        for timestep in range(input_tensor.shape[1]):
+            np.testing.assert_allclose(embedded[:, timestep].detach().numpy(), document.detach().numpy(),
+                                       rtol=1e-5, atol=1e-6)
@@ -0,0 +1,108 @@
+# pylint: disable=no-self-use,invalid-name,protected-access
+import argparse
+import os
+
+import numpy as np
+import torch
+from allennlp.common import Params
+from allennlp.models import Model
+from scipy import sparse
+from sklearn.feature_extraction.text import CountVectorizer
+
+from scripts.build_reference import REFERENCE_NPMI_FILE, CooccurrenceAccumulator, build_reference, read_vocabulary
+from scripts.preprocess_data import load_data
+from vampire.common.npmi import NpmiReference, compute_npmi_matrices, score_npmi
+from vampire.common.testing import VAETestCase
+from vampire.common.util import read_json
+
+
+class TestBuildReference(VAETestCase):
+
+    def test_accumulated_cooccurrences_match_the_product_of_the_counts(self):
+        vocab_size = 50
+        ref_counts = sparse.random(200, vocab_size, density=0.1, format="csr", random_state=0,
+                                   data_rvs=lambda size: np.random.RandomState(0).randint(1, 5, size))
+        doc_counts = (ref_counts > 0).astype(np.int64)
+        bucket_directory = self.TEST_DIR / "buckets"
+        os.makedirs(bucket_directory)
+        # Buckets of 17 rows, the last of which is smaller.
+        accumulator = CooccurrenceAccumulator(vocab_size, str(bucket_directory), num_buckets=3, max_buffer_entries=100)
+        flushes = []
+        flush = accumulator.flush
+
+        def counting_flush():
+            flushes.append(1)
+            flush()
+        accumulator.flush = counting_flush
+        for start in range(0, doc_counts.shape[0], 20):
+            chunk = doc_counts[start:start + 20]
+            accumulator.add(chunk.T.dot(chunk))
+        assert len(flushes) > 2
+        interactions = accumulator.finalize()
+
+        assert interactions.shape == (vocab_size, vocab_size)
+        np.testing.assert_array_equal(interactions.toarray(), doc_counts.T.dot(doc_counts).toarray())
+        # The buckets are removed.
+        assert not os.listdir(bucket_directory)
+
+    def build_reference(self, serialization_dir, vocabulary_path=None, vocab_size=None):
+        corpus = self.TEST_DIR / "corpus.jsonl"
+        with open(corpus, "w") as corpus_file:
+            for split in ["train", "test"]:
+                for line in (self.FIXTURES_ROOT / "imdb" / f"{split}.jsonl").read_text().splitlines():
+                    print(line, file=corpus_file)
+        # Chunks of two documents and a small buffer, so that the co-occurrences are spilled.
+        build_reference(argparse.Namespace(reference_corpus_path=str(corpus),
+                                           serialization_dir=str(serialization_dir),
+                                           vocabulary_path=vocabulary_path,
+                                           vocab_size=vocab_size,
+                                           tokenize=False,
+                                           tokenizer_type="just_spaces",
+                                           workers=1,
+                                           chunk_size=2,
+                                           max_counter_size=5000000,
+                                           max_buffer_entries=100,
+                                           tmp_dir=None,
+                                           save_counts=False))
+        # The counts of the same corpus, vectorized at once.
+        vocabulary = read_json(serialization_dir / "ref.vocab.json")
+        vectorizer = CountVectorizer(vocabulary=vocabulary, binary=True, stop_words='english',
+                                     token_pattern=r'\b[^\d\W]{3,30}\b')
+        return vocabulary, vectorizer.transform(load_data(str(corpus)))
+
+    def test_reference_restricted_to_a_vocabulary_scores_like_the_in_memory_reference(self):
+        vocabulary_path = str(self.FIXTURES_ROOT / "imdb" / "vocabulary" / "vampire.txt")
+        serialization_dir = self.TEST_DIR / "reference"
+        vocabulary, ref_counts = self.build_reference(serialization_dir, vocabulary_path=vocabulary_path)
+        assert vocabulary == read_vocabulary(vocabulary_path)
+        assert os.path.exists(serialization_dir / REFERENCE_NPMI_FILE)
+
+        self.set_up_model(self.FIXTURES_ROOT / "unsupervised" / "experiment.json",
+                          self.FIXTURES_ROOT / "imdb" / "train.npz")
+        params = Params.from_file(self.param_file)
+        params["model"].pop("reference_counts")
+        params["model"]["reference_vocabulary"] = str(serialization_dir / "ref.vocab.json")
+        params["model"]["reference_npmi"] = str(serialization_dir / REFERENCE_NPMI_FILE)
+        # Without reference counts, the model can only load the built NPMI matrices.
+        model = Model.from_params(vocab=self.vocab, params=params["model"])
+
+        index_to_token = self.vocab.get_index_to_token_vocabulary("vampire")
+        reference_index = {word: index for index, word in enumerate(vocabulary)}
+        topic_indices = np.random.RandomState(0).permutation(len(index_to_token))[:50].reshape(5, 10)
+        reference_indices = np.vectorize(lambda index: reference_index.get(index_to_token[index], -1))(topic_indices)
+        expected = score_npmi(NpmiReference.from_matrices(compute_npmi_matrices(ref_counts)), reference_indices)
+        np.testing.assert_allclose(model.score_topic_indices(torch.from_numpy(topic_indices)), expected,
+                                   rtol=1e-5, atol=1e-6)
+
+    def test_reference_restricted_to_a_vocab_size_keeps_the_most_frequent_words(self):
+        serialization_dir = self.TEST_DIR / "reference"
+        vocabulary, _ = self.build_reference(serialization_dir, vocab_size=20)
+        assert len(vocabulary) == 20
+        assert os.path.exists(serialization_dir / REFERENCE_NPMI_FILE)
+        corpus = load_data(str(self.TEST_DIR / "corpus.jsonl"))
+        vectorizer = CountVectorizer(binary=True, stop_words='english', token_pattern=r'\b[^\d\W]{3,30}\b')
+        doc_frequencies = dict(zip(vectorizer.fit(corpus).get_feature_names(),
+                                   np.asarray(vectorizer.transform(corpus).sum(0)).ravel()))
+        kept = [doc_frequencies[word] for word in vocabulary]
+        dropped = [frequency for word, frequency in doc_frequencies.items() if word not in vocabulary]
+        assert min(kept) >= max(dropped)
@@ -0,0 +1,32 @@
+# pylint: disable=no-self-use,invalid-name
+import numpy as np
+
+from scripts.derive_vocabulary import FULL_VOCABULARY_DIR, TERM_COUNTS_FILE, derive_vocabulary
+from vampire.common.testing import VAETestCase
+from vampire.common.util import load_sparse, read_json, read_text
+
+
+class TestDeriveVocabulary(VAETestCase):
+
+    def test_derived_vocabulary_matches_preprocessing_with_that_vocabulary_size(self):
+        full = self.TEST_DIR / "full"
+        self.preprocess_data(full, "--save-full-vocabulary")
+        counts = [count for _, count in read_json(full / FULL_VOCABULARY_DIR / TERM_COUNTS_FILE)]
+        # CountVectorizer breaks ties between equally frequent words arbitrarily, so cut
+        # the vocabulary between two different counts.
+        vocab_size = max(size for size in range(1, 30) if counts[size - 1] > counts[size])
+
+        derived = self.TEST_DIR / "derived"
+        vocabulary = derive_vocabulary(full / FULL_VOCABULARY_DIR, vocab_size, derived)
+        expected = self.TEST_DIR / "expected"
+        self.preprocess_data(expected, "--vocab-size", str(vocab_size))
+
+        assert len(vocabulary) == vocab_size
+        assert read_text(derived / "vocabulary" / "vampire.txt") == read_text(expected / "vocabulary" / "vampire.txt")
+        for split in ["train", "dev"]:
+            derived_matrix, expected_matrix = load_sparse(derived / f"{split}.npz"), load_sparse(expected / f"{split}.npz")
+            assert derived_matrix.shape == expected_matrix.shape
+            assert (derived_matrix != expected_matrix).nnz == 0
+        derived_bgfreq, expected_bgfreq = read_json(derived / "vampire.bgfreq"), read_json(expected / "vampire.bgfreq")
+        assert derived_bgfreq.keys() == expected_bgfreq.keys()
+        np.testing.assert_allclose([derived_bgfreq[word] for word in expected_bgfreq], list(expected_bgfreq.values()))
@@ -0,0 +1,36 @@
+# pylint: disable=no-self-use,invalid-name,protected-access
+import multiprocessing
+
+import numpy as np
+import torch
+
+from scripts import embed
+from scripts.embed import DocumentEncoder, iter_batches, share_with_workers
+from vampire.common.testing import VAETestCase
+
+
+def table_pointer(_):
+    with torch.no_grad():
+        return embed._WORKER_ENCODER.model.vae._bag_of_words_layer.table().data_ptr()
+
+
+class TestEmbed(VAETestCase):
+
+    def test_forked_workers_embed_with_the_model_of_the_parent(self):
+        batches = list(iter_batches(str(self.FIXTURES_ROOT / "imdb" / "train.jsonl"), batch_size=2))
+        with self.patch_to_call_once(embed, "load_cached_archive") as load:
+            encoder = DocumentEncoder(str(self.FIXTURES_ROOT / "vae" / "model.tar.gz"), "all")
+            share_with_workers(encoder)
+            with multiprocessing.get_context("fork").Pool(2, initializer=embed._init_worker) as pool:
+                embedded = pool.map(embed._embed_batch, batches, chunksize=1)
+                table_pointers = pool.map(table_pointer, range(4), chunksize=1)
+        assert load.call_count == 1
+
+        for (keys, features), batch in zip(embedded, batches):
+            expected_keys, expected_features = encoder.embed_texts(batch)
+            assert keys == expected_keys
+            np.testing.assert_allclose(features, expected_features, rtol=1e-6)
+        # The workers use the embedding table built and shared by the parent.
+        table = encoder.model.vae._bag_of_words_layer._table
+        assert table.is_shared()
+        assert set(table_pointers) == {table.data_ptr()}
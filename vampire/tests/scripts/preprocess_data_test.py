@@ -0,0 +1,56 @@
+# pylint: disable=no-self-use,invalid-name
+import glob
+import json
+import os
+
+import numpy as np
+
+from scripts.preprocess_data import _load_shard, iter_data_parallel, load_data, shard_offsets
+from vampire.common.npmi import load_npmi_matrices
+from vampire.common.testing import VAETestCase
+from vampire.common.util import load_sparse, read_json, read_text
+
+
+class TestPreprocessData(VAETestCase):
+
+    def test_streaming_matches_in_memory_preprocessing(self):
+        in_memory = self.TEST_DIR / "in_memory"
+        streamed = self.TEST_DIR / "streamed"
+        self.preprocess_data(in_memory, "--output-format", "csr")
+        # Chunks of two documents, so that every split is vectorized in several chunks.
+        self.preprocess_data(streamed, "--output-format", "csr", "--streaming", "--chunk-size", "2")
+
+        assert read_text(streamed / "vocabulary" / "vampire.txt") == read_text(in_memory / "vocabulary" / "vampire.txt")
+        assert read_json(streamed / "reference" / "ref.vocab.json") == read_json(in_memory / "reference" / "ref.vocab.json")
+        for path in ["train.csr", "dev.csr", os.path.join("reference", "ref.csr")]:
+            expected, actual = load_sparse(in_memory / path), load_sparse(streamed / path)
+            assert actual.shape == expected.shape
+            assert (actual != expected).nnz == 0
+        expected_bgfreq, bgfreq = read_json(in_memory / "vampire.bgfreq"), read_json(streamed / "vampire.bgfreq")
+        assert bgfreq.keys() == expected_bgfreq.keys()
+        np.testing.assert_allclose([bgfreq[word] for word in expected_bgfreq], list(expected_bgfreq.values()))
+
+        expected_npmi, = glob.glob(str(in_memory / "reference" / "npmi.*.npz"))
+        npmi, = glob.glob(str(streamed / "reference" / "npmi.*.npz"))
+        expected_npmi, npmi = load_npmi_matrices(expected_npmi), load_npmi_matrices(npmi)
+        assert npmi["n_docs"] == expected_npmi["n_docs"]
+        np.testing.assert_allclose(npmi["doc_sums"], expected_npmi["doc_sums"])
+        for name in ("numerator", "denominator"):
+            np.testing.assert_allclose(npmi[name].toarray(), expected_npmi[name].toarray())
+
+    def test_sharded_parallel_reads_match_a_serial_read(self):
+        data_path = str(self.TEST_DIR / "data.jsonl")
+        rng = np.random.RandomState(0)
+        with open(data_path, "w") as data_file:
+            for index in range(101):
+                print(json.dumps({"text": f"document {index} " + "word " * rng.randint(0, 20)}), file=data_file)
+        # The file size is not a multiple of the number of shards.
+        assert os.path.getsize(data_path) % 2 != 0 and os.path.getsize(data_path) % 3 != 0
+        expected = load_data(data_path)
+        for num_shards in [1, 2, 3, 200]:
+            shards = shard_offsets(data_path, num_shards)
+            assert shards[0][0] == 0 and shards[-1][1] == os.path.getsize(data_path)
+            assert all(end == start for (_, end), (start, _) in zip(shards, shards[1:]))
+            texts = [text for start, end in shards for text in _load_shard((data_path, start, end, False, None))]
+            assert texts == expected
+        assert list(iter_data_parallel(data_path, False, "just_spaces", workers=3, shard_size=500)) == expected
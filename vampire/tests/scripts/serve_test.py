@@ -0,0 +1,56 @@
+# pylint: disable=no-self-use,invalid-name
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+import numpy as np
+
+from scripts import embed
+from scripts.embed import DocumentEncoder
+from scripts.serve import build_encode_function, serve_workers
+from vampire.common.testing import VAETestCase
+
+
+async def embed_request(unix_socket, texts):
+    reader, writer = await asyncio.open_unix_connection(unix_socket)
+    payload = json.dumps({"texts": texts}).encode("utf-8")
+    writer.write(f"POST /embed HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n"
+                 f"Content-Length: {len(payload)}\r\n\r\n".encode("latin-1") + payload)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, content = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), json.loads(content.decode("utf-8"))
+
+
+class TestServe(VAETestCase):
+
+    def test_forked_workers_serve_the_model_of_the_parent(self):
+        with open(self.FIXTURES_ROOT / "imdb" / "train.jsonl") as data_file:
+            texts = [json.loads(line)["text"] for line in data_file]
+        unix_socket = str(self.TEST_DIR / "vampire.sock")
+        args = argparse.Namespace(host=None, port=None, unix_socket=unix_socket, max_batch_size=4,
+                                  max_latency_ms=1.0, threads=1, workers=2)
+        with self.patch_to_call_once(embed, "load_cached_archive") as load:
+            encoder = DocumentEncoder(str(self.FIXTURES_ROOT / "vae" / "model.tar.gz"), "all")
+            server = threading.Thread(target=serve_workers, args=(encoder, args))
+            server.start()
+            try:
+                while not os.path.exists(unix_socket):
+                    time.sleep(0.01)
+                responses = asyncio.get_event_loop().run_until_complete(
+                        asyncio.gather(*[embed_request(unix_socket, [text]) for text in texts]))
+            finally:
+                for worker in multiprocessing.active_children():
+                    worker.terminate()
+                server.join()
+        assert load.call_count == 1
+
+        expected = build_encode_function(encoder)(texts)["vector"]
+        for (status, response), vector in zip(responses, expected):
+            assert status == 200
+            np.testing.assert_allclose(response["embeddings"], [vector], rtol=1e-5, atol=1e-6)